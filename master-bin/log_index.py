@@ -0,0 +1,167 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# This file is part of Piuparts
+#
+# Piuparts is free software; you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation; either version 2 of the License, or (at your
+# option) any later version.
+#
+# Piuparts is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General
+# Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, see <http://www.gnu.org/licenses/>.
+
+
+import os
+import sys
+import time
+import argparse
+import fcntl
+
+import piupartslib
+from piupartslib.logindex import LogIndex, LOG_DIRS
+
+
+CONFIG_FILE = "/etc/piuparts/piuparts.conf"
+
+
+class Busy(Exception):
+
+    def __init__(self):
+        self.args = "section is locked by another process",
+
+
+class LogIndex_Config(piupartslib.conf.Config):
+
+    """Configuration parameters for the logfile index"""
+
+    def __init__(self, section="global", defaults_section=None):
+        self.section = section
+        piupartslib.conf.Config.__init__(self, section,
+                                         {
+                                         "sections": "report",
+                                         "master-directory": ".",
+                                         "log-index": None,
+                                         },
+                                         defaults_section=defaults_section)
+
+
+def update_paths(index, paths):
+    """ Update the index of logfiles (or directories) changed by scripts """
+
+    dirs = set()
+    for path in paths:
+        index.update(path)
+        dirs.add(path if os.path.isdir(path) else os.path.dirname(path))
+    # let a running master daemon notice the change (again) and query the
+    # updated index, it might have reloaded before the update
+    for dirname in dirs:
+        if os.path.isdir(dirname):
+            os.utime(dirname, None)
+
+
+def process_section(index, sectiondir, args):
+    """ Rebuild, verify or list the index of this section, returns the
+        number of problems found """
+
+    if args.command == "list":
+        older_than = newer_than = None
+        now = time.time()
+        if args.older_than is not None:
+            older_than = now - args.older_than * 86400
+        if args.newer_than is not None:
+            newer_than = now - args.newer_than * 86400
+        for path in index.query(sectiondir, args.dirs or LOG_DIRS, older_than, newer_than):
+            print path
+        return 0
+
+    with open(os.path.join(sectiondir, "master.lock"), "we") as lock:
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError:
+            raise Busy()
+
+        if args.command == "rebuild":
+            index.rebuild(sectiondir)
+            return 0
+
+        problems = index.verify(sectiondir)
+        for (problem, path) in problems:
+            print "%s: %s" % (problem, path)
+        if problems and args.fix:
+            index.rebuild(sectiondir)
+        return len(problems)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description="Maintain the index of the logfiles",
+                 epilog="""
+'rebuild' replaces the index of the sections with the logfiles found on disk,
+'verify' reports logfiles that are missing in the index, stale or changed,
+and exits non-zero if there were any, 'list' prints the paths of the indexed
+logfiles (relative to the master directory) sorted by age, oldest first.
+'update' takes the paths of logfiles (or log directories) that were created,
+moved or removed (e.g. by the cron jobs) instead of SECTIONs and updates
+their entries.
+""")
+
+    parser.add_argument('command', choices=['rebuild', 'verify', 'list', 'update'])
+
+    parser.add_argument('sections', nargs='*', metavar='SECTION',
+                        help="limit processing to the listed SECTION(s), "
+                        "update: the changed PATH(s)")
+
+    parser.add_argument('--fix', action='store_true',
+                        help="verify: rebuild the index of sections with problems")
+
+    parser.add_argument('--dir', dest='dirs', action='append', choices=LOG_DIRS,
+                        help="list: only list logfiles in DIR (may be repeated)")
+
+    parser.add_argument('--older-than', type=float, metavar='DAYS',
+                        help="list: only list logfiles older than DAYS")
+
+    parser.add_argument('--newer-than', type=float, metavar='DAYS',
+                        help="list: only list logfiles newer than DAYS")
+
+    args = parser.parse_args()
+
+    conf = LogIndex_Config()
+    conf.read(CONFIG_FILE)
+
+    if not conf['log-index']:
+        sys.exit("log-index is not configured in %s" % CONFIG_FILE)
+
+    # paths are relative to the current directory
+    paths = [os.path.abspath(path) for path in args.sections]
+
+    os.chdir(conf['master-directory'])
+    index = LogIndex(conf['log-index'])
+
+    if args.command == "update":
+        update_paths(index, paths)
+        sys.exit(0)
+
+    sections = args.sections
+    if not sections:
+        sections = conf['sections'].split()
+
+    problems = 0
+    for section in sections:
+        if not os.path.isdir(section):
+            continue
+        try:
+            problems += process_section(index, section, args)
+        except Busy:
+            sys.stderr.write("%s: %s\n" % (section, Busy()))
+            problems += 1
+
+    if problems:
+        sys.exit(1)
+
+# vi:set et ts=4 sw=4 :
@@ -0,0 +1,100 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# This file is part of Piuparts
+#
+# Piuparts is free software; you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation; either version 2 of the License, or (at your
+# option) any later version.
+#
+# Piuparts is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General
+# Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, see <http://www.gnu.org/licenses/>.
+
+
+import os
+import sys
+import time
+import argparse
+
+import piupartslib
+from piupartslib.submissions import SubmissionsJournal, format_submission
+
+
+CONFIG_FILE = "/etc/piuparts/piuparts.conf"
+
+
+class Submissions_Config(piupartslib.conf.Config):
+
+    """Configuration parameters for the submissions journal"""
+
+    def __init__(self, section="global", defaults_section=None):
+        self.section = section
+        piupartslib.conf.Config.__init__(self, section,
+                                         {
+                                         "sections": "report",
+                                         "master-directory": ".",
+                                         },
+                                         defaults_section=defaults_section)
+
+
+def process_section(journal, section, args):
+    """ Convert or query the submissions journal of this section """
+
+    if args.command == "convert":
+        count = journal.convert()
+        print "%s: %d submissions" % (section, count)
+        return
+
+    since = time.time() - args.hours * 3600
+    if args.command == "list":
+        for s in journal.since(since):
+            sys.stdout.write("%s %s" % (section, format_submission(s)))
+    else:
+        throughput = journal.throughput(since)
+        for hour in sorted(throughput):
+            print "%s %s %d" % (section, time.strftime("%Y-%m-%d %H:00", time.gmtime(hour)),
+                                throughput[hour])
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description="Convert or query the journal of submitted logs",
+                 epilog="""
+'convert' rewrites submissions.txt (e.g. in the old format without slave,
+duration and size) in the current format and rebuilds its index, 'list'
+prints the submissions of the last HOURS, 'throughput' the number of
+submissions per hour (UTC).
+""")
+
+    parser.add_argument('command', choices=['convert', 'list', 'throughput'])
+
+    parser.add_argument('sections', nargs='*', metavar='SECTION',
+                        help="limit processing to the listed SECTION(s)")
+
+    parser.add_argument('--hours', type=float, default=24,
+                        help="list, throughput: the last HOURS (default: 24)")
+
+    args = parser.parse_args()
+
+    conf = Submissions_Config()
+    conf.read(CONFIG_FILE)
+
+    os.chdir(conf['master-directory'])
+
+    sections = args.sections
+    if not sections:
+        sections = conf['sections'].split()
+
+    for section in sections:
+        if not os.path.isdir(section):
+            continue
+        journal = SubmissionsJournal(os.path.join(section, "submissions.txt"))
+        process_section(journal, section, args)
+
+# vi:set et ts=4 sw=4 :
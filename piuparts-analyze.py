@@ -40,18 +40,17 @@ import subprocess
 import fcntl
 
 import debianbts
-import apt_pkg
 from signal import alarm, signal, SIGALRM
 from collections import deque
 
 import piupartslib.conf
+import piupartslib.logindex
+from piupartslib.versions import version_compare, version_key
 from piupartslib.conf import MissingSection
 
 
 CONFIG_FILE = "/etc/piuparts/piuparts.conf"
 
-apt_pkg.init_system()
-
 error_pattern = re.compile(r"(?<=\n).*error.*\n?", flags=re.IGNORECASE)
 chroot_pattern = re.compile(r"tmp/tmp.*?'")
 
@@ -123,7 +122,7 @@ class PiupartsBTS():
                     pass
                 else:
                     versions.append(v)
-            self._bug_versions[bug] =  list(reversed(sorted(versions, cmp=apt_pkg.version_compare))) or ['~']
+            self._bug_versions[bug] =  list(reversed(sorted(versions, key=version_key))) or ['~']
         self._queries += 1
         return self._bug_versions[bug]
 
@@ -131,6 +130,7 @@ class PiupartsBTS():
         print("PiupartsBTS: %d queries, %d forwarded to debianbts" % (self._queries, self._misses))
 
 
+log_index = None
 piupartsbts = PiupartsBTS()
 
 ############################################################################
@@ -148,12 +148,15 @@ class Config(piupartslib.conf.Config):
                                          {
                                          "sections": "report",
                                          "master-directory": ".",
+                                         "log-index": None,
                                          },
                                          defaults_section=defaults_section)
 
 
 def find_logs(directory):
     """Returns list of logfiles sorted by age, newest first."""
+    if log_index is not None:
+        return [os.path.join(directory, x[0]) for x in reversed(log_index.list_dir(directory))]
     logs = [os.path.join(directory, x)
             for x in os.listdir(directory) if x.endswith(".log")]
     return [y[1] for y in reversed(sorted([(os.path.getmtime(x), x) for x in logs]))]
@@ -238,6 +241,8 @@ def write_bug_file(failed_log, bugs):
 def move_to_bugged(failed_log, bugged="bugged", bug=None):
     print("Moving %s to %s (#%s)" % (failed_log, bugged, bug))
     os.rename(failed_log, os.path.join(bugged, os.path.basename(failed_log)))
+    if log_index is not None:
+        log_index.move(failed_log, os.path.join(bugged, os.path.basename(failed_log)))
     if bug is not None:
         write_bug_file(os.path.join(bugged, os.path.basename(failed_log)), [bug])
 
@@ -249,6 +254,8 @@ def mark_bugged_version(failed_log, bugged_log):
     failed_headers = extract_headers(failed_log)
     prepend_to_file(failed_log, bugged_headers)
     prepend_to_file(bugged_log, failed_headers)
+    if log_index is not None:
+        log_index.add(bugged_log)
     move_to_bugged(failed_log)
 
 
@@ -286,7 +293,7 @@ def mark_logs_with_reported_bugs():
                 for bug_version in found_versions:
                     # print('DEBUG: %s/%s #%d %s' % (pname, pversion, bug, bug_version))
 
-                    if apt_pkg.version_compare(pversion, bug_version) > 0:  # pversion > bug_version
+                    if version_compare(pversion, bug_version) > 0:  # pversion > bug_version
                         bugged_logs = find_bugged_logs(failed_log)
                         if not bugged_logs and not moved:
                             print('%s/%s: Maybe the bug was filed earlier: https://bugs.debian.org/%d against %s/%s'
@@ -295,7 +302,7 @@ def mark_logs_with_reported_bugs():
                         for bugged_log in bugged_logs:
                             old_pversion = package_source_version(bugged_log)
                             bugged_errors = extract_errors(bugged_log)
-                            if (apt_pkg.version_compare(old_pversion, bug_version) == 0  # old_pversion == bug_version
+                            if (version_compare(old_pversion, bug_version) == 0  # old_pversion == bug_version
                                 and
                                     failed_errors == bugged_errors):
                                 # a bug was filed for an old version of the package,
@@ -316,10 +323,14 @@ def mark_logs_with_reported_bugs():
 
 
 def main():
+    global log_index
+
     conf = Config()
     conf.read(CONFIG_FILE)
 
     master_directory = conf["master-directory"]
+    if conf["log-index"]:
+        log_index = piupartslib.logindex.LogIndex(os.path.join(master_directory, conf["log-index"]))
     if len(sys.argv) > 1:
         sections = sys.argv[1:]
     else:
@@ -29,7 +29,14 @@ import logging
 import os
 import fcntl
 import time
+import hashlib
+import zlib
+import lzma
 import random
+import select
+import socket
+import threading
+from contextlib import contextmanager
 from urllib2 import URLError
 
 import piupartslib
@@ -40,6 +47,8 @@ from piupartslib.conf import MissingSection
 CONFIG_FILE = "/etc/piuparts/piuparts.conf"
 DISTRO_CONFIG_FILE = "/etc/piuparts/distros.conf"
 
+metrics = piupartslib.metrics.registry
+
 
 log_handler = None
 
@@ -71,6 +80,15 @@ class Config(piupartslib.conf.Config):
                                          "log-file": None,
                                          "master-directory": ".",
                                          "proxy": None,
+                                         "packages-cache-directory": None,
+                                         "log-index": None,
+                                         "master-socket": None,
+                                         "refresh-interval": 600,
+                                         "package-state-checkpoint": "no",
+                                         "reservation-lease-time": 0,
+                                         "max-log-size": 104857600,
+                                         "metrics-file": None,
+                                         "metrics-interval": 60,
                                          "mirror": None,
                                          "distro": None,
                                          "area": None,
@@ -89,8 +107,8 @@ class CommandSyntaxError(Exception):
 
 class ProtocolError(Exception):
 
-    def __init__(self):
-        self.args = "EOF, missing space in long part, or other protocol error",
+    def __init__(self, msg="EOF, missing space in long part, or other protocol error"):
+        self.args = msg,
 
 
 class Protocol:
@@ -112,6 +130,14 @@ class Protocol:
     def _short_response(self, *words):
         self._writeline(" ".join(words))
 
+    def _long_response(self, words, lines):
+        self._output.write(" ".join(words) + "\n")
+        for line in lines:
+            self._output.write(" " + line + "\n")
+        self._output.write(".\n")
+        self._output.flush()
+        logging.debug("<< %s (+%d lines)" % (" ".join(words), len(lines)))
+
     def _read_long_part(self):
         lines = []
         while True:
@@ -125,18 +151,281 @@ class Protocol:
             lines.append(line[1:])
         return "".join(lines)
 
+    def _read_data(self, size):
+        data = self._input.read(size)
+        logging.debug(">> (%d bytes of data)" % len(data))
+        if len(data) != size:
+            raise ProtocolError()
+        return data
+
+    def _decompress(self, compression, data, checksum, max_size):
+        """Return the decompressed data after verifying its sha256 checksum,
+           it must not exceed max_size bytes"""
+        decompressor = _decompressors[compression]()
+        try:
+            # stop once the output exceeds the limit
+            data = decompressor.decompress(data, max_size + 1)
+        except Exception as e:
+            raise ProtocolError("Decompression failed: %s" % e)
+        if len(data) > max_size or decompressor.unconsumed_tail:
+            raise ProtocolError("Decompressed log exceeds %d bytes" % max_size)
+        if hashlib.sha256(data).hexdigest() != checksum:
+            raise ProtocolError("Checksum mismatch")
+        return data
+
+
+_decompressors = {
+    "zlib": zlib.decompressobj,
+    "xz": lzma.LZMADecompressor,
+}
+
+
+def try_flock(f, operation):
+    """Try to lock a file without blocking, returns whether it succeeded"""
+    try:
+        fcntl.flock(f, operation | fcntl.LOCK_NB)
+    except IOError:
+        return False
+    return True
+
+
+class SharedSection:
+
+    """The state of a section shared by all sessions of a long-running master
+
+    All commands of the sessions in this section are serialized by try_lock(),
+    which also holds the master.lock of the section while the command is
+    processed, so that other tools (piuparts-report, piuparts-analyze, ...)
+    can still modify the section between commands.
+
+    The package databases (one set for normal and one for recycle mode) are
+    kept in memory across sessions. Their states are recomputed if another
+    process changed the logfiles. At most every refresh_interval seconds
+    the Packages files on the mirror and the logfiles of the
+    depends-sections are checked for changes, too. The databases of the
+    depends-sections are those of their own SharedSections (in normal
+    mode), which are locked, too, while a command is processed.
+    """
+
+    def __init__(self, section, refresh_interval):
+        self.section = section
+        self.depends = []     # SharedSections of the depends-sections
+        self._refresh_interval = refresh_interval
+        self._lock = threading.RLock()
+        self._lockfile = None
+        self._databases = {}  # recycle mode -> {section: PackagesDB}
+        self._mtimes = {}     # PackagesDB -> mtime of its log directories
+        self._observed = {}   # recycle mode -> mtime seen by checkout()
+        self._validators = {}  # recycle mode -> {url: validators}
+        self._checked = {}    # recycle mode -> time of the last refresh check
+        self.log_index = None
+
+    def _open_lockfile(self):
+        if self._lockfile is None:
+            if not os.path.exists(self.section):
+                os.makedirs(self.section)
+            self._lockfile = open(os.path.join(self.section, "master.lock"), "we")
+
+    def is_busy(self):
+        """Check whether another process holds the master.lock"""
+        with self._lock:
+            self._open_lockfile()
+            if not try_flock(self._lockfile, fcntl.LOCK_EX):
+                return True
+            fcntl.flock(self._lockfile, fcntl.LOCK_UN)
+            return False
+
+    def _get_height(self, seen=()):
+        """Return the length of the longest chain of depends-sections"""
+        heights = [shared._get_height(seen + (self,)) + 1
+                   for shared in self.depends if shared not in seen + (self,)]
+        return max(heights or [0])
+
+    def _get_all_depends(self):
+        """Return the SharedSections of all (recursive) depends-sections
+
+        They are ordered by the length of their chain of depends-sections
+        (and name), so that all threads lock them in the same order, a
+        section before its depends-sections.
+        """
+        all_depends = []
+        more = list(self.depends)
+        while more:
+            shared = more.pop()
+            if shared is not self and shared not in all_depends:
+                all_depends.append(shared)
+                more.extend(shared.depends)
+        return sorted(all_depends, key=lambda x: (-x._get_height(), x.section))
+
+    @contextmanager
+    def try_lock(self, shared=False):
+        """Lock the section for a command, without waiting for other processes
+
+        Yields "exclusive" or (if shared is set and another process holds a
+        shared lock) "shared", or None if the master.lock is not available.
+        Never blocks on the master.lock, since all other sessions of the
+        section would have to wait, too.
+        """
+        with self._lock:
+            depends = self._get_all_depends()
+            for dep in depends:
+                dep._lock.acquire()
+            try:
+                self._open_lockfile()
+                mode = None
+                if try_flock(self._lockfile, fcntl.LOCK_EX):
+                    mode = "exclusive"
+                elif shared and try_flock(self._lockfile, fcntl.LOCK_SH):
+                    mode = "shared"
+                try:
+                    yield mode
+                finally:
+                    if mode is not None:
+                        fcntl.flock(self._lockfile, fcntl.LOCK_UN)
+            finally:
+                for dep in reversed(depends):
+                    dep._lock.release()
+
+    def _get_validators(self, databases):
+        validators = {}
+        for db in databases.values():
+            for url in db.get_urls():
+                try:
+                    validators[url] = piupartslib.packagescache.get_url_validators(url)
+                except URLError:
+                    validators[url] = None
+        return validators
+
+    def checkout(self, recycle_mode):
+        """Return the package databases (or None if not loaded yet)
+
+        Must be called with the lock held.
+        """
+        databases = self._databases.get(recycle_mode)
+        if databases is None:
+            return None
+        main_db = databases[self.section]
+        reload_states = False
+        if self._checked[recycle_mode] + self._refresh_interval < time.time():
+            self._checked[recycle_mode] = time.time()
+            if self._get_validators(databases) != self._validators[recycle_mode]:
+                logging.info("%s: Packages files changed, reloading" % self.section)
+                main_db.flush_submissions()
+                del self._databases[recycle_mode]
+                return None
+            for db in databases.values():
+                if db is not main_db and db.get_mtime() != self._mtimes.get(db):
+                    logging.info("%s: logs in %s changed" % (self.section, db.prefix))
+                    db.reload_package_states()
+                    self._mtimes[db] = db.get_mtime()
+                    reload_states = True
+        mtime = main_db.get_mtime()
+        self._observed[recycle_mode] = mtime
+        if mtime != self._mtimes.get(main_db):
+            logging.info("%s: logs changed by another process" % self.section)
+            reload_states = True
+        if reload_states:
+            main_db.reload_package_states()
+        return databases
+
+    def checkin(self, recycle_mode, databases, exclusive):
+        """Record the state of the package databases after a command
+
+        Must be called with the lock held. Unless the command held the
+        master.lock exclusively, another process (e.g. piuparts-report
+        archiving logs) may have changed the logfiles meanwhile, so only
+        the mtimes seen before the command are recorded.
+        """
+        if databases is None:
+            return
+        main_db = databases[self.section]
+        if self._databases.get(recycle_mode) is not databases:
+            # newly loaded
+            self._databases[recycle_mode] = databases
+            self._validators[recycle_mode] = self._get_validators(databases)
+            self._checked[recycle_mode] = time.time()
+            for db in databases.values():
+                if exclusive:
+                    self._mtimes[db] = db.get_mtime()
+                else:
+                    # recheck them next time
+                    self._mtimes.pop(db, None)
+        elif exclusive:
+            self._mtimes[main_db] = main_db.get_mtime()
+        else:
+            self._mtimes[main_db] = self._observed[recycle_mode]
+
+    def flush_submissions(self):
+        with self._lock:
+            for databases in self._databases.values():
+                databases[self.section].flush_submissions()
+
+
+class MasterDaemon:
+
+    """The sections shared by all sessions of a long-running master"""
+
+    def __init__(self, refresh_interval):
+        self._refresh_interval = refresh_interval
+        self._lock = threading.Lock()
+        self._sections = {}
+
+    def get_section(self, section):
+        with self._lock:
+            return self._get_section(section)
+
+    def _get_section(self, section):
+        if section not in self._sections:
+            shared = SharedSection(section, self._refresh_interval)
+            self._sections[section] = shared
+            config = Config(section=section, defaults_section="global")
+            try:
+                config.read(CONFIG_FILE)
+            except MissingSection:
+                return shared
+            if config["depends-sections"]:
+                shared.depends = [self._get_section(dep)
+                                  for dep in config["depends-sections"].split()]
+        return self._sections[section]
+
+    def flush_submissions(self):
+        with self._lock:
+            sections = self._sections.values()
+        for section in sections:
+            section.flush_submissions()
+
+
+# the highest protocol version understood by this master, see "hello"
+PROTOCOL_VERSION = 5
+
 
 class Master(Protocol):
 
-    def __init__(self, input, output):
+    # commands submitting a log, which is read before locking the section
+    _log_commands = ["pass", "fail", "untestable"]
+
+    # commands not needing a selected section
+    _session_commands = ["hello", "section", "_peer"]
+
+    # commands not modifying the section, allowed under a shared master.lock
+    _readonly_commands = ["idle", "status", "_state", "_depends", "_recursive-depends",
+                          "_depcycle", "_list", "_metrics"]
+
+    # read-only commands answered even while another process holds the
+    # master.lock exclusively, from the idle.stamp or the logfiles as they are
+    _lockfree_commands = ["idle", "status"]
+
+    def __init__(self, input, output, daemon=None):
         Protocol.__init__(self, input, output)
         self._commands = {
+            "hello": self._hello,
             "section": self._switch_section,
             "recycle": self._recycle,
             "idle": self._idle,
             "status": self._status,
             "reserve": self._reserve,
             "unreserve": self._unreserve,
+            "renew": self._renew,
             "pass": self._pass,
             "fail": self._fail,
             "untestable": self._untestable,
@@ -147,76 +436,149 @@ class Master(Protocol):
             "_recursive-depends": self._recursive_depends,
             "_depcycle": self._depcycle,
             "_list": self._list,
+            "_metrics": self._metrics,
+
+            # sent by piuparts-master when forwarding a session to the daemon
+            "_peer": self._set_peer,
         }
         self._section = None
         self._lock = None
+        self._exclusive = False
+        self._log_index = None
+        self._daemon = daemon
+        self._shared = None
+        self._binary_db = None
+        self._dummy_db = None
+        self._long_part = None
+        self._protocol_version = 1
+        self._max_log_size = 0
+        self._peer = get_peer_name()
         self._writeline("hello")
 
     def _init_section(self, section):
+        self.save_checkpoint()
+        self.flush_submissions()
         if self._lock:
             self._lock.close()
 
         # clear all settings from a previous section and set defaults
         self._section = None
         self._lock = None
+        self._exclusive = False
         self._recycle_mode = False
         self._idle_mode = None
         self._idle_stamp = os.path.join(section, "idle.stamp")
         self._package_databases = None
         self._binary_db = None
+        self._dummy_db = None
+        self._shared = None
 
         config = Config(section=section, defaults_section="global")
         try:
             config.read(CONFIG_FILE)
         except MissingSection:
             return False
+        self._max_log_size = int(config["max-log-size"])
 
         if not os.path.exists(section):
             os.makedirs(section)
 
-        self._lock = open(os.path.join(section, "master.lock"), "we")
-        try:
-            fcntl.flock(self._lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
-        except IOError:
-            return False
+        # since protocol version 5 slaves may connect to a section locked
+        # by another process, log submissions are journaled then
+        if self._daemon is not None:
+            # the section's master.lock is taken for each command
+            self._shared = self._daemon.get_section(section)
+            if self._protocol_version < 5 and self._shared.is_busy():
+                return False
+        else:
+            self._lock = open(os.path.join(section, "master.lock"), "we")
+            self._exclusive = try_flock(self._lock, fcntl.LOCK_EX)
+            if not self._exclusive and self._protocol_version < 5:
+                return False
 
         self._section = section
 
-        logging.debug(timestamp() + " switching logfile")
-        logfile = config["log-file"] or os.path.join(section, "master.log")
-        setup_logging(logging.DEBUG, logfile)
-        logging.debug(timestamp() + " connected")
+        if self._daemon is None:
+            logging.debug(timestamp() + " switching logfile")
+            logfile = config["log-file"] or os.path.join(section, "master.log")
+            setup_logging(logging.DEBUG, logfile)
+        logging.debug(timestamp() + " connected to " + section)
 
         # start with a dummy _binary_db (without Packages file), sufficient
         # for submitting finished logs
-        self._binary_db = piupartslib.packagesdb.PackagesDB(prefix=section)
+        self._binary_db = piupartslib.packagesdb.PackagesDB(logdb=self._get_logdb(config, self._shared),
+                                                            prefix=section)
+        self._binary_db.set_reservation_lease_time(int(config["reservation-lease-time"]))
+        self._dummy_db = self._binary_db
+        if self._exclusive:
+            self._binary_db.replay_log_journal()
 
         return True
 
+    def _get_logdb(self, config, shared=None):
+        if not config["log-index"]:
+            return None
+        if shared is not None:
+            # the databases outlive this session
+            if shared.log_index is None:
+                shared.log_index = piupartslib.logindex.LogIndex(config["log-index"])
+            return piupartslib.packagesdb.IndexedLogDB(shared.log_index)
+        if self._log_index is None:
+            self._log_index = piupartslib.logindex.LogIndex(config["log-index"])
+        return piupartslib.packagesdb.IndexedLogDB(self._log_index)
+
     def _init_db(self):
         if self._package_databases is not None:
             return
 
-        self._package_databases = {}
-        self._load_package_database(self._section)
+        start = time.time()
+        self._package_databases = self._load_package_databases(self._section, self._recycle_mode)
         self._binary_db = self._package_databases[self._section]
+        metrics.observe("piuparts_master_init_db_seconds", time.time() - start,
+                        {"section": self._section})
+
+    def _load_package_databases(self, section, recycle_mode):
+        """Return the package databases of a section and its depends-sections"""
+        databases = {}
+        self._load_package_database(section, section, recycle_mode, databases)
+        return databases
 
-    def _load_package_database(self, section):
-        if section in self._package_databases:
+    def _load_package_database(self, section, main_section, recycle_mode, databases):
+        if section in databases:
             return
 
+        shared = None
+        if self._daemon is not None:
+            shared = self._daemon.get_section(section)
+            if section != main_section:
+                # use (and share) the databases of the depends-section
+                for (name, db) in self._get_shared_databases(shared).iteritems():
+                    databases.setdefault(name, db)
+                return
+
         config = Config(section=section, defaults_section="global")
         config.read(CONFIG_FILE)
         distro_config = piupartslib.conf.DistroConfig(DISTRO_CONFIG_FILE, config["mirror"])
-        db = piupartslib.packagesdb.PackagesDB(prefix=section)
-        if self._recycle_mode and self._section == section:
+        packages_cache = None
+        if config["packages-cache-directory"]:
+            packages_cache = piupartslib.packagescache.PackagesCache(config["packages-cache-directory"])
+        db = piupartslib.packagesdb.PackagesDB(logdb=self._get_logdb(config, shared), prefix=section,
+                                               packages_cache=packages_cache)
+        if recycle_mode and section == main_section:
             db.enable_recycling()
-        self._package_databases[section] = db
+        databases[section] = db
+        if section == main_section:
+            db.set_reservation_lease_time(int(config["reservation-lease-time"]))
+        if section == main_section and config["package-state-checkpoint"] in ["yes", "true"]:
+            if recycle_mode:
+                db.enable_checkpoint(os.path.join(section, "package-states-recycle.checkpoint"))
+            else:
+                db.enable_checkpoint(os.path.join(section, "package-states.checkpoint"))
         if config["depends-sections"]:
             deps = config["depends-sections"].split()
             for dep in deps:
-                self._load_package_database(dep)
-            db.set_dependency_databases([self._package_databases[dep] for dep in deps])
+                self._load_package_database(dep, main_section, recycle_mode, databases)
+            db.set_dependency_databases([databases[dep] for dep in deps])
         db.load_packages_urls(
             distro_config.get_packages_urls(
                 config.get_distro(),
@@ -261,15 +623,171 @@ class Master(Protocol):
             if len(parts) > 0:
                 command = parts[0]
                 args = parts[1:]
-                if self._section is None and command != "section":
-                    raise CommandSyntaxError("Expected 'section' command, got %s" % command)
-                if command in self._commands:
-                    self._commands[command](command, args)
-                    return True
+                data_format = self.get_data_format(command, args)
+                if data_format is None:
+                    data = None
+                elif data_format == "long":
+                    data = self._read_long_part()
                 else:
-                    raise CommandSyntaxError("Unknown command %s" % command)
+                    data = self._read_data(data_format)
+                self.run_command(command, args, data)
+                return True
         return False
 
+    def _is_compressed_log(self, command, args):
+        return command in self._log_commands and \
+            self._protocol_version >= 3 and len(args) == 5
+
+    def get_data_format(self, command, args):
+        """Check a command and return how the data following it is sent
+
+        Returns None if there is no data, "long" for a long part or the
+        number of bytes to read.
+        """
+        if self._section is None and command not in self._session_commands:
+            raise CommandSyntaxError("Expected 'section' command, got %s" % command)
+        if command not in self._commands:
+            raise CommandSyntaxError("Unknown command %s" % command)
+        if self._is_compressed_log(command, args):
+            (compression, size) = args[2:4]
+            if compression not in _decompressors or not size.isdigit():
+                raise CommandSyntaxError("Invalid compressed log: %s %s" %
+                                         (command, " ".join(args)))
+            if int(size) > self._max_log_size:
+                raise CommandSyntaxError("Compressed log too large: %s bytes" % size)
+            return int(size)
+        if command in self._log_commands:
+            self._check_args(2, command, args)
+            return "long"
+        if command == "unreserve" and self._protocol_version >= 2 and not args:
+            return "long"
+        if command == "renew" and self._protocol_version >= 4:
+            return "long"
+        return None
+
+    def run_command(self, command, args, data=None):
+        """Process a command and the data read as told by get_data_format()
+
+        Commands of a long-running master are serialized per section and
+        hold the master.lock, the data was read before.
+        """
+        start = time.time()
+        section = self._section or ""
+        labels = {"section": section, "command": command}
+        if data is not None:
+            metrics.inc("piuparts_master_received_bytes_total", labels, len(data))
+        if self._is_compressed_log(command, args):
+            data = self._decompress(args[2], data, args[4], self._max_log_size)
+        if command in self._log_commands:
+            metrics.inc("piuparts_master_log_bytes_total", labels, len(data))
+        self._long_part = data
+        try:
+            if command in self._session_commands or self._exclusive:
+                self._commands[command](command, args)
+            elif self._shared is not None:
+                self._run_daemon_command(command, args, start)
+            elif command in self._readonly_commands and try_flock(self._lock, fcntl.LOCK_SH):
+                try:
+                    self._commands[command](command, args)
+                finally:
+                    fcntl.flock(self._lock, fcntl.LOCK_UN)
+            elif command in self._lockfree_commands:
+                self._commands[command](command, args)
+            else:
+                self._run_unlocked(command, args)
+        finally:
+            self._long_part = None
+            metrics.observe("piuparts_master_command_seconds", time.time() - start, labels)
+            metrics.inc("piuparts_master_commands_total",
+                        {"section": section, "command": command, "slave": self._peer})
+
+    def _run_daemon_command(self, command, args, start):
+        # like a master without daemon, answer "busy" (or journal the log)
+        # instead of waiting for another process holding the master.lock
+        with self._shared.try_lock(shared=command in self._readonly_commands) as mode:
+            metrics.observe("piuparts_master_lock_wait_seconds", time.time() - start,
+                            {"section": self._section})
+            if mode is None and command not in self._lockfree_commands:
+                self._run_unlocked(command, args)
+                return
+            self._checkout_shared(self._recycle_mode)
+            try:
+                if mode == "exclusive":
+                    self._binary_db.replay_log_journal()
+                self._commands[command](command, args)
+            finally:
+                self._update_state_metrics()
+                self._shared.checkin(self._recycle_mode, self._package_databases,
+                                     mode == "exclusive")
+
+    def _run_unlocked(self, command, args):
+        """Process a command while another process holds the master.lock"""
+        if command in self._log_commands:
+            self._dummy_db.journal_log(command, args[0], args[1], self._get_long_part(),
+                                       self._peer)
+            self._short_response("ok")
+        else:
+            self._short_response("busy")
+
+    def _update_state_metrics(self):
+        """Record the number of packages in each state of a section loaded
+           by the daemon"""
+        if self._section is None or self._package_databases is None:
+            return
+        db = self._binary_db
+        mode = "recycle" if db._recycle_mode else "normal"
+        for (state, count) in db.get_state_counts().iteritems():
+            metrics.set("piuparts_master_packages", count,
+                        {"section": self._section, "mode": mode, "state": state})
+
+    def close(self):
+        self.save_checkpoint()
+        self.flush_submissions()
+
+    def _get_shared_databases(self, shared):
+        """Return the package databases of a depends-section loaded by the
+           daemon (in normal mode), loading them if needed
+
+        Its SharedSection was locked together with the one of this session.
+        """
+        databases = shared.checkout(False)
+        if databases is None:
+            databases = self._load_package_databases(shared.section, False)
+            shared.checkin(False, databases, False)
+        return databases
+
+    def _checkout_shared(self, recycle_mode):
+        self._package_databases = self._shared.checkout(recycle_mode)
+        if self._package_databases is not None:
+            self._binary_db = self._package_databases[self._section]
+        else:
+            self._binary_db = self._dummy_db
+
+    def save_checkpoint(self):
+        """Save the package states of the current section, if enabled"""
+        if self._section is None or self._package_databases is None:
+            return
+        if self._shared is not None:
+            with self._shared.try_lock() as mode:
+                if mode is None:
+                    return
+                self._checkout_shared(self._recycle_mode)
+                try:
+                    self._binary_db.save_checkpoint()
+                finally:
+                    self._shared.checkin(self._recycle_mode, self._package_databases, True)
+        elif self._exclusive:
+            self._binary_db.save_checkpoint()
+
+    def flush_submissions(self):
+        """Write the submissions recorded in this session"""
+        for db in set([self._dummy_db, self._binary_db]):
+            if db is not None:
+                db.flush_submissions()
+
+    def _get_long_part(self):
+        return self._long_part
+
     def _check_args(self, count, command, args):
         if len(args) != count:
             raise CommandSyntaxError("Need exactly %d args: %s %s" %
@@ -280,11 +798,24 @@ class Master(Protocol):
             for name in self._binary_db.get_pkg_names_in_state(st):
                 logging.debug("%s : %s\n" % (st, name))
 
+    def _set_peer(self, command, args):
+        self._check_args(1, command, args)
+        self._peer = args[0]
+
+    def _hello(self, command, args):
+        self._check_args(1, command, args)
+        try:
+            version = int(args[0])
+        except ValueError:
+            raise CommandSyntaxError("Invalid protocol version: %s" % args[0])
+        self._protocol_version = max(1, min(version, PROTOCOL_VERSION))
+        self._short_response("ok", "%d" % self._protocol_version)
+
     def _switch_section(self, command, args):
         self._check_args(1, command, args)
         if self._init_section(args[0]):
             self._short_response("ok")
-        elif self._lock is None:
+        elif self._lock is None and self._shared is None:
             # unknown section
             self._short_response("error")
         else:
@@ -292,11 +823,17 @@ class Master(Protocol):
 
     def _recycle(self, command, args):
         self._check_args(0, command, args)
+        if self._shared is not None:
+            # switch to the shared databases in recycle mode
+            self._shared.checkin(self._recycle_mode, self._package_databases, True)
+            self._checkout_shared(True)
         if self._binary_db.enable_recycling():
             self._idle_stamp = os.path.join(self._section, "recycle.stamp")
             self._recycle_mode = True
             self._short_response("ok")
         else:
+            if self._shared is not None:
+                self._checkout_shared(self._recycle_mode)
             self._short_response("error")
 
     def _idle(self, command, args):
@@ -318,6 +855,9 @@ class Master(Protocol):
         self._short_response("ok", stats)
 
     def _reserve(self, command, args):
+        if self._protocol_version >= 2 and args:
+            self._reserve_many(command, args)
+            return
         self._check_args(0, command, args)
         self._init_db()
         package = self._binary_db.reserve_package()
@@ -326,40 +866,95 @@ class Master(Protocol):
             self._short_response("error")
         else:
             self._clear_idle()
+            self._count_reservations(1)
             self._short_response("ok",
                                  package.name(),
                                  package.test_versions())
 
+    def _reserve_many(self, command, args):
+        self._check_args(1, command, args)
+        try:
+            count = int(args[0])
+        except ValueError:
+            count = 0
+        if count < 1:
+            raise CommandSyntaxError("Invalid count: %s %s" % (command, args[0]))
+        self._init_db()
+        reserved = []
+        while len(reserved) < count:
+            package = self._binary_db.reserve_package()
+            if package is None:
+                self._set_idle()
+                break
+            reserved.append("%s %s" % (package.name(), package.test_versions()))
+        if reserved:
+            self._clear_idle()
+            self._count_reservations(len(reserved))
+            self._long_response(["ok"], reserved)
+        else:
+            self._short_response("error")
+
+    def _count_reservations(self, count):
+        metrics.inc("piuparts_master_reserved_packages_total",
+                    {"section": self._section, "slave": self._peer}, count)
+
     def _unreserve(self, command, args):
+        if self._protocol_version >= 2 and not args:
+            self._unreserve_many(command, args)
+            return
         self._check_args(2, command, args)
         self._binary_db.unreserve_package(args[0], args[1])
         self._short_response("ok")
 
+    def _get_package_list(self, command):
+        """Return the (package, version) pairs from the long part"""
+        packages = []
+        for line in self._get_long_part().splitlines():
+            words = line.split()
+            if len(words) != 2:
+                raise CommandSyntaxError("Need exactly 2 words per line: %s %s" % (command, line))
+            packages.append(words)
+        return packages
+
+    def _unreserve_many(self, command, args):
+        packages = self._get_package_list(command)
+        for (package, version) in packages:
+            self._binary_db.unreserve_package(package, version)
+        self._short_response("ok")
+
+    def _renew(self, command, args):
+        if self._protocol_version < 4:
+            raise CommandSyntaxError("Unknown command %s" % command)
+        self._check_args(0, command, args)
+        packages = self._get_package_list(command)
+        lost = []
+        for (package, version) in packages:
+            if not self._binary_db.renew_reservation(package, version):
+                lost.append("%s %s" % (package, version))
+        self._long_response(["ok", "%d" % self._binary_db.get_reservation_lease_time()], lost)
+
     def _pass(self, command, args):
-        self._check_args(2, command, args)
-        log = self._read_long_part()
+        log = self._get_long_part()
         try:
-            self._binary_db.pass_package(args[0], args[1], log)
+            self._binary_db.pass_package(args[0], args[1], log, self._peer)
         except LogfileExists:
             logging.info("Ignoring duplicate submission: %s %s %s"
                          % ("pass", args[0], args[1]))
         self._short_response("ok")
 
     def _fail(self, command, args):
-        self._check_args(2, command, args)
-        log = self._read_long_part()
+        log = self._get_long_part()
         try:
-            self._binary_db.fail_package(args[0], args[1], log)
+            self._binary_db.fail_package(args[0], args[1], log, self._peer)
         except LogfileExists:
             logging.info("Ignoring duplicate submission: %s %s %s"
                          % ("fail", args[0], args[1]))
         self._short_response("ok")
 
     def _untestable(self, command, args):
-        self._check_args(2, command, args)
-        log = self._read_long_part()
+        log = self._get_long_part()
         try:
-            self._binary_db.make_package_untestable(args[0], args[1], log)
+            self._binary_db.make_package_untestable(args[0], args[1], log, self._peer)
         except LogfileExists:
             logging.info("Ignoring duplicate submission: %s %s %s"
                          % ("untestable", args[0], args[1]))
@@ -405,6 +1000,106 @@ class Master(Protocol):
         else:
             self._short_response("error")
 
+    # debug command
+    def _metrics(self, command, args):
+        self._check_args(0, command, args)
+        self._long_response(["ok"], metrics.format().splitlines())
+
+
+def get_peer_name():
+    """Return the name of the slave connected to this process via ssh"""
+    ssh_client = os.environ.get("SSH_CLIENT", "").split()
+    if ssh_client:
+        return ssh_client[0]
+    return "local"
+
+
+def write_metrics(filename, interval):
+    while True:
+        time.sleep(interval)
+        try:
+            metrics.write(filename)
+        except (IOError, OSError) as e:
+            logging.error("writing %s failed: %s" % (filename, e))
+
+
+def parse_socket_address(value):
+    """Return (address family, address) of a "master-socket" setting:
+       either host:port or the path of a Unix socket"""
+    if "/" not in value and ":" in value:
+        (host, port) = value.rsplit(":", 1)
+        return (socket.AF_INET, (host, int(port)))
+    return (socket.AF_UNIX, value)
+
+
+def connect_to_daemon(value):
+    (family, address) = parse_socket_address(value)
+    sock = socket.socket(family, socket.SOCK_STREAM)
+    try:
+        sock.connect(address)
+    except socket.error:
+        sock.close()
+        return None
+    return sock
+
+
+def run_daemon(config):
+    (family, address) = parse_socket_address(config["master-socket"])
+    if family == socket.AF_UNIX and os.path.exists(address):
+        sock = connect_to_daemon(config["master-socket"])
+        if sock is not None:
+            sock.close()
+            sys.exit("piuparts-master is already running on %s" % address)
+        os.unlink(address)
+    sock = socket.socket(family, socket.SOCK_STREAM)
+    if family != socket.AF_UNIX:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind(address)
+    sock.listen(socket.SOMAXCONN)
+    daemon = MasterDaemon(int(config["refresh-interval"]))
+    engine = piupartslib.protocolengine.ProtocolEngine(
+        expected_errors=(ProtocolError, CommandSyntaxError, URLError, socket.error))
+    engine.listen(sock, lambda output: Master(None, output, daemon=daemon))
+    setup_logging(logging.DEBUG, "master-daemon.log")
+    logging.info(timestamp() + " listening on %s" % config["master-socket"])
+    if config["metrics-file"]:
+        writer = threading.Thread(target=write_metrics,
+                                  args=(config["metrics-file"], int(config["metrics-interval"])))
+        writer.daemon = True
+        writer.start()
+    try:
+        engine.serve_forever()
+    finally:
+        engine.close()
+        daemon.flush_submissions()
+        if family == socket.AF_UNIX and os.path.exists(address):
+            os.unlink(address)
+
+
+def proxy_to_daemon(sock, input, output):
+    """Forward the session between stdin/stdout and a running master"""
+    sock.sendall("_peer %s\n" % get_peer_name())
+    input_fd = input.fileno()
+    output_fd = output.fileno()
+    readers = [input_fd, sock]
+    while sock in readers:
+        for r in select.select(readers, [], [])[0]:
+            if r is sock:
+                data = sock.recv(65536)
+                if not data:
+                    readers.remove(sock)
+                    break
+                while data:
+                    data = data[os.write(output_fd, data):]
+            else:
+                data = os.read(input_fd, 65536)
+                if data:
+                    sock.sendall(data)
+                else:
+                    readers.remove(input_fd)
+                    sock.shutdown(socket.SHUT_WR)
+    sock.close()
+
 
 def main():
     setup_logging(logging.INFO, None)
@@ -419,6 +1114,20 @@ def main():
 
     os.chdir(master_directory)
 
+    if "--daemon" in sys.argv[1:]:
+        if not global_config["master-socket"]:
+            sys.exit("master-socket is not configured in %s" % CONFIG_FILE)
+        run_daemon(global_config)
+        return
+
+    if global_config["master-socket"]:
+        sock = connect_to_daemon(global_config["master-socket"])
+        if sock is not None:
+            proxy_to_daemon(sock, sys.stdin, sys.stdout)
+            return
+        logging.info("piuparts-master is not running on %s, serving this session"
+                     % global_config["master-socket"])
+
     m = Master(sys.stdin, sys.stdout)
     try:
         while m.do_transaction():
@@ -426,6 +1135,7 @@ def main():
     except URLError as e:
         logging.error("ABORT: URLError: " + str(e.reason))
 
+    m.close()
     logging.debug(timestamp() + " disconnected")
 
 if __name__ == "__main__":
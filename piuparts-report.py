@@ -515,6 +515,8 @@ class Config(piupartslib.conf.Config):
                 "depends-sections": None,
                 "description": "",
                 "proxy": None,
+                "packages-cache-directory": None,
+                "log-index": None,
                 "mirror": None,
                 "distro": None,
                 "area": None,
@@ -531,6 +533,31 @@ class Config(piupartslib.conf.Config):
             defaults_section=defaults_section)
 
 
+def get_packages_cache(config):
+    if config["packages-cache-directory"]:
+        return piupartslib.packagescache.PackagesCache(config["packages-cache-directory"])
+    return None
+
+
+log_indexes = {}
+
+
+def get_log_index(config):
+    if not config["log-index"]:
+        return None
+    filename = os.path.abspath(os.path.join(config["master-directory"], config["log-index"]))
+    if filename not in log_indexes:
+        log_indexes[filename] = piupartslib.logindex.LogIndex(filename)
+    return log_indexes[filename]
+
+
+def get_logdb(config):
+    log_index = get_log_index(config)
+    if log_index is None:
+        return None
+    return piupartslib.packagesdb.IndexedLogDB(log_index)
+
+
 def setup_logging(log_level, log_file_name):
     logger = logging.getLogger()
     logger.setLevel(log_level)
@@ -819,6 +846,8 @@ class Section:
             os.makedirs(self._section_directory)
 
         self._doc_root = doc_root
+        self._log_index = get_log_index(self._config)
+        self._logs_to_archive = []
 
         logging.debug("Loading and parsing Packages file")
         self._packagedb_cache = packagedb_cache
@@ -826,7 +855,8 @@ class Section:
         self._load_package_database(section, master_directory)
         self._binary_db = self._package_databases[section]
 
-        self._source_db = piupartslib.packagesdb.PackagesDB(prefix=self._section_directory)
+        self._source_db = piupartslib.packagesdb.PackagesDB(prefix=self._section_directory,
+                packages_cache=get_packages_cache(self._config))
         self._source_db.load_packages_urls(
             self._distro_config.get_sources_urls(
                 self._config.get_distro(),
@@ -855,7 +885,8 @@ class Section:
             # only cache the most recent base database
             self._packagedb_cache.clear()
         sectiondir = os.path.join(master_directory, section)
-        db = piupartslib.packagesdb.PackagesDB(prefix=sectiondir)
+        db = piupartslib.packagesdb.PackagesDB(logdb=get_logdb(config), prefix=sectiondir,
+                packages_cache=get_packages_cache(config))
         self._package_databases[section] = db
         if config["depends-sections"]:
             deps = config["depends-sections"].split()
@@ -1521,13 +1552,25 @@ class Section:
                     })
 
     def archive_logfile(self, vdir, log):
-        archivedir = os.path.join("archive", vdir)
-        if not os.path.exists(archivedir):
-            os.makedirs(archivedir)
-        try:
-            os.rename(os.path.join(vdir, log), os.path.join("archive", vdir, log))
-        except OSError:
-            logging.debug("OSError while archiving %s/%s" % (vdir, log))
+        """Schedule a logfile to be moved to the archive by
+           archive_logfiles(), the report no longer lists it"""
+        self._logs_to_archive.append((vdir, log))
+
+    def archive_logfiles(self):
+        """Move the logfiles of obsolete packages to the archive, needs the
+           master.lock of the section exclusively"""
+        for (vdir, log) in self._logs_to_archive:
+            archivedir = os.path.join(self._section_directory, "archive", vdir)
+            if not os.path.exists(archivedir):
+                os.makedirs(archivedir)
+            try:
+                os.rename(os.path.join(self._section_directory, vdir, log),
+                          os.path.join(archivedir, log))
+            except OSError:
+                logging.debug("OSError while archiving %s/%s" % (vdir, log))
+            if self._log_index is not None:
+                self._log_index.remove(os.path.join(vdir, log))
+        self._logs_to_archive = []
 
     def cleanup_removed_packages(self, logs_by_dir):
         vdirs = logs_by_dir.keys()
@@ -1566,9 +1609,12 @@ class Section:
         dirs = ["pass", "fail", "bugged", "affected", "reserved", "untestable"]
         logs_by_dir = {}
         for vdir in dirs:
-            logs_by_dir[vdir] = find_files_with_suffix(vdir, ".log")
+            if self._log_index is not None:
+                logs_by_dir[vdir] = [x[0] for x in self._log_index.list_dir(vdir)]
+            else:
+                logs_by_dir[vdir] = find_files_with_suffix(vdir, ".log")
 
-        logging.debug("Archiving logs of obsolete packages")
+        logging.debug("Finding logs of obsolete packages")
         self.cleanup_removed_packages(logs_by_dir)
 
         logging.debug("Copying log files")
@@ -1840,13 +1886,25 @@ def main():
                 if not os.path.exists(section_directory):
                     raise MissingSection("", section_name)
                 with open(os.path.join(section_directory, "master.lock"), "we") as lock:
+                    # a shared lock, the master may still answer the
+                    # read-only queries of the slaves and journal their logs
                     try:
-                        fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                        fcntl.flock(lock, fcntl.LOCK_SH | fcntl.LOCK_NB)
                     except IOError:
                         raise Busy()
 
                     section = Section(section_name, master_directory, doc_root, packagedb_cache=packagedb_cache)
                     section.generate_output(output_directory, section_names, problem_list, web_host)
+
+                    # moving logfiles needs the lock exclusively, if a
+                    # master took it meanwhile, they are archived next time
+                    try:
+                        fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    except IOError:
+                        logging.info("Section is busy, not archiving logs")
+                    else:
+                        logging.debug("Archiving logs of obsolete packages")
+                        section.archive_logfiles()
             except Busy:
                 logging.info("Section is busy")
                 todo.append((section_name, time.time() + 300))
@@ -29,24 +29,30 @@ import sys
 import stat
 import time
 import logging
-from signal import alarm, signal, SIGALRM, SIGINT, SIGKILL, SIGHUP, SIGUSR1
+from signal import signal, SIGINT, SIGKILL, SIGHUP, SIGUSR1
 import subprocess
 import fcntl
 import random
-import apt_pkg
 import pipes
+import hashlib
+import tempfile
+import threading
+import zlib
 
 import piupartslib.conf
 import piupartslib.packagesdb
+import piupartslib.packagescache
+from piupartslib.versions import version_compare
 from piupartslib.conf import MissingSection
 
-apt_pkg.init_system()
-
 
 CONFIG_FILE = "/etc/piuparts/piuparts.conf"
 DISTRO_CONFIG_FILE = "/etc/piuparts/distros.conf"
 MAX_WAIT_TEST_RUN = 90 * 60
 
+# the highest protocol version understood by this slave, see "hello"
+PROTOCOL_VERSION = 5
+
 interrupted = False
 old_sigint_handler = None
 got_sighup = False
@@ -83,6 +89,7 @@ class Config(piupartslib.conf.Config):
                                          "master-host": None,
                                          "master-user": None,
                                          "master-command": None,
+                                         "master-control-persist": 0,
                                          "proxy": None,
                                          "mirror": None,
                                          "setarch": None,
@@ -104,18 +111,14 @@ class Config(piupartslib.conf.Config):
                                          "precedence": "1",
                                          "slave-load-max": None,
                                          "slave-flush-interval": 0,
+                                         "max-concurrent-tests": 1,
+                                         "log-upload-interval": 0,
+                                         "reserve-low-water": 0,
+                                         "packages-cache-directory": None,
                                          },
                                          defaults_section=defaults_section)
 
 
-class Alarm(Exception):
-    pass
-
-
-def alarm_handler(signum, frame):
-    raise Alarm
-
-
 def sigint_handler(signum, frame):
     global interrupted
     interrupted = True
@@ -182,7 +185,10 @@ class Slave:
         self._master_host = None
         self._master_user = None
         self._master_command = None
+        self._control_persist = 0
         self._section = None
+        self._protocol_version = 1
+        self._try_hello = True
 
     def _readline(self):
         try:
@@ -192,6 +198,19 @@ class Slave:
         logging.debug("<< " + line.rstrip())
         return line
 
+    def _read_long_part(self):
+        lines = []
+        while True:
+            line = self._readline()
+            if not line:
+                raise MasterCommunicationFailed()
+            if line == ".\n":
+                break
+            if line[0] != " ":
+                raise MasterIsCrazy()
+            lines.append(line[1:].rstrip("\n"))
+        return lines
+
     def _writeline(self, *words):
         line = " ".join(words)
         logging.debug(">> " + line)
@@ -201,23 +220,40 @@ class Slave:
         except IOError:
             raise MasterCommunicationFailed()
 
+    def _write_data(self, data):
+        try:
+            self._to_master.write(data)
+            self._to_master.flush()
+        except IOError:
+            raise MasterCommunicationFailed()
+
     def set_master_host(self, host):
         logging.debug("Setting master host to %s" % host)
         if self._master_host != host:
             self.close()
             self._master_host = host
+            self._try_hello = True
 
     def set_master_user(self, user):
         logging.debug("Setting master user to %s" % user)
         if self._master_user != user:
             self.close()
             self._master_user = user
+            self._try_hello = True
 
     def set_master_command(self, cmd):
         logging.debug("Setting master command to %s" % cmd)
         if self._master_command != cmd:
             self.close()
             self._master_command = cmd
+            self._try_hello = True
+
+    def set_master_control_persist(self, seconds):
+        """Keep an ssh master connection open for seconds after the last
+           session, later sessions are multiplexed over it (0 disables)"""
+        if self._control_persist != seconds:
+            self.close()
+            self._control_persist = seconds
 
     def set_section(self, section):
         logging.debug("Setting section to %s" % section)
@@ -234,6 +270,11 @@ class Slave:
     def _initial_connect(self):
         logging.info("Connecting to %s" % self._master_host)
         ssh_command = ["ssh", "-x"]
+        if self._control_persist > 0:
+            # %d is the home directory and %C a hash of user, host and port
+            ssh_command.extend(["-o", "ControlMaster=auto",
+                                "-o", "ControlPath=%d/.ssh/piuparts-slave-%C",
+                                "-o", "ControlPersist=%d" % self._control_persist])
         if self._master_user:
             ssh_command.extend(["-l", self._master_user])
         ssh_command.append(self._master_host)
@@ -244,6 +285,33 @@ class Slave:
         line = self._readline()
         if line != "hello\n":
             raise MasterDidNotGreet()
+        self._protocol_version = 1
+        if self._try_hello:
+            self._negotiate_protocol()
+
+    def _negotiate_protocol(self):
+        self._writeline("hello", "%d" % PROTOCOL_VERSION)
+        line = self._readline()
+        words = line.split()
+        if not line:
+            # an old master closes the connection on unknown commands
+            logging.info("Master does not support protocol version %d, reconnecting" % PROTOCOL_VERSION)
+            self.close()
+            self._try_hello = False
+            self._initial_connect()
+        elif len(words) == 2 and words[0] == "ok" and words[1].isdigit():
+            self._protocol_version = int(words[1])
+            logging.debug("Using protocol version %d" % self._protocol_version)
+        else:
+            raise MasterIsCrazy()
+
+    def _read_response(self):
+        """Read a response line, since protocol version 5 the master may
+           answer "busy" if another process holds the section's lock"""
+        line = self._readline()
+        if line == "busy\n":
+            raise MasterIsBusy()
+        return line
 
     def _select_section(self):
         self._writeline("section", self._section)
@@ -265,25 +333,35 @@ class Slave:
         self._from_master = self._to_master = None
         logging.info("Connection to master closed")
 
-    def send_log(self, section, pass_or_fail, filename):
-        logging.info("Sending log file %s/%s" % (section, filename))
+    def _log_name_to_package(self, filename):
         basename = os.path.basename(filename)
         package, rest = basename.split("_", 1)
         version = rest[:-len(".log")]
-        self._writeline(pass_or_fail, package, version)
+        return (package, version)
+
+    def send_log(self, section, pass_or_fail, filename):
+        logging.info("Sending log file %s/%s" % (section, filename))
+        package, version = self._log_name_to_package(filename)
         with open(filename, "r") as f:
-            for line in f:
-                if line.endswith("\n"):
-                    line = line[:-1]
-                self._writeline(" " + line)
-        self._writeline(".")
+            log = f.read()
+        if self._protocol_version >= 3:
+            data = zlib.compress(log)
+            self._writeline(pass_or_fail, package, version, "zlib",
+                            "%d" % len(data), hashlib.sha256(log).hexdigest())
+            self._write_data(data)
+        else:
+            self._writeline(pass_or_fail, package, version)
+            lines = log.split("\n")
+            if lines[-1] == "":
+                lines.pop()
+            self._write_data("".join([" " + line + "\n" for line in lines]) + ".\n")
         line = self._readline()
         if line != "ok\n":
             raise MasterNotOK()
 
     def get_status(self, section):
         self._writeline("status")
-        line = self._readline()
+        line = self._read_response()
         words = line.split()
         if words and words[0] == "ok":
             logging.info("Master " + section + " status: " + " ".join(words[1:]))
@@ -292,14 +370,14 @@ class Slave:
 
     def enable_recycling(self):
         self._writeline("recycle")
-        line = self._readline()
+        line = self._read_response()
         words = line.split()
         if line != "ok\n":
             raise MasterCantRecycle()
 
     def get_idle(self):
         self._writeline("idle")
-        line = self._readline()
+        line = self._read_response()
         words = line.split()
         if words and words[0] == "ok" and len(words) == 2:
             return int(words[1])
@@ -308,7 +386,7 @@ class Slave:
 
     def reserve(self):
         self._writeline("reserve")
-        line = self._readline()
+        line = self._read_response()
         words = line.split()
         if words and words[0] == "ok":
             logging.info("Reserved for us: %s %s" % (words[1], words[2]))
@@ -320,16 +398,75 @@ class Slave:
         else:
             raise MasterIsCrazy()
 
+    def reserve_many(self, count):
+        """Reserve up to count packages, returns the number of packages reserved"""
+        if self._protocol_version < 2:
+            reserved = 0
+            while reserved < count and self.reserve():
+                reserved += 1
+            return reserved
+        self._writeline("reserve", "%d" % count)
+        line = self._read_response()
+        if line == "ok\n":
+            packages = [line.split() for line in self._read_long_part()]
+            for words in packages:
+                if len(words) != 2:
+                    raise MasterIsCrazy()
+                logging.info("Reserved for us: %s %s" % (words[0], words[1]))
+                self.remember_reservation(words[0], words[1])
+            return len(packages)
+        elif line == "error\n":
+            logging.info("Master didn't reserve anything (more) for us")
+            return 0
+        else:
+            raise MasterIsCrazy()
+
     def unreserve(self, filename):
-        basename = os.path.basename(filename)
-        package, rest = basename.split("_", 1)
-        version = rest[:-len(".log")]
+        package, version = self._log_name_to_package(filename)
         logging.info("Unreserve: %s %s" % (package, version))
         self._writeline("unreserve", package, version)
-        line = self._readline()
+        line = self._read_response()
+        if line != "ok\n":
+            raise MasterNotOK()
+
+    def unreserve_many(self, filenames):
+        if self._protocol_version < 2:
+            for filename in filenames:
+                self.unreserve(filename)
+            return
+        self._writeline("unreserve")
+        for filename in filenames:
+            package, version = self._log_name_to_package(filename)
+            logging.info("Unreserve: %s %s" % (package, version))
+            self._writeline(" " + package, version)
+        self._writeline(".")
+        line = self._read_response()
         if line != "ok\n":
             raise MasterNotOK()
 
+    def renew_reservations(self):
+        """Renew the leases of all our reservations and forget those the
+           master has expired, returns the lease time (or None if not
+           supported by the master)"""
+        if self._protocol_version < 4:
+            return None
+        self._writeline("renew")
+        for name, version in self.get_reserved():
+            self._writeline(" " + name, version)
+        self._writeline(".")
+        line = self._read_response()
+        words = line.split()
+        if len(words) != 2 or words[0] != "ok" or not words[1].isdigit():
+            raise MasterIsCrazy()
+        lease_time = int(words[1])
+        for line in self._read_long_part():
+            words = line.split()
+            if len(words) != 2:
+                raise MasterIsCrazy()
+            logging.info("Reservation expired: %s %s" % (words[0], words[1]))
+            self.forget_reserved(words[0], words[1])
+        return lease_time
+
     def _reserved_filename(self, name, version):
         return os.path.join("reserved", "%s_%s.log" % (name, version))
 
@@ -351,9 +488,89 @@ class Slave:
             pass
 
 
+class LogUploader(threading.Thread):
+
+    """Submit the finished logs of a section in the background
+
+    The uploader uses its own connection to the master and holds lock
+    while sending logs, the section holds it while flushing logs itself.
+    Failed uploads are retried with an increasing delay.
+    """
+
+    _max_backoff = 900
+
+    def __init__(self, section, directory, interval, lock):
+        threading.Thread.__init__(self, name="log-uploader-%s" % section)
+        self.daemon = True
+        self._section = section
+        self._directory = directory
+        self._interval = interval
+        self._lock = lock
+        self._slave = Slave()
+        self._slave.set_section(section)
+        self._master = (None, None, None, 0)
+        self._wakeup = threading.Event()
+        self._backoff = 0
+        self._retry_at = 0
+
+    def configure(self, config):
+        """Use the master settings (which may change) of the section"""
+        with self._lock:
+            self._master = (config["master-host"], config["master-user"],
+                            config["master-command"], int(config["master-control-persist"]))
+            self._interval = int(config["log-upload-interval"])
+
+    def wakeup(self):
+        """Upload now, e.g. because a test finished"""
+        self._wakeup.set()
+
+    def run(self):
+        while True:
+            self._wakeup.wait(max(self._interval, 1))
+            self._wakeup.clear()
+            if time.time() < self._retry_at:
+                continue
+            with self._lock:
+                try:
+                    self._upload()
+                except (MasterDidNotGreet, MasterIsCrazy, MasterCommunicationFailed,
+                        MasterNotOK, MasterIsBusy):
+                    self._failed("log upload to master failed")
+                except Exception:
+                    logging.exception("log upload to master failed")
+                    self._failed("log upload to master failed")
+                else:
+                    self._backoff = 0
+                finally:
+                    self._slave.close()
+
+    def _failed(self, msg):
+        self._backoff = min(max(60, 2 * self._backoff), self._max_backoff)
+        self._retry_at = time.time() + self._backoff
+        logging.error("%s, retrying in %d seconds" % (msg, self._backoff))
+
+    def _upload(self):
+        logs = []
+        for logdir in ["pass", "fail", "untestable"]:
+            for basename in os.listdir(os.path.join(self._directory, logdir)):
+                if basename.endswith(".log"):
+                    logs.append((logdir, os.path.join(self._directory, logdir, basename)))
+        if not logs:
+            return
+        (host, user, command, control_persist) = self._master
+        self._slave.set_master_host(host)
+        self._slave.set_master_user(user)
+        self._slave.set_master_command(command)
+        self._slave.set_master_control_persist(control_persist)
+        self._slave.connect_to_master()
+        for (logdir, fullname) in logs:
+            self._slave.send_log(self._section, logdir, fullname)
+            os.remove(fullname)
+
+
 class Section:
 
-    def __init__(self, section, slave=None):
+    def __init__(self, section, slave=None, packages_cache=None):
         self._config = Config(section=section, defaults_section="global")
         self._config.read(CONFIG_FILE)
         self._distro_config = piupartslib.conf.DistroConfig(
@@ -362,6 +579,12 @@ class Section:
         self._idle_wait_until = 0
         self._recycle_wait_until = 0
         self._tarball_wait_until = 0
+        self._lease_renew_at = None
+        self._upload_lock = threading.Lock()
+        self._uploader = None
+        self._prefetched = (set(), None)
+        self._refchroot_metadata_stale = False
+        self._packages_cache = packages_cache
         self._slave_directory = os.path.abspath(section)
         if not os.path.exists(self._slave_directory):
             os.makedirs(self._slave_directory)
@@ -380,17 +603,21 @@ class Section:
         if int(self._config["max-reserved"]) > 0:
             self._check_tarball()
 
+    def _is_overloaded(self):
+        if self._config["slave-load-max"] is None:
+            return False
+        load_max = float(self._config["slave-load-max"])
+        if load_max < 1.0:
+            return False
+        return os.getloadavg()[0] > load_max
+
     def _throttle_if_overloaded(self):
         global interrupted
         if interrupted or got_sighup:
             return
-        if self._config["slave-load-max"] is None:
+        if not self._is_overloaded():
             return
         load_max = float(self._config["slave-load-max"])
-        if load_max < 1.0:
-            return
-        if os.getloadavg()[0] <= load_max:
-            return
         load_resume = max(load_max - 1.0, 0.9)
         secs = random.randrange(30, 90)
         self._slave.close()
@@ -408,10 +635,23 @@ class Section:
             if secs < 300:
                 secs += random.randrange(30, 90)
 
+    def _start_uploader(self):
+        if self._uploader is None:
+            if int(self._config["log-upload-interval"]) <= 0:
+                return
+            self._uploader = LogUploader(self._config.section, self._slave_directory,
+                                         int(self._config["log-upload-interval"]),
+                                         self._upload_lock)
+            self._uploader.configure(self._config)
+            self._uploader.start()
+        else:
+            self._uploader.configure(self._config)
+
     def _connect_to_master(self, recycle=False):
         self._slave.set_master_host(self._config["master-host"])
         self._slave.set_master_user(self._config["master-user"])
         self._slave.set_master_command(self._config["master-command"])
+        self._slave.set_master_control_persist(int(self._config["master-control-persist"]))
         self._slave.set_section(self._config.section)
         self._slave.connect_to_master()
         if recycle:
@@ -471,16 +711,35 @@ class Section:
         return None
 
     def _check_refchroot_metadata(self):
+        """Remove an old or outdated refchroot metadata file, must only be
+           called while no tests are running"""
         refchroot_metadata = self._get_refchroot_metadata()
         if refchroot_metadata:
             if os.path.exists(refchroot_metadata):
                 try:
                     age = time.time() - os.path.getmtime(refchroot_metadata)
-                    if age > 6 * 3600:
+                    if self._refchroot_metadata_stale:
+                        os.unlink(refchroot_metadata)
+                        logging.info("Deleting outdated %s" % refchroot_metadata)
+                    elif age > 6 * 3600:
                         os.unlink(refchroot_metadata)
                         logging.info("Deleting old %s" % refchroot_metadata)
                 except OSError:
                     pass
+        self._refchroot_metadata_stale = False
+
+    def _may_start_concurrent_test(self, running):
+        """Tests may only run concurrently to others if they don't create
+           the refchroot metadata (-S) and it already exists for them (-B)"""
+        if not running:
+            return True
+        if len(self._config.get_distros()) > 1 and self._config["chroot-meta-auto"]:
+            if [test for test in running if test.saves_refchroot_metadata]:
+                return False
+            if self._refchroot_metadata_stale:
+                return False
+            return os.path.exists(self._get_refchroot_metadata())
+        return True
 
     def _count_submittable_logs(self):
         files = 0
@@ -516,6 +775,7 @@ class Section:
             return 0
         self._distro_config = piupartslib.conf.DistroConfig(
                 DISTRO_CONFIG_FILE, self._config["mirror"])
+        self._start_uploader()
 
         if interrupted or got_sighup:
             do_processing = False
@@ -572,7 +832,7 @@ class Section:
                             if recycle:
                                 self._recycle_wait_until = self._idle_wait_until + 3600
                 if do_processing and self._slave.get_reserved():
-                            processed = self._process()
+                            processed = self._process(recycle=recycle)
                             if got_sighup and self._slave.get_reserved():
                                 # keep this section at the front of the round-robin runnable queue
                                 self._idle_wait_until = 0
@@ -586,10 +846,11 @@ class Section:
                 os.chdir(oldcwd)
         return 0
 
-    def _talk_to_master(self, fetch=False, unreserve=False, recycle=False):
+    def _talk_to_master(self, fetch=False, unreserve=False, recycle=False, renew=False):
         flush = self._count_submittable_logs() > 0
         fetch = fetch and not self._slave.get_reserved()
-        if not flush and not fetch:
+        renew = renew and not unreserve and self._slave.get_reserved()
+        if not flush and not fetch and not renew:
             return True
 
         try:
@@ -608,20 +869,24 @@ class Section:
             self._slave.close()
         else:
             try:
-                for logdir in ["pass", "fail", "untestable"]:
-                    for basename in os.listdir(logdir):
-                        if basename.endswith(".log"):
-                            fullname = os.path.join(logdir, basename)
-                            self._slave.send_log(self._config.section, logdir, fullname)
-                            os.remove(fullname)
+                with self._upload_lock:
+                    for logdir in ["pass", "fail", "untestable"]:
+                        for basename in os.listdir(logdir):
+                            if basename.endswith(".log"):
+                                fullname = os.path.join(logdir, basename)
+                                self._slave.send_log(self._config.section, logdir, fullname)
+                                os.remove(fullname)
 
                 if unreserve:
+                    fullnames = []
                     for logdir in ["new", "reserved"]:
                         for basename in os.listdir(logdir):
                             if basename.endswith(".log"):
-                                fullname = os.path.join(logdir, basename)
-                                self._slave.unreserve(fullname)
-                                os.remove(fullname)
+                                fullnames.append(os.path.join(logdir, basename))
+                    if fullnames:
+                        self._slave.unreserve_many(fullnames)
+                        for fullname in fullnames:
+                            os.remove(fullname)
 
                 if fetch:
                     max_reserved = int(self._config["max-reserved"])
@@ -634,9 +899,16 @@ class Section:
                         else:
                             self._recycle_wait_until = time.time() + idle
                         return 0
-                    while len(self._slave.get_reserved()) < max_reserved and self._slave.reserve():
-                        pass
+                    count = max_reserved - len(self._slave.get_reserved())
+                    if count > 0:
+                        self._slave.reserve_many(count)
                     self._slave.get_status(self._config.section)
+
+                if not unreserve and self._slave.get_reserved():
+                    self._renew_leases()
+            except MasterIsBusy:
+                logging.error("master is busy")
+                self._error_wait_until = time.time() + random.randrange(60, 180)
             except MasterNotOK:
                 logging.error("master did not respond with 'ok'")
                 self._error_wait_until = time.time() + 900
@@ -649,16 +921,22 @@ class Section:
                 return True
         return False
 
-    def _process(self):
-        global interrupted
-        last_flush = time.time()
+    def _renew_leases(self):
+        lease_time = self._slave.renew_reservations()
+        if lease_time:
+            self._lease_renew_at = time.time() + lease_time / 3
+        else:
+            self._lease_renew_at = None
 
-        packagenames = set([x[0] for x in self._slave.get_reserved()])
+    def _load_packages_files(self, packagenames):
+        """Return the Packages files (restricted to packagenames) of all
+           distros of the section, None if fetching one failed"""
+        global interrupted
         packages_files = {}
         for distro in [self._config.get_distro()] + self._config.get_distros():
             if distro not in packages_files:
                 try:
-                    pf = piupartslib.packagesdb.PackagesFile()
+                    pf = piupartslib.packagesdb.PackagesFile(cache=self._packages_cache)
                     pf.load_packages_urls(
                         self._distro_config.get_packages_urls(
                             distro,
@@ -668,38 +946,127 @@ class Section:
                     packages_files[distro] = pf
                 except IOError:
                     logging.error("failed to fetch packages file for %s" % distro)
-                    self._error_wait_until = time.time() + 900
-                    return 0
+                    return None
                 except KeyboardInterrupt:
                     interrupted = True
-        del packagenames
+        return packages_files
+
+    def _prefetch(self, recycle):
+        """Reserve the next batch of packages and fetch their Packages files
+           while the tests of the current batch are running"""
+        reserved = self._slave.get_reserved()
+        count = int(self._config["max-reserved"]) - len(reserved)
+        if count <= 0:
+            return
+        try:
+            self._connect_to_master(recycle=recycle)
+            idle = self._slave.get_idle()
+            if idle > 0:
+                logging.info("idle (%d), not prefetching" % idle)
+                return
+            self._slave.reserve_many(count)
+        except KeyboardInterrupt:
+            raise
+        except (MasterIsBusy, MasterCantRecycle, MasterDidNotGreet, MasterIsCrazy,
+                MasterCommunicationFailed, MasterNotOK):
+            logging.error("prefetching reservations failed")
+            self._slave.close()
+            return
+        prefetched = set(self._slave.get_reserved()) - set(reserved)
+        if prefetched:
+            packages_files = self._load_packages_files(set([x[0] for x in prefetched]))
+            if packages_files is not None:
+                logging.info("Prefetched %d packages" % len(prefetched))
+                self._prefetched = (prefetched, packages_files)
+
+    def _process(self, recycle=False):
+        global interrupted
+        last_flush = time.time()
+
+        reserved = self._slave.get_reserved()
+        (prefetched, packages_files) = self._prefetched
+        self._prefetched = (set(), None)
+        if not set(reserved) <= prefetched:
+            packages_files = self._load_packages_files(set([x[0] for x in reserved]))
+            if packages_files is None:
+                self._error_wait_until = time.time() + 900
+                return 0
 
         test_count = 0
         self._check_tarball()
         if not os.path.exists(self._get_tarball()):
             self._error_wait_until = time.time() + 300
         self._check_refchroot_metadata()
-        for package_name, version in self._slave.get_reserved():
-            self._throttle_if_overloaded()
-            if interrupted or got_sighup:
-                break
-            if int(self._config["slave-flush-interval"]):
-                if time.time() - last_flush > int(self._config["slave-flush-interval"]):
-                    last_flush += 300   # throttle retries
-                    if self._talk_to_master():
-                        last_flush = time.time()
-            if not os.path.exists(self._get_tarball()):
-                logging.error("Missing chroot-tgz %s" % self._get_tarball())
-                break
-            test_count += 1
-            self._test_package(package_name, version, packages_files)
-            self._slave.forget_reserved(package_name, version)
-        self._talk_to_master(unreserve=interrupted)
-        return test_count
 
-    def _test_package(self, pname, pvers, packages_files):
         global old_sigint_handler
         old_sigint_handler = signal(SIGINT, sigint_handler)
+        max_tests = max(1, int(self._config["max-concurrent-tests"]))
+        low_water = int(self._config["reserve-low-water"])
+        prefetch = low_water > 0
+        queue = reserved
+        running = []
+        try:
+            while queue or running:
+                for test in running[:]:
+                    result = test.poll()
+                    if result is not None:
+                        running.remove(test)
+                        self._finish_test(test, *result)
+                if interrupted or got_sighup:
+                    queue = []
+                elif prefetch and running and len(queue) < low_water:
+                    # the next batch is tested in the next run, keeping the
+                    # sections round-robin
+                    prefetch = False
+                    self._prefetch(recycle)
+                if not queue or len(running) >= max_tests or \
+                        (running and self._is_overloaded()) or \
+                        not self._may_start_concurrent_test(running):
+                    if running:
+                        time.sleep(1)
+                    continue
+                if not running:
+                    if self._refchroot_metadata_stale:
+                        self._check_refchroot_metadata()
+                    self._throttle_if_overloaded()
+                    if interrupted or got_sighup:
+                        continue
+                if int(self._config["slave-flush-interval"]):
+                    if time.time() - last_flush > int(self._config["slave-flush-interval"]):
+                        last_flush += 300   # throttle retries
+                        if self._talk_to_master():
+                            last_flush = time.time()
+                if self._lease_renew_at is not None and time.time() > self._lease_renew_at:
+                    self._lease_renew_at += 300   # throttle retries
+                    self._talk_to_master(renew=True)
+                (package_name, version) = queue.pop(0)
+                if (package_name, version) not in self._slave.get_reserved():
+                    # the reservation expired
+                    continue
+                if not os.path.exists(self._get_tarball()):
+                    logging.error("Missing chroot-tgz %s" % self._get_tarball())
+                    queue = []
+                    continue
+                test_count += 1
+                test = self._start_test(package_name, version, packages_files)
+                if test is not None:
+                    running.append(test)
+        except KeyboardInterrupt:
+            print('\nSlave interrupted by the user, cleaning up...')
+            try:
+                for test in running:
+                    test.terminate()
+            except KeyboardInterrupt:
+                print('\nTerminating piuparts was interrupted... manual cleanup still neccessary.')
+            raise
+        finally:
+            signal(SIGINT, old_sigint_handler)
+        self._talk_to_master(unreserve=interrupted)
+        return test_count
+
+    def _start_test(self, pname, pvers, packages_files):
+        """Start testing a package, returns the TestRun or None if the test
+           already finished (because the package is untestable)"""
         self._slave.close()
 
         logging.info("Testing package %s/%s %s" % (self._config.section, pname, pvers))
@@ -739,15 +1106,16 @@ class Section:
                 command.extend(["-d", distro])
         if self._config["keep-sources-list"] in ["yes", "true"]:
             command.append("--keep-sources-list")
+        saves_refchroot_metadata = False
         if distupgrade and self._config["chroot-meta-auto"]:
             refchroot_metadata = self._get_refchroot_metadata()
             if not os.path.exists(refchroot_metadata):
                 command.extend(["-S", refchroot_metadata])
+                saves_refchroot_metadata = True
             else:
                 command.extend(["-B", refchroot_metadata])
         command.extend(["--apt", "%s=%s" % (pname, pvers)])
 
-        subdir = "fail"
         ret = 0
 
         if not distupgrade:
@@ -800,18 +1168,34 @@ class Section:
                     for distro in distros:
                         if pname in packages_files[distro]:
                             v = packages_files[distro][pname]["Version"]
-                            if not apt_pkg.version_compare(prev, v) <= 0:
+                            if not version_compare(prev, v) <= 0:
                                 output.write("Upgrade to %s requires downgrade: %s > %s\n" % (distro, prev, v))
                                 ret = -10006
                             prev = v
             else:
                 ret = -10010
+        test = TestRun(pname, pvers, output, distupgrade)
+        test.saves_refchroot_metadata = saves_refchroot_metadata
         if ret != 0:
-            subdir = "untestable"
+            self._finish_test(test, ret)
+            return None
+
+        output.write("Executing: %s\n" % command2string(command))
+        test.start(command, MAX_WAIT_TEST_RUN)
+        return test
+
+    def _finish_test(self, test, ret, f=None):
+        """Complete the log of a test and move it to pass/, fail/ or
+           untestable/, f is the output of piuparts (if it was run)"""
+        output = test.output
+        output_name = log_name(test.pname, test.pvers)
+        new_name = os.path.join("new", output_name)
+        distupgrade = test.distupgrade
 
-        if ret == 0:
-            output.write("Executing: %s\n" % command2string(command))
-            ret, f = run_test_with_timeout(command, MAX_WAIT_TEST_RUN)
+        subdir = "fail"
+        if f is None:
+            subdir = "untestable"
+        else:
             if not f or f[-1] != '\n':
                 f += '\n'
             output.write(f.replace('\033', '[ESC]'))
@@ -822,16 +1206,20 @@ class Section:
                 ret += 1024
                 output.write(" *** PIUPARTS OUTPUT INCOMPLETE ***\n")
             elif distupgrade and self._config["chroot-meta-auto"]:
-                try:
-                    refchroot_metadata = self._get_refchroot_metadata()
-                    if "History of available packages does not match - reference chroot may be outdated" in f:
-                        os.unlink(refchroot_metadata)
-                        logging.info("Deleting outdated %s" % refchroot_metadata)
-                    elif "Initial package selections do not match - ignoring loaded reference chroot state" in f:
-                        os.unlink(refchroot_metadata)
-                        logging.info("Deleting mismatching %s" % refchroot_metadata)
-                except OSError:
-                    pass
+                if "History of available packages does not match - reference chroot may be outdated" in f or \
+                        "Initial package selections do not match - ignoring loaded reference chroot state" in f:
+                    if test.saves_refchroot_metadata:
+                        # no other test was started while this one ran
+                        try:
+                            refchroot_metadata = self._get_refchroot_metadata()
+                            os.unlink(refchroot_metadata)
+                            logging.info("Deleting mismatching %s" % refchroot_metadata)
+                        except OSError:
+                            pass
+                    else:
+                        # other tests may still be reading it, it is
+                        # removed once all of them finished
+                        self._refchroot_metadata_stale = True
 
         output.write("\n")
         output.write("ret=%d\n" % ret)
@@ -842,7 +1230,9 @@ class Section:
             subdir = "pass"
         os.rename(new_name, os.path.join(subdir, output_name))
         logging.debug("Done with %s: %s (%d)" % (output_name, subdir, ret))
-        signal(SIGINT, old_sigint_handler)
+        self._slave.forget_reserved(test.pname, test.pvers)
+        if self._uploader is not None:
+            self._uploader.wakeup()
 
 
 def log_name(package, version):
@@ -854,73 +1244,89 @@ def command2string(command):
     return " ".join([pipes.quote(arg) for arg in command])
 
 
-def run_test_with_timeout(cmd, maxwait, kill_all=True):
-
-    def terminate_subprocess(p, kill_all):
-        pids = [p.pid]
-        if kill_all:
-            ps = subprocess.Popen(["ps", "--no-headers", "-o", "pid", "--ppid", "%d" % p.pid],
-                                  stdout=subprocess.PIPE)
-            stdout, stderr = ps.communicate()
-            pids.extend([int(pid) for pid in stdout.split()])
-        if p.poll() is None:
-            print('Sending SIGINT...')
+def terminate_subprocess(p, kill_all=True):
+    pids = [p.pid]
+    if kill_all:
+        ps = subprocess.Popen(["ps", "--no-headers", "-o", "pid", "--ppid", "%d" % p.pid],
+                              stdout=subprocess.PIPE)
+        stdout, stderr = ps.communicate()
+        pids.extend([int(pid) for pid in stdout.split()])
+    if p.poll() is None:
+        print('Sending SIGINT...')
+        try:
+            os.killpg(os.getpgid(p.pid), SIGINT)
+        except OSError:
+            pass
+        # piuparts has 30 seconds to clean up after Ctrl-C
+        for i in range(60):
+            time.sleep(0.5)
+            if p.poll() is not None:
+                break
+    if p.poll() is None:
+        print('Sending SIGTERM...')
+        p.terminate()
+        # piuparts has 5 seconds to clean up after SIGTERM
+        for i in range(10):
+            time.sleep(0.5)
+            if p.poll() is not None:
+                break
+    if p.poll() is None:
+        print('Sending SIGKILL...')
+        p.kill()
+    for pid in pids:
+        if pid > 0:
             try:
-                os.killpg(os.getpgid(p.pid), SIGINT)
+                os.kill(pid, SIGKILL)
+                print("Killed %d" % pid)
             except OSError:
                 pass
-            # piuparts has 30 seconds to clean up after Ctrl-C
-            for i in range(60):
-                time.sleep(0.5)
-                if p.poll() is not None:
-                    break
-        if p.poll() is None:
-            print('Sending SIGTERM...')
-            p.terminate()
-            # piuparts has 5 seconds to clean up after SIGTERM
-            for i in range(10):
-                time.sleep(0.5)
-                if p.poll() is not None:
-                    break
-        if p.poll() is None:
-            print('Sending SIGKILL...')
-            p.kill()
-        for pid in pids:
-            if pid > 0:
-                try:
-                    os.kill(pid, SIGKILL)
-                    print("Killed %d" % pid)
-                except OSError:
-                    pass
 
-    logging.debug("Executing: %s" % command2string(cmd))
 
-    stdout = ""
-    p = subprocess.Popen(cmd, preexec_fn=os.setpgrp,
-                         stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
-    if maxwait > 0:
-        signal(SIGALRM, alarm_handler)
-        alarm(maxwait)
-    try:
-        stdout, stderr = p.communicate()
-        alarm(0)
-    except Alarm:
-        terminate_subprocess(p, kill_all)
-        return -1, stdout
-    except KeyboardInterrupt:
-        print('\nSlave interrupted by the user, cleaning up...')
-        try:
-            terminate_subprocess(p, kill_all)
-        except KeyboardInterrupt:
-            print('\nTerminating piuparts was interrupted... manual cleanup still neccessary.')
-            raise
-        raise
-
-    ret = p.returncode
-    if ret in [124, 137]:
-        # process was terminated by the timeout command
-        ret = -ret
-    return ret, stdout
+class TestRun:
+
+    """The test of a package, running piuparts in the background
+
+    The output of piuparts is collected in a temporary file, so that
+    several tests may run concurrently without reading their pipes.
+    """
+
+    def __init__(self, pname, pvers, output, distupgrade):
+        self.pname = pname
+        self.pvers = pvers
+        self.output = output
+        self.distupgrade = distupgrade
+        self.saves_refchroot_metadata = False
+        self._process = None
+        self._stdout = None
+        self._deadline = None
+
+    def start(self, cmd, maxwait):
+        logging.debug("Executing: %s" % command2string(cmd))
+        self._stdout = tempfile.TemporaryFile()
+        self._process = subprocess.Popen(cmd, preexec_fn=os.setpgrp,
+                                         stdout=self._stdout, stderr=subprocess.STDOUT)
+        if maxwait > 0:
+            self._deadline = time.time() + maxwait
+
+    def poll(self):
+        """Return (ret, output) once piuparts finished or was killed for
+           exceeding the maximum run time, None while it is running"""
+        ret = self._process.poll()
+        if ret is None:
+            if self._deadline is None or time.time() < self._deadline:
+                return None
+            terminate_subprocess(self._process)
+            ret = -1
+        elif ret in [124, 137]:
+            # process was terminated by the timeout command
+            ret = -ret
+        self._stdout.seek(0)
+        stdout = self._stdout.read()
+        self._stdout.close()
+        return ret, stdout
+
+    def terminate(self):
+        terminate_subprocess(self._process)
 
 
 def create_chroot(config, tarball, distro):
@@ -1001,11 +1407,17 @@ def main():
         section_names = global_config["sections"].split()
         section_names += global_config["basetgz-sections"].split()
 
+    # shared by all sections (and other slaves using the same directory)
+    packages_cache = None
+    if global_config["packages-cache-directory"]:
+        packages_cache = piupartslib.packagescache.PackagesCache(
+            os.path.abspath(global_config["packages-cache-directory"]))
+
     persistent_connection = Slave()
     sections = []
     for section_name in section_names:
         try:
-            sections.append(Section(section_name, persistent_connection))
+            sections.append(Section(section_name, persistent_connection, packages_cache))
         except MissingSection:
             # ignore unknown sections
             pass
@@ -25,11 +25,19 @@ import urllib2
 
 import conf
 import dependencyparser
+import logindex
+import metrics
 import packagesdb
+import packagescache
+import protocolengine
+import submissions
+import versions
 
 
 class DecompressedStream():
 
+    _chunk_size = 1 << 16
+
     def __init__(self, fileobj, decompressor=None):
         self._input = fileobj
         self._decompressor = decompressor
@@ -38,20 +46,27 @@ class DecompressedStream():
         self._i = 0
         self._end = 0
 
-    def _refill(self):
+    def _read_chunk(self):
+        """Return the next non-empty chunk of decompressed data or "" at EOF"""
         if self._input is None:
-            return False
+            return ""
         while True:
             # repeat until decompressor yields some output or input is exhausted
-            chunk = self._input.read(4096)
+            chunk = self._input.read(self._chunk_size)
             if not chunk:
                 self.close()
-                return False
+                return ""
             if self._decompressor:
                 chunk = self._decompressor.decompress(chunk)
-            self._buffer = self._buffer + chunk
             if chunk:
-                return True
+                return chunk
+
+    def _refill(self):
+        chunk = self._read_chunk()
+        if not chunk:
+            return False
+        self._buffer = self._buffer + chunk
+        return True
 
     def readline(self):
         while not self._i < self._end:
@@ -71,14 +86,34 @@ class DecompressedStream():
             return self._line_buffer[self._i - 1]
         return ""
 
+    def read(self, size=-1):
+        """Read decompressed data, do not mix with readline()"""
+        chunks = [self._buffer]
+        length = len(self._buffer)
+        while size < 0 or length < size:
+            chunk = self._read_chunk()
+            if not chunk:
+                break
+            chunks.append(chunk)
+            length += len(chunk)
+        data = "".join(chunks)
+        if size < 0:
+            self._buffer = ""
+            return data
+        self._buffer = data[size:]
+        return data[:size]
+
     def close(self):
         if self._input:
             self._input.close()
         self._input = self._decompressor = None
 
 
-def open_packages_url(url):
-    """Open a Packages.bz2 file pointed to by a URL"""
+def urlopen_packages_url(url):
+    """Open the first available compressed variant of a Packages file
+
+    Returns the extension found and the (still compressed) stream.
+    """
     socket = None
     for ext in ['.xz', '.bz2', '.gz', '']:
         try:
@@ -89,7 +124,10 @@ def open_packages_url(url):
             break
     if socket is None:
         raise httperror
-    url = socket.geturl()
+    return (ext, socket)
+
+
+def decompress_packages_stream(ext, socket):
     if ext == '.bz2':
         decompressor = bz2.BZ2Decompressor()
         decompressed = DecompressedStream(socket, decompressor)
@@ -103,6 +141,12 @@ def open_packages_url(url):
         decompressed = socket
     else:
         raise ext
-    return (url, decompressed)
+    return decompressed
+
+
+def open_packages_url(url):
+    """Open a Packages.bz2 file pointed to by a URL"""
+    (ext, socket) = urlopen_packages_url(url)
+    return (socket.geturl(), decompress_packages_stream(ext, socket))
 
 # vi:set et ts=4 sw=4 :
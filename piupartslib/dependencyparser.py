@@ -185,8 +185,10 @@ class DependencyParser:
     """
 
     def __init__(self, input_string):
-        self._cursor = _Cursor(input_string)
-        self._list = self._parse_dependencies()
+        self._list = self._parse_simple_dependencies(input_string)
+        if self._list is None:
+            self._cursor = _Cursor(input_string)
+            self._list = self._parse_dependencies()
 
     def get_dependencies(self):
         """Return parsed dependencies
@@ -206,6 +208,37 @@ class DependencyParser:
         """
         return self._list
 
+    # a possible-dependency without arch-restriction, for the fast path
+    _simple_pat = re.compile(r"\s*(?P<name>[a-zA-Z0-9][a-zA-Z0-9+._-]+)(:[a-zA-Z0-9-]+)?\s*" +
+                             r"(\(\s*(?P<op><<|<=|=|>=|>>|<(?![<=])|>(?![>=]))\s*" +
+                             r"(?P<version>(\d+:)?[a-zA-Z0-9+][a-zA-Z0-9.+:~-]*(-[a-zA-Z0-9.+]+)?)" +
+                             r"\s*\)\s*)?\Z")
+
+    def _parse_simple_dependencies(self, input_string):
+        """Fast path for the common case without arch restrictions
+
+        Splits the input at commas and vertical bars and matches each
+        possible-dependency with a single regular expression. Returns None
+        if that doesn't succeed, the cursor based parser handles these
+        cases (and reports syntax errors).
+
+        """
+        if "[" in input_string:
+            return None
+        if not input_string.strip():
+            return []
+        vlist = []
+        for dependency in input_string.split(","):
+            alternatives = []
+            for possible_dependency in dependency.split("|"):
+                m = self._simple_pat.match(possible_dependency)
+                if not m:
+                    return None
+                alternatives.append(SimpleDependency(m.group("name"), m.group("op"),
+                                                     m.group("version"), None))
+            vlist.append(alternatives)
+        return vlist
+
     def _parse_dependencies(self):
         vlist = []
         dep = self._parse_dependency()
@@ -0,0 +1,238 @@
+# -*- coding: utf-8 -*-
+
+# This file is part of Piuparts
+#
+# Piuparts is free software; you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation; either version 2 of the License, or (at your
+# option) any later version.
+#
+# Piuparts is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General
+# Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, see <http://www.gnu.org/licenses/>.
+
+
+"""SQLite index of the logfiles of all sections
+
+The index records section, directory (pass, fail, ...), package, version,
+mtime, ctime and size of every logfile in the section directories, so that
+existence checks and listings don't need to scan the directories.
+
+All paths are of the form .../SECTION/DIR/PACKAGE_VERSION.log and may be
+relative to the current directory. A section is (re)built from the
+filesystem the first time it is accessed. Scripts moving or removing
+logfiles record that with update(), rebuild() and verify() take care of
+drift caused by manual file operations.
+"""
+
+
+import os
+import sqlite3
+import time
+
+
+# the directories with logfiles in each section
+LOG_DIRS = ["pass", "fail", "untestable", "reserved", "bugged", "affected", "recycle"]
+
+_schema = [
+    """CREATE TABLE IF NOT EXISTS logs (
+        section TEXT NOT NULL,
+        dir TEXT NOT NULL,
+        package TEXT NOT NULL,
+        version TEXT NOT NULL,
+        mtime INTEGER NOT NULL,
+        ctime INTEGER NOT NULL,
+        size INTEGER NOT NULL,
+        PRIMARY KEY (section, dir, package, version))""",
+    """CREATE INDEX IF NOT EXISTS logs_by_mtime ON logs (section, dir, mtime)""",
+    """CREATE TABLE IF NOT EXISTS sections (
+        section TEXT PRIMARY KEY,
+        built INTEGER NOT NULL)""",
+]
+
+
+def split_log_name(basename):
+    """Return (package, version) of a logfile name or None"""
+    if not basename.endswith(".log") or "_" not in basename:
+        return None
+    return tuple(basename[:-len(".log")].split("_", 1))
+
+
+class LogIndex:
+
+    def __init__(self, filename, timeout=60):
+        # the long-running master uses the index from different threads,
+        # but serializes the accesses
+        self._db = sqlite3.connect(filename, timeout=timeout, check_same_thread=False)
+        self._db.text_factory = str
+        with self._db:
+            for statement in _schema:
+                self._db.execute(statement)
+        self._sections = set()
+
+    def close(self):
+        self._db.close()
+
+    def _section(self, sectiondir):
+        """Return the name of a section, building its index if needed"""
+        section = os.path.basename(os.path.abspath(sectiondir))
+        if section not in self._sections:
+            row = self._db.execute("SELECT built FROM sections WHERE section = ?",
+                                   (section,)).fetchone()
+            if row is None:
+                self.rebuild(sectiondir)
+            self._sections.add(section)
+        return section
+
+    def _split_dir(self, dirname):
+        dirname = os.path.abspath(dirname)
+        return (self._section(os.path.dirname(dirname)), os.path.basename(dirname))
+
+    def _split_path(self, path):
+        """Return (section, dir, package, version) of a logfile or None"""
+        name = split_log_name(os.path.basename(path))
+        if name is None:
+            return None
+        return self._split_dir(os.path.dirname(path)) + name
+
+    def _scan_dir(self, dirname):
+        """Yield (package, version, mtime, ctime, size) of all logfiles"""
+        if not os.path.isdir(dirname):
+            return
+        for basename in os.listdir(dirname):
+            name = split_log_name(basename)
+            if name is None:
+                continue
+            try:
+                st = os.stat(os.path.join(dirname, basename))
+            except OSError:
+                continue
+            yield name + (int(st.st_mtime), int(st.st_ctime), st.st_size)
+
+    def rebuild(self, sectiondir):
+        """Replace the index of a section with the logfiles found on disk"""
+        section = os.path.basename(os.path.abspath(sectiondir))
+        with self._db:
+            self._db.execute("DELETE FROM logs WHERE section = ?", (section,))
+            for subdir in LOG_DIRS:
+                self._db.executemany(
+                    "INSERT OR REPLACE INTO logs VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    [(section, subdir) + x
+                     for x in self._scan_dir(os.path.join(sectiondir, subdir))])
+            self._db.execute("INSERT OR REPLACE INTO sections VALUES (?, ?)",
+                             (section, int(time.time())))
+        self._sections.add(section)
+
+    def rescan_dir(self, dirname):
+        """Replace the index of one directory with the logfiles found on disk"""
+        (section, subdir) = self._split_dir(dirname)
+        with self._db:
+            # the DELETE locks the database before the scan, so that a
+            # concurrent add() of a new logfile is not lost
+            self._db.execute("DELETE FROM logs WHERE section = ? AND dir = ?",
+                             (section, subdir))
+            self._db.executemany(
+                "INSERT OR REPLACE INTO logs VALUES (?, ?, ?, ?, ?, ?, ?)",
+                [(section, subdir) + x for x in self._scan_dir(dirname)])
+
+    def update(self, path):
+        """Bring the index of a logfile or a directory of logfiles in line
+           with the filesystem after it was changed behind our back"""
+        if os.path.isdir(path):
+            self.rescan_dir(path)
+        elif os.path.exists(path):
+            self.add(path)
+        else:
+            self.remove(path)
+
+    def verify(self, sectiondir):
+        """Compare the index of a section with the logfiles found on disk
+
+        Returns a sorted list of (problem, path) tuples, problem being one of
+        "missing" (not in the index), "stale" (no longer on disk) or
+        "changed" (mtime or size differ).
+        """
+        section = self._section(sectiondir)
+        problems = []
+        for subdir in LOG_DIRS:
+            dirname = os.path.join(sectiondir, subdir)
+            indexed = {}
+            for row in self._db.execute("SELECT package, version, mtime, size FROM logs "
+                                        "WHERE section = ? AND dir = ?", (section, subdir)):
+                indexed[row[:2]] = row[2:]
+            for (package, version, mtime, ctime, size) in self._scan_dir(dirname):
+                path = os.path.join(dirname, "%s_%s.log" % (package, version))
+                if (package, version) not in indexed:
+                    problems.append(("missing", path))
+                elif indexed.pop((package, version)) != (mtime, size):
+                    problems.append(("changed", path))
+            for (package, version) in indexed:
+                problems.append(("stale", os.path.join(dirname, "%s_%s.log" % (package, version))))
+        return sorted(problems)
+
+    def add(self, path):
+        """Add (or update) a logfile to the index"""
+        key = self._split_path(path)
+        if key is None:
+            return
+        st = os.stat(path)
+        with self._db:
+            self._db.execute("INSERT OR REPLACE INTO logs VALUES (?, ?, ?, ?, ?, ?, ?)",
+                             key + (int(st.st_mtime), int(st.st_ctime), st.st_size))
+
+    def remove(self, path):
+        """Remove a logfile from the index"""
+        key = self._split_path(path)
+        if key is None:
+            return
+        with self._db:
+            self._db.execute("DELETE FROM logs WHERE section = ? AND dir = ? "
+                             "AND package = ? AND version = ?", key)
+
+    def move(self, old_path, new_path):
+        """Record the rename of a logfile, e.g. from fail/ to bugged/"""
+        self.remove(old_path)
+        self.add(new_path)
+
+    def exists(self, path):
+        key = self._split_path(path)
+        if key is None:
+            return False
+        row = self._db.execute("SELECT 1 FROM logs WHERE section = ? AND dir = ? "
+                               "AND package = ? AND version = ?", key).fetchone()
+        return row is not None
+
+    def list_dir(self, dirname):
+        """Return the (basename, mtime, ctime, size) of all logfiles in a
+           directory, sorted by mtime"""
+        (section, subdir) = self._split_dir(dirname)
+        return [("%s_%s.log" % (package, version), mtime, ctime, size)
+                for (package, version, mtime, ctime, size) in self._db.execute(
+                    "SELECT package, version, mtime, ctime, size FROM logs "
+                    "WHERE section = ? AND dir = ? ORDER BY mtime, package, version",
+                    (section, subdir))]
+
+    def query(self, sectiondir, subdirs=LOG_DIRS, older_than=None, newer_than=None):
+        """Return the paths of the logfiles in some directories of a section,
+           optionally restricted to mtimes before older_than or after
+           newer_than (seconds since the epoch), sorted by mtime"""
+        section = self._section(sectiondir)
+        sql = "SELECT dir, package, version FROM logs WHERE section = ? AND dir IN (%s)" % \
+            ", ".join(["?"] * len(subdirs))
+        args = [section] + list(subdirs)
+        if older_than is not None:
+            sql += " AND mtime < ?"
+            args.append(older_than)
+        if newer_than is not None:
+            sql += " AND mtime > ?"
+            args.append(newer_than)
+        sql += " ORDER BY mtime, package, version"
+        return [os.path.join(sectiondir, subdir, "%s_%s.log" % (package, version))
+                for (subdir, package, version) in self._db.execute(sql, args)]
+
+
+# vi:set et ts=4 sw=4 :
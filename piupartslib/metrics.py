@@ -0,0 +1,145 @@
+# -*- coding: utf-8 -*-
+
+# This file is part of Piuparts
+#
+# Piuparts is free software; you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation; either version 2 of the License, or (at your
+# option) any later version.
+#
+# Piuparts is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General
+# Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, see <http://www.gnu.org/licenses/>.
+
+
+"""Counters, gauges and timings in the Prometheus text format
+
+The metrics are kept in memory and written to a file, e.g. for the
+textfile collector of the Prometheus node exporter. Summaries record the
+number, sum and maximum of the observed values, i.e. NAME_count,
+NAME_sum and NAME_max.
+
+The module level registry is used by piupartslib and
+piuparts-master-backend.
+"""
+
+
+import os
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    return "{%s}" % ",".join(['%s="%s"' % (k, str(v).replace("\\", "\\\\").replace('"', '\\"'))
+                              for (k, v) in labels])
+
+
+def _format_value(value):
+    if isinstance(value, float):
+        return repr(value)
+    return "%d" % value
+
+
+class Metrics:
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._types = {}   # name -> counter, gauge or summary
+        self._values = {}  # name -> {labels: value or [count, sum, max]}
+
+    def _get(self, name, type, labels):
+        if name not in self._types:
+            self._types[name] = type
+            self._values[name] = {}
+        return (self._values[name], tuple(sorted(labels.items())))
+
+    def inc(self, name, labels={}, value=1):
+        """Increment a counter"""
+        with self._lock:
+            (values, key) = self._get(name, "counter", labels)
+            values[key] = values.get(key, 0) + value
+
+    def set(self, name, value, labels={}):
+        """Set a gauge"""
+        with self._lock:
+            (values, key) = self._get(name, "gauge", labels)
+            values[key] = value
+
+    def observe(self, name, value, labels={}):
+        """Add a value (e.g. a duration in seconds) to a summary"""
+        with self._lock:
+            (values, key) = self._get(name, "summary", labels)
+            summary = values.setdefault(key, [0, 0, value])
+            summary[0] += 1
+            summary[1] += value
+            summary[2] = max(summary[2], value)
+
+    @contextmanager
+    def timer(self, name, labels={}):
+        """Observe the seconds spent in a with statement"""
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.observe(name, time.time() - start, labels)
+
+    def get(self, name, labels={}):
+        """Return the value of a counter or gauge or the (count, sum, max) of
+           a summary, None if nothing was recorded"""
+        with self._lock:
+            value = self._values.get(name, {}).get(tuple(sorted(labels.items())))
+            if isinstance(value, list):
+                return tuple(value)
+            return value
+
+    def reset(self):
+        with self._lock:
+            self._types = {}
+            self._values = {}
+
+    def format(self):
+        """Return all metrics in the Prometheus text exposition format"""
+        lines = []
+        with self._lock:
+            for name in sorted(self._types):
+                type = self._types[name]
+                if type == "summary":
+                    lines.append("# TYPE %s summary" % name)
+                    for (labels, (count, sum, max)) in sorted(self._values[name].items()):
+                        labels = _format_labels(labels)
+                        lines.append("%s_count%s %d" % (name, labels, count))
+                        lines.append("%s_sum%s %s" % (name, labels, _format_value(sum)))
+                        lines.append("%s_max%s %s" % (name, labels, _format_value(max)))
+                else:
+                    lines.append("# TYPE %s %s" % (name, type))
+                    for (labels, value) in sorted(self._values[name].items()):
+                        lines.append("%s%s %s" % (name, _format_labels(labels),
+                                                  _format_value(value)))
+        return "".join([line + "\n" for line in lines])
+
+    def write(self, filename):
+        """Replace filename atomically with the current metrics"""
+        dirname = os.path.dirname(filename) or "."
+        (fd, temp_name) = tempfile.mkstemp(dir=dirname, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "w") as f:
+                f.write(self.format())
+            os.chmod(temp_name, 0o644)
+            os.rename(temp_name, filename)
+        except:
+            os.remove(temp_name)
+            raise
+
+
+registry = Metrics()
+
+
+# vi:set et ts=4 sw=4 :
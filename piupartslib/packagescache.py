@@ -0,0 +1,233 @@
+# -*- coding: utf-8 -*-
+
+# This file is part of Piuparts
+#
+# Piuparts is free software; you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation; either version 2 of the License, or (at your
+# option) any later version.
+#
+# Piuparts is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General
+# Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, see <http://www.gnu.org/licenses/>.
+
+
+"""Persistent cache of parsed Packages and Sources files
+
+Every Packages (or Sources) URL gets a snapshot of its parsed packages
+together with the HTTP validators (ETag, Last-Modified, Content-Length)
+of the file it was created from, or if the server sends none, with the
+SHA256 of the file listed in the Release file of the distribution. A
+snapshot is reused as long as a conditional request for the file returns
+304 Not Modified or the same validators (or the Release file lists the
+same hash), avoiding the repeated download, decompression and parsing
+of unchanged files.
+
+The cache directory may be shared between processes, the snapshot of a
+URL is created under a lock, so that only one of them downloads it.
+
+NOTA BENE: This module MUST NOT use the logging module for anything but
+debug messages, it is used by piuparts-master-backend while logging
+is redirected.
+"""
+
+
+import fcntl
+import hashlib
+import logging
+import marshal
+import os
+import tempfile
+import urllib2
+
+import piupartslib
+
+
+# bump this whenever the snapshot contents change
+SNAPSHOT_FORMAT = 1
+
+_validator_headers = ["ETag", "Last-Modified", "Content-Length"]
+
+
+def _get_validators(socket):
+    info = socket.info()
+    validators = {}
+    for header in _validator_headers:
+        value = info.getheader(header)
+        if value is not None:
+            validators[header] = value.strip()
+    return validators
+
+
+def get_release_hash(url):
+    """Return the SHA256 of a (compressed) Packages or Sources file as
+       listed in the Release file of its distribution, or None"""
+    (mirror, sep, path) = url.rpartition("/dists/")
+    parts = path.split("/")
+    if not sep or len(parts) < 4:
+        return None
+    # e.g. dists/sid/main/binary-amd64/Packages.xz
+    release_url = "%s/dists/%s/Release" % (mirror, "/".join(parts[:-3]))
+    name = "/".join(parts[-3:])
+    try:
+        socket = urllib2.urlopen(release_url)
+        try:
+            release = socket.read()
+        finally:
+            socket.close()
+    except (urllib2.URLError, IOError):
+        return None
+    in_sha256 = False
+    for line in release.splitlines():
+        if not line.startswith(" "):
+            in_sha256 = line.strip() == "SHA256:"
+        elif in_sha256:
+            fields = line.split()
+            if len(fields) == 3 and fields[2] == name:
+                return fields[0]
+    return None
+
+
+def get_url_validators(url):
+    """Return the validators of a URL, retrieved with a HEAD request"""
+    request = urllib2.Request(url)
+    request.get_method = lambda: "HEAD"
+    socket = urllib2.urlopen(request)
+    try:
+        return _get_validators(socket)
+    finally:
+        socket.close()
+
+
+class PackagesCache:
+
+    def __init__(self, directory):
+        self._directory = directory
+        if not os.path.exists(self._directory):
+            os.makedirs(self._directory)
+        self.hits = 0
+        self.misses = 0
+
+    def _snapshot_name(self, url):
+        return os.path.join(self._directory,
+                            hashlib.sha1(url).hexdigest() + ".snapshot")
+
+    def _lock_name(self, url):
+        return os.path.join(self._directory,
+                            hashlib.sha1(url).hexdigest() + ".lock")
+
+    def _read_header(self, f):
+        header = marshal.load(f)
+        if header.get("format") != SNAPSHOT_FORMAT:
+            raise ValueError("unknown snapshot format")
+        return header
+
+    def _load_header(self, url):
+        try:
+            with open(self._snapshot_name(url), "rb") as f:
+                return self._read_header(f)
+        except (IOError, EOFError, ValueError, TypeError, AttributeError):
+            return None
+
+    def _load_packages(self, url):
+        try:
+            with open(self._snapshot_name(url), "rb") as f:
+                self._read_header(f)
+                states = marshal.load(f)
+        except (IOError, EOFError, ValueError, TypeError):
+            return None
+        return [piupartslib.packagesdb.package_from_state(state) for state in states]
+
+    def _store(self, url, header, packages):
+        name = self._snapshot_name(url)
+        (fd, temp_name) = tempfile.mkstemp(dir=self._directory)
+        try:
+            with os.fdopen(fd, "wb") as f:
+                marshal.dump(header, f)
+                marshal.dump([p.get_state() for p in packages], f)
+            os.rename(temp_name, name)
+        except:
+            os.remove(temp_name)
+            raise
+
+    def _is_unmodified(self, header):
+        """Revalidate the file a snapshot was created from"""
+        validators = header["validators"]
+        if "Release-SHA256" in validators:
+            return get_release_hash(header["url"]) == validators["Release-SHA256"]
+        request = urllib2.Request(header["url"])
+        if "ETag" in validators:
+            request.add_header("If-None-Match", validators["ETag"])
+        if "Last-Modified" in validators:
+            request.add_header("If-Modified-Since", validators["Last-Modified"])
+        try:
+            socket = urllib2.urlopen(request)
+        except urllib2.HTTPError as e:
+            return e.code == 304
+        except urllib2.URLError:
+            return False
+        try:
+            # not all servers (and no file:// URLs) support conditional requests
+            return _get_validators(socket) == validators
+        finally:
+            socket.close()
+
+    def load_packages_url(self, url, parse_stream):
+        """Return the real URL and the list of packages for a Packages URL
+
+        parse_stream is called to parse a (decompressed) stream into a list
+        of Package objects if there is no valid snapshot.
+        """
+        try:
+            lock = open(self._lock_name(url), "a")
+        except IOError:
+            # e.g. a read-only cache directory
+            return self._load_packages_url(url, parse_stream)
+        with lock:
+            # wait for a concurrent process fetching the same URL
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            return self._load_packages_url(url, parse_stream)
+
+    def _load_packages_url(self, url, parse_stream):
+        header = self._load_header(url)
+        if header is not None and header["validators"] and self._is_unmodified(header):
+            packages = self._load_packages(url)
+            if packages is not None:
+                logging.debug("Using cached %s" % header["url"])
+                self.hits += 1
+                return (header["url"], packages)
+
+        self.misses += 1
+        logging.debug("Opening %s.*" % url)
+        (ext, socket) = piupartslib.urlopen_packages_url(url)
+        real_url = socket.geturl()
+        validators = _get_validators(socket)
+        if "ETag" not in validators and "Last-Modified" not in validators:
+            # taken before reading the file, a race with a mirror update
+            # results in a new snapshot next time, not in a stale one
+            release_hash = get_release_hash(real_url)
+            if release_hash is not None:
+                validators = {"Release-SHA256": release_hash}
+        logging.debug("Fetching %s" % real_url)
+        stream = piupartslib.decompress_packages_stream(ext, socket)
+        packages = parse_stream(stream)
+        stream.close()
+        if "ETag" in validators or "Last-Modified" in validators or \
+                "Release-SHA256" in validators:
+            header = {
+                "format": SNAPSHOT_FORMAT,
+                "url": real_url,
+                "validators": validators,
+            }
+            try:
+                self._store(url, header, packages)
+            except (IOError, OSError) as e:
+                logging.debug("Failed to store snapshot of %s: %s" % (real_url, e))
+        return (real_url, packages)
+
+
+# vi:set et ts=4 sw=4 :
@@ -26,10 +26,16 @@ Lars Wirzenius <liw@iki.fi>
 """
 
 
+import fcntl
+import hashlib
+import heapq
 import logging
+import marshal
 import os
 import random
+import shutil
 import stat
+import string
 import tempfile
 import time
 import UserDict
@@ -37,38 +43,161 @@ import apt_pkg
 
 import piupartslib
 from piupartslib.dependencyparser import DependencyParser
+from piupartslib.metrics import registry as _metrics
+from piupartslib.submissions import SubmissionsJournal, get_log_duration
+from piupartslib.versions import version_compare
 
 apt_pkg.init_system()
 
+# the parser used by PackagesFile: "apt" (apt_pkg.TagFile) or "python"
+default_parser = "apt"
 
-def rfc822_like_header_parse(input):
-    headers = []
+
+# parsed dependency fields, shared by all packages
+_dependency_names = {}
+
+# limit the memory used by the long-running master, which reloads the
+# Packages files whenever they change
+_max_dependency_names = 200000
+
+
+def parse_dependency_names(field):
+    """Return the package names of a dependency field as a tuple of
+       tuples of alternatives, memoized for identical fields"""
+    names = _dependency_names.get(field)
+    if names is None:
+        if len(_dependency_names) >= _max_dependency_names:
+            _dependency_names.clear()
+        depends = DependencyParser(field).get_dependencies()
+        names = tuple([tuple([intern(alt.name) for alt in alternatives])
+                       for alternatives in depends])
+        _dependency_names[field] = names
+    return names
+
+
+def rfc822_like_stanza_read(input):
+    """Return the next stanza (without the separating empty line) or "" """
+    lines = []
     while True:
         line = input.readline()
         if not line or line in ["\r\n", "\n"]:
-            break
-        if headers and line and line[0].isspace():
-            headers[-1] = headers[-1] + line
+            if lines or not line:
+                break
+            continue
+        lines.append(line)
+    return "".join(lines)
+
+
+def rfc822_like_stanza_parse(stanza):
+    """Return a dict of all fields in a stanza"""
+    fields = {}
+    name = None
+    for line in stanza.splitlines(True):
+        if name is not None and line[0].isspace():
+            fields[name].append(line)
         else:
-            headers.append(line)
-    return headers
-
+            name, value = line.split(":", 1)
+            name = name.strip()
+            fields[name] = [value]
+    for name, value in fields.items():
+        fields[name] = "".join(value).strip()
+    return fields
+
+
+class Package(object):
+
+    """A binary or source package stanza
+
+    Only the fields needed for computing package states are kept as
+    attributes, all other fields are parsed on demand from the raw stanza.
+    """
+
+    # field name -> attribute
+    _fields = {
+        "Package": "_package",
+        "Version": "_version",
+        "Source": "_source",
+        "Depends": "_depends",
+        "Pre-Depends": "_pre_depends",
+        "Provides": "_provides",
+        "Architecture": "_architecture",
+        "Maintainer": "_maintainer",
+        "Uploaders": "_uploaders",
+        "TestVersions": "_test_versions",
+    }
 
-class Package(UserDict.UserDict):
+    # fields saved in snapshots, see get_state()
+    _state_fields = ["Package", "Version", "Source", "Depends", "Pre-Depends",
+                     "Provides", "Architecture", "Maintainer", "Uploaders"]
+
+    # field values that are shared by many packages
+    _interned_fields = ["Package", "Source", "Architecture", "Maintainer"]
+
+    __slots__ = list(_fields.values()) + [
+        "_stanza",
+        "_parsed_deps",
+        "_parsed_alt_deps",
+        "rrdep_cnt",
+        "block_cnt",
+        "waiting_cnt",
+        "rdep_chain_len",
+    ]
 
-    def __init__(self, headers):
-        UserDict.UserDict.__init__(self)
-        self.headers = headers
-        for header in headers:
-            name, value = header.split(":", 1)
-            self[name.strip()] = value.strip()
-        self._parsed_deps = {}
-        self._parsed_alt_deps = {}
+    def __init__(self, stanza, fields=None):
+        """fields may be an already parsed mapping of the stanza,
+           e.g. an apt_pkg.TagSection"""
+        self._stanza = stanza
+        if fields is None:
+            fields = rfc822_like_stanza_parse(stanza)
+        for name, attr in self._fields.iteritems():
+            value = fields.get(name)
+            if value is not None and name in self._interned_fields:
+                value = intern(value)
+            setattr(self, attr, value)
+        self._parsed_deps = None
+        self._parsed_alt_deps = None
         self.rrdep_cnt = None
         self.block_cnt = None
         self.waiting_cnt = None
         self.rdep_chain_len = None
 
+    def get_state(self):
+        """Return a tuple of marshallable values to recreate the package
+           with package_from_state()"""
+        return (self._stanza,) + tuple([getattr(self, self._fields[name])
+                                        for name in self._state_fields])
+
+    def __getitem__(self, name):
+        attr = self._fields.get(name)
+        if attr is not None:
+            value = getattr(self, attr)
+        else:
+            value = rfc822_like_stanza_parse(self._stanza).get(name)
+        if value is None:
+            raise KeyError(name)
+        return value
+
+    def __setitem__(self, name, value):
+        if name not in self._fields:
+            raise KeyError(name)
+        setattr(self, self._fields[name], value)
+
+    def __contains__(self, name):
+        try:
+            self[name]
+        except KeyError:
+            return False
+        return True
+
+    def get(self, name, default=None):
+        try:
+            return self[name]
+        except KeyError:
+            return default
+
+    def __repr__(self):
+        return "<Package %s %s>" % (self._package, self._version)
+
     def name(self):
         return self["Package"]
 
@@ -107,22 +236,24 @@ class Package(UserDict.UserDict):
         return self.version()
 
     def _parse_dependencies(self, header_name):
+        if self._parsed_deps is None:
+            self._parsed_deps = {}
         if header_name in self._parsed_deps:
             depends = self._parsed_deps[header_name]
         else:
-            parser = DependencyParser(self[header_name])
-            depends = parser.get_dependencies()
-            depends = [alternatives[0].name for alternatives in depends]
+            depends = parse_dependency_names(self[header_name])
+            depends = [alternatives[0] for alternatives in depends]
             self._parsed_deps[header_name] = depends
         return depends
 
     def _parse_alternative_dependencies(self, header_name):
+        if self._parsed_alt_deps is None:
+            self._parsed_alt_deps = {}
         if header_name in self._parsed_alt_deps:
             depends = self._parsed_alt_deps[header_name]
         else:
-            parser = DependencyParser(self[header_name])
-            depends = parser.get_dependencies()
-            depends = [[alt.name for alt in alternatives] for alternatives in depends]
+            depends = parse_dependency_names(self[header_name])
+            depends = [list(alternatives) for alternatives in depends]
             self._parsed_alt_deps[header_name] = depends
         return depends
 
@@ -145,10 +276,12 @@ class Package(UserDict.UserDict):
                 vlist += self._parse_alternative_dependencies(header)
         return vlist
 
+    def reset_preferred_alternatives(self):
+        self._parsed_deps = None
+
     def prefer_alt_depends(self, header_name, dep_idx, dep):
         if header_name in self:
-            if header_name not in self._parsed_deps:
-                self._parse_dependencies(header_name)
+            self._parse_dependencies(header_name)
             if self._parsed_deps[header_name][dep_idx]:
                 self._parsed_deps[header_name][dep_idx] = dep
 
@@ -160,41 +293,113 @@ class Package(UserDict.UserDict):
         return vlist
 
     def dump(self, output_file):
-        output_file.write("".join(self.headers))
+        output_file.write(self._stanza)
+
+
+def package_from_state(state):
+    """Recreate a Package from the result of Package.get_state()"""
+    p = Package.__new__(Package)
+    p._stanza = state[0]
+    for name, value in zip(Package._state_fields, state[1:]):
+        if value is not None and name in Package._interned_fields:
+            value = intern(value)
+        setattr(p, Package._fields[name], value)
+    p._test_versions = None
+    p._parsed_deps = None
+    p._parsed_alt_deps = None
+    p.rrdep_cnt = None
+    p.block_cnt = None
+    p.waiting_cnt = None
+    p.rdep_chain_len = None
+    return p
 
 
 class PackagesFile(UserDict.UserDict):
 
-    def __init__(self):
+    """Packages or Sources file(s), indexed by package name
+
+    The files are parsed with apt_pkg.TagFile if available. Use
+    parser="python" to select the (slower) pure Python parser instead,
+    e.g. for comparing the results.
+    """
+
+    def __init__(self, parser=None, cache=None):
         UserDict.UserDict.__init__(self)
         self._urllist = []
+        if parser is None:
+            parser = default_parser
+        if parser == "apt" and not hasattr(apt_pkg, "TagFile"):
+            parser = "python"
+        self._parser = parser
+        self._cache = cache
+        # seconds spent downloading and decompressing (apt parser only)
+        self.fetch_time = 0.0
 
     def load_packages_urls(self, urls, restrict_packages=None):
         for url in urls:
+            if self._cache is not None:
+                (url, packages) = self._cache.load_packages_url(url, self._parse_stream)
+                for p in packages:
+                    self._add_package(p, restrict_packages)
+                self._urllist.append(url)
+                continue
             logging.debug("Opening %s.*" % url)
             (url, stream) = piupartslib.open_packages_url(url)
             logging.debug("Fetching %s" % url)
-            self._read_file(stream, restrict_packages=restrict_packages)
+            self._read_stream(stream, restrict_packages=restrict_packages)
             stream.close()
             self._urllist.append(url)
 
+    def _read_stream(self, stream, restrict_packages=None):
+        if self._parser == "apt":
+            self._read_tagfile(stream, restrict_packages=restrict_packages)
+        else:
+            self._read_file(stream, restrict_packages=restrict_packages)
+
+    def _parse_stream(self, stream):
+        """Return all packages from a stream, without adding them to us"""
+        pf = PackagesFile(parser=self._parser)
+        pf._read_stream(stream)
+        self.fetch_time += pf.fetch_time
+        return pf.values()
+
+    def _add_package(self, p, restrict_packages):
+        if p["Package"] in self:
+            q = self[p["Package"]]
+            if version_compare(p["Version"], q["Version"]) <= 0:
+                # there is already a newer version
+                return
+        if restrict_packages is not None:
+            if p["Package"] not in restrict_packages:
+                # unwanted package
+                return
+        self[p["Package"]] = p
+
     def _read_file(self, input, restrict_packages=None):
         """Parse a Packages file and add its packages to us-the-dict"""
         while True:
-            headers = rfc822_like_header_parse(input)
-            if not headers:
+            stanza = rfc822_like_stanza_read(input)
+            if not stanza:
                 break
-            p = Package(headers)
-            if p["Package"] in self:
-                q = self[p["Package"]]
-                if apt_pkg.version_compare(p["Version"], q["Version"]) <= 0:
-                    # there is already a newer version
-                    continue
-            if restrict_packages is not None:
-                if p["Package"] not in restrict_packages:
-                    # unwanted package
-                    continue
-            self[p["Package"]] = p
+            self._add_package(Package(stanza), restrict_packages)
+
+    def _read_tagfile(self, input, restrict_packages=None):
+        """Parse a Packages file with apt_pkg.TagFile and add its packages
+           to us-the-dict"""
+        # apt_pkg.TagFile needs a real file, decompress the stream into it
+        with tempfile.TemporaryFile() as tmp:
+            start = time.time()
+            shutil.copyfileobj(input, tmp, 1 << 20)
+            tmp.flush()
+            tmp.seek(0)
+            self.fetch_time += time.time() - start
+            for section in apt_pkg.TagFile(tmp):
+                if restrict_packages is not None:
+                    if section.get("Package") not in restrict_packages:
+                        # unwanted package, skip creating a Package object
+                        continue
+                stanza = str(section).rstrip("\n") + "\n"
+                self._add_package(Package(stanza, section), restrict_packages)
 
     def get_urls(self):
         return self._urllist
@@ -220,15 +425,21 @@ class LogDB:
         except AttributeError:
             pass
 
+    def clear_cache(self):
+        self.exists_cache = {}
+
     def bulk_load_dir(self, dirname):
+        """Cache the existence of all logfiles in a directory, returns
+           their basenames"""
         try:
             cache = self.exists_cache
         except AttributeError:
             self.exists_cache = {}
             cache = self.exists_cache
-        for basename in os.listdir(dirname):
-            if basename.endswith(".log"):
-                cache[os.path.join(dirname, basename)] = True
+        basenames = [x for x in os.listdir(dirname) if x.endswith(".log")]
+        for basename in basenames:
+            cache[os.path.join(dirname, basename)] = True
+        return basenames
 
     def remove_file(self, pathname):
         os.remove(pathname)
@@ -286,6 +497,62 @@ class LogDB:
         full_name = os.path.join(subdir, self._log_name(package, version))
         return os.stat(full_name)
 
+    def touch(self, subdir, package, version):
+        full_name = os.path.join(subdir, self._log_name(package, version))
+        os.utime(full_name, None)
+
+
+class IndexedLogDB(LogDB):
+
+    """A LogDB answering existence queries from a LogIndex instead of the
+       filesystem and keeping the index up to date"""
+
+    def __init__(self, index):
+        self._index = index
+        self.exists_cache = {}
+        self._loaded_dirs = set()
+
+    def clear_cache(self):
+        self.exists_cache = {}
+        self._loaded_dirs = set()
+
+    def exists(self, pathname):
+        cache = self.exists_cache
+        if pathname not in cache:
+            if os.path.dirname(pathname) in self._loaded_dirs:
+                cache[pathname] = False
+            else:
+                cache[pathname] = self._index.exists(pathname)
+        return cache[pathname]
+
+    def bulk_load_dir(self, dirname):
+        cache = self.exists_cache
+        basenames = [entry[0] for entry in self._index.list_dir(dirname)]
+        for basename in basenames:
+            cache[os.path.join(dirname, basename)] = True
+        self._loaded_dirs.add(dirname)
+        return basenames
+
+    def remove_file(self, pathname):
+        LogDB.remove_file(self, pathname)
+        self._index.remove(pathname)
+
+    def create(self, subdir, package, version, contents):
+        full_name = os.path.join(subdir, self._log_name(package, version))
+        if not LogDB.create(self, subdir, package, version, contents):
+            if os.path.exists(full_name):
+                # the index missed a file created behind our back
+                self._index.add(full_name)
+                self.exists_cache[full_name] = True
+            return False
+        self._index.add(full_name)
+        self.exists_cache[full_name] = True
+        return True
+
+    def touch(self, subdir, package, version):
+        LogDB.touch(self, subdir, package, version)
+        self._index.add(os.path.join(subdir, self._log_name(package, version)))
+
 
 class LogfileExists(Exception):
 
@@ -293,6 +560,143 @@ class LogfileExists(Exception):
         self.args = (path, package, version)
 
 
+class LogJournal:
+
+    """Logs submitted while another process holds the master.lock
+
+    Each record consists of a "RESULT PACKAGE VERSION SIZE [SLAVE]" line
+    followed by SIZE bytes of log. Records are appended (and synced) under a lock
+    of the journal file itself and replayed by the next master holding
+    the master.lock exclusively. An incomplete last record (from a crash
+    before the submission was acknowledged) is dropped.
+    """
+
+    def __init__(self, filename):
+        self._filename = filename
+
+    def append(self, result, package, version, log, slave=None):
+        header = [result, package, version, "%d" % len(log)]
+        if slave:
+            header.append(slave)
+        with open(self._filename, "ab") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            f.write("%s\n%s" % (" ".join(header), log))
+            f.flush()
+            os.fsync(f.fileno())
+
+    def replay(self, handler):
+        """Call handler(result, package, version, log, slave) for all records
+           and empty the journal, returns the number of records"""
+        if not os.path.exists(self._filename) or os.path.getsize(self._filename) == 0:
+            return 0
+        with open(self._filename, "r+b") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            data = f.read()
+            count = 0
+            offset = 0
+            while True:
+                end = data.find("\n", offset)
+                if end < 0:
+                    break
+                words = data[offset:end].split()
+                if len(words) not in [4, 5] or not words[3].isdigit():
+                    logging.error("%s: invalid record at offset %d" % (self._filename, offset))
+                    break
+                size = int(words[3])
+                if end + 1 + size > len(data):
+                    break
+                slave = words[4] if len(words) == 5 else None
+                handler(words[0], words[1], words[2], data[end + 1:end + 1 + size], slave)
+                count += 1
+                offset = end + 1 + size
+            if offset < len(data):
+                logging.info("%s: dropped %d bytes of incomplete records"
+                             % (self._filename, len(data) - offset))
+            f.truncate(0)
+        return count
+
+
+def strongly_connected_components(graph):
+    """Return the strongly connected components of a graph
+
+    graph maps every node to the list of its successors. The components
+    are lists of nodes, ordered such that the successors of a component
+    precede it (Tarjan's algorithm emits them in reverse topological order).
+    """
+    sccs = []
+    index = {}
+    lowlink = {}
+    stack = []
+    on_stack = set()
+    for root in graph:
+        if root in index:
+            continue
+        index[root] = lowlink[root] = len(index)
+        stack.append(root)
+        on_stack.add(root)
+        work = [(root, iter(graph[root]))]
+        while work:
+            node, successors = work[-1]
+            for succ in successors:
+                if succ not in index:
+                    index[succ] = lowlink[succ] = len(index)
+                    stack.append(succ)
+                    on_stack.add(succ)
+                    work.append((succ, iter(graph[succ])))
+                    break
+                elif succ in on_stack:
+                    lowlink[node] = min(lowlink[node], index[succ])
+            else:
+                work.pop()
+                if work:
+                    parent = work[-1][0]
+                    lowlink[parent] = min(lowlink[parent], lowlink[node])
+                if lowlink[node] == index[node]:
+                    scc = []
+                    while True:
+                        member = stack.pop()
+                        on_stack.remove(member)
+                        scc.append(member)
+                        if member == node:
+                            break
+                    sccs.append(scc)
+    return sccs
+
+
+_popcount_table = string.maketrans("0123456789abcdef", "0112122312232334")
+
+
+def popcount(bits):
+    """Return the number of bits set in a non-negative (long) integer"""
+    counts = ("%x" % bits).translate(_popcount_table)
+    return counts.count("1") + 2 * counts.count("2") + 3 * counts.count("3") + 4 * counts.count("4")
+
+
+def merge_levels(own, bits, rdep_levels):
+    """Return the reachability levels of a package outside of any cycle
+
+    Level d is the bitset of the packages reachable within d steps, i.e.
+    own (the package itself) and level d - 1 of all reverse dependencies.
+    bits is the final level, the bitset of all reachable packages.
+    """
+    if own == bits:
+        return [own]
+    levels = [own] * (1 + max([len(x) for x in rdep_levels]))
+    ends = {}
+    for rdep in rdep_levels:
+        for d in xrange(len(rdep)):
+            levels[d + 1] |= rdep[d]
+        # after its last level an rdep contributes everything it reaches
+        ends[len(rdep)] = ends.get(len(rdep), 0) | rdep[-1]
+    tail = 0
+    for d in xrange(1, len(levels)):
+        tail |= ends.get(d - 1, 0)
+        levels[d] |= tail
+        if levels[d] == bits:
+            return levels[:d + 1]
+    return levels
+
+
 class PackagesDB:
 
     # these packages are uses as dependencies but are only available
@@ -370,8 +774,19 @@ class PackagesDB:
         "waiting-for-dependency-to-be-tested": "waiting-for-dependency-to-be-tested",
     }
 
-    def __init__(self, logdb=None, prefix=None):
+    # number of target packages handled at once by _calc_all_rrdep_pkg_counts()
+    # limits the size of the reachability bitsets
+    _rrdep_block_size = 8192
+
+    # increment after changes to the state computation or checkpoint contents
+    _checkpoint_format = 1
+
+    # minimum number of seconds between two scans for expired reservations
+    _lease_check_interval = 60
+
+    def __init__(self, logdb=None, prefix=None, packages_cache=None):
         self.prefix = prefix
+        self._packages_cache = packages_cache
         self._packages_files = []
         self._ready_for_testing = None
         self._logdb = logdb or LogDB()
@@ -381,7 +796,20 @@ class PackagesDB:
         self._dependency_databases = []
         self._recycle_mode = False
         self._candidates_for_testing = None
+        self._candidate_keys = {}
         self._rdeps = None
+        self._alt_rdeps = None
+        self._dep_graph = None
+        self._sccs = None
+        self._scc_by_package = {}
+        self._dirty_packages = set()
+        self._use_cached_success = False
+        self._all_rrdep_counts_done = False
+        self._packages_digest = None
+        self._checkpoint_file = None
+        self._checkpoint_changed = False
+        self._lease_time = 0
+        self._lease_check_time = 0
         self.set_subdirs(ok="pass", fail="fail", evil="untestable",
                          reserved="reserved", morefail=["bugged", "affected"],
                          recycle="recycle")
@@ -393,7 +821,8 @@ class PackagesDB:
             pformat = self.prefix + "/%s"
         else:
             pformat = "%s"
-        self._submissions = pformat % "submissions.txt"
+        self._submissions = SubmissionsJournal(pformat % "submissions.txt")
+        self._log_journal = LogJournal(pformat % "log-journal")
         self._all = []
         if ok:
             self._ok = pformat % ok
@@ -436,16 +865,29 @@ class PackagesDB:
     def get_mtime(self):
         return max([os.path.getmtime(sdir) for sdir in self._all])
 
-    def load_packages_urls(self, urls):
-        pf = PackagesFile()
+    def _observe_phase(self, phase, start):
+        """Record the seconds since start spent in a phase of the package
+           state computation"""
+        _metrics.observe("piuparts_packagesdb_phase_seconds", time.time() - start,
+                        {"section": self.prefix or "", "phase": phase})
+
+    def _load_packages_file(self, urls):
+        start = time.time()
+        pf = PackagesFile(cache=self._packages_cache)
         pf.load_packages_urls(urls)
+        _metrics.observe("piuparts_packagesdb_phase_seconds", pf.fetch_time,
+                        {"section": self.prefix or "", "phase": "fetch"})
+        self._observe_phase("parse", start + pf.fetch_time)
+        return pf
+
+    def load_packages_urls(self, urls):
+        pf = self._load_packages_file(urls)
         self._packages_files.append(pf)
         self._packages = None
 
     def load_alternate_versions_from_packages_urls(self, urls):
         # take version numbers (or None) from alternate URLs
-        pf2 = PackagesFile()
-        pf2.load_packages_urls(urls)
+        pf2 = self._load_packages_file(urls)
         for package in self.get_all_packages():
             if package.name() in pf2:
                 package.set_test_versions(pf2[package.name()].version())
@@ -465,6 +907,10 @@ class PackagesDB:
         if self._packages is None:
             self._packages = {}
             self._virtual_packages = {}
+            self._dep_graph = None
+            self._alt_rdeps = None
+            self._all_rrdep_counts_done = False
+            self._packages_digest = None
             for pf in self._packages_files:
                 for p in pf.values():
                     self._packages[p["Package"]] = p
@@ -475,34 +921,102 @@ class PackagesDB:
                             self._virtual_packages[provided] = []
                         self._virtual_packages[provided].append(p["Package"])
 
+    def _get_dependency_graph(self):
+        """Return dict of the dependencies of all packages
+
+        The edges point to the packages in this database that can influence
+        the state of a package: all alternatives of its Depends and
+        Pre-Depends and all providers of virtual dependencies.
+        """
+        self._find_all_packages()
+        if self._dep_graph is None:
+            self._dep_graph = {}
+            for pkg_name, pkg in self._packages.iteritems():
+                deps = []
+                for alternatives in pkg.all_dependencies():
+                    for dep in alternatives:
+                        for target in [dep] + self.get_providers(dep, recurse=False):
+                            if target in self._packages and target not in deps:
+                                deps.append(target)
+                self._dep_graph[pkg_name] = deps
+            self._sccs = None
+        return self._dep_graph
+
+    def _get_dependency_sccs(self):
+        """Return the strongly connected components of the dependency graph
+
+        The components are lists of package names, ordered such that the
+        dependencies of a component precede it (Tarjan's algorithm emits
+        them in reverse topological order).
+        """
+        graph = self._get_dependency_graph()
+        if self._sccs is None:
+            self._sccs = strongly_connected_components(graph)
+            self._scc_by_package = {}
+            for scc in self._sccs:
+                for member in scc:
+                    self._scc_by_package[member] = scc
+        return self._sccs
+
     def _get_recursive_dependencies(self, package):
-        assert self._packages is not None
-        deps = []
-        more = package.dependencies()
+        graph = self._get_dependency_graph()
+        deps = set()
+        more = list(graph.get(package["Package"], []))
         while more:
-            dep = more[0]
-            more = more[1:]
+            dep = more.pop()
             if dep not in deps:
-                deps.append(dep)
-                dep_pkg = self.get_package(dep, recurse=True, resolve_virtual=True)
-                if dep_pkg is not None:
-                    more += dep_pkg.dependencies()
+                deps.add(dep)
+                more.extend(graph[dep])
+        return sorted(deps)
+
+    def _get_preferred_dependencies(self, package_name, members):
+        """Return the packages out of members that package_name depends on
+           via its preferred alternatives (and their resolved providers)"""
+        deps = []
+        for dep in self._packages[package_name].dependencies():
+            dep_pkg = self.get_package(dep, recurse=True, resolve_virtual=True)
+            if dep_pkg is not None and dep_pkg["Package"] in members and \
+                    self._packages.get(dep_pkg["Package"]) is dep_pkg:
+                deps.append(dep_pkg["Package"])
         return deps
 
     def _get_dependency_cycle(self, package_name):
-        deps = []
-        circular = []
+        """Return the packages on a dependency cycle with package_name
+
+        Only the preferred alternatives form a cycle, an alternative that
+        is not chosen does not. Such a cycle is always part of a strongly
+        connected component of the dependency graph (of all alternatives),
+        which limits the search.
+        """
+        self._get_dependency_sccs()
+        members = set(self._scc_by_package.get(package_name, []))
+        if not members:
+            return []
+        graph = dict([(name, self._get_preferred_dependencies(name, members))
+                      for name in members])
+        # the packages reachable from package_name ...
+        reachable = set()
+        more = list(graph[package_name])
+        while more:
+            dep = more.pop()
+            if dep not in reachable:
+                reachable.add(dep)
+                more.extend(graph[dep])
+        if package_name not in reachable:
+            return []
+        # ... that can reach package_name again
+        rdeps = {}
+        for name in reachable:
+            for dep in graph[name]:
+                rdeps.setdefault(dep, []).append(name)
+        circular = set()
         more = [package_name]
         while more:
-            dep = more[0]
-            more = more[1:]
-            if dep not in deps:
-                deps.append(dep)
-                dep_pkg = self.get_package(dep, recurse=True, resolve_virtual=True)
-                if dep_pkg is not None and package_name in self._get_recursive_dependencies(dep_pkg):
-                    circular.append(dep)
-                    more += dep_pkg.dependencies()
-        return circular
+            dep = more.pop()
+            if dep not in circular:
+                circular.add(dep)
+                more.extend([x for x in rdeps.get(dep, []) if x in reachable])
+        return sorted(circular)
 
     def _is_successfully_tested(self, package):
         # a pass/ log exists but no corresponding recycle/ log exists
@@ -518,7 +1032,7 @@ class PackagesDB:
             curr_ver = package.version()
             for db in self._dependency_databases:
                 dep_ver = db.get_version(package.name())
-                if dep_ver is not None and apt_pkg.version_compare(curr_ver, dep_ver) < 0:
+                if dep_ver is not None and version_compare(curr_ver, dep_ver) < 0:
                     #logging.info("[%s] outdated: %s %s < %s @[%s]" % (self.prefix, package.name(), curr_ver, dep_ver, db.prefix))
                     return "outdated";
         if self._recycle_mode:
@@ -545,7 +1059,7 @@ class PackagesDB:
             return "waiting-to-be-tested"
         return "unknown"
 
-    def _compute_package_state(self, package):
+    def _compute_package_state(self, package, circular_deps=None):
         # First attempt to resolve (still-unresolved) multiple alternative depends
         # Definitely sub-optimal, but improvement over blindly selecting first one
         # Select the first alternative in the highest of the following states:
@@ -611,7 +1125,8 @@ class PackagesDB:
             return "waiting-to-be-tested"
 
         # treat circular-dependencies as testable (for the part of the circle)
-        circular_deps = self._get_dependency_cycle(package["Package"])
+        if circular_deps is None:
+            circular_deps = self._get_dependency_cycle(package["Package"])
         if package["Package"] in circular_deps:
             testable = True
             for dep, dep_state in dep_states:
@@ -654,14 +1169,69 @@ class PackagesDB:
 
         return todo
 
+    def _resolve_package_states(self, todo):
+        """Resolve the states of the given packages in dependency order
+
+        The strongly connected components of the dependency graph are
+        processed such that all dependencies outside of a component have
+        their final state before the component is resolved. Only packages
+        on a dependency cycle may need more than one pass.
+        Resolved packages are added to self._in_state, the names of the
+        packages whose state is still "unknown" are returned.
+        """
+        todo = set(todo)
+        unresolved = []
+        for scc in self._get_dependency_sccs():
+            package_names = [x for x in scc if x in todo]
+            if not package_names:
+                continue
+            # in a component with cycles, let error states propagate along
+            # the whole component before treating the packages on a cycle
+            # (of their preferred alternatives, computed per package) as
+            # testable
+            if len(scc) > 1 or scc[0] in self._dep_graph.get(scc[0], []):
+                phases = [([], ["unknown", "waiting-for-dependency-to-be-tested"]),
+                          (None, ["unknown"])]
+            else:
+                phases = [([], ["unknown"])]
+            for circular, retry_states in phases:
+                while package_names:
+                    remaining = []
+                    for package_name in package_names:
+                        state = self._compute_package_state(self._packages[package_name], circular)
+                        assert state in self._states
+                        if state in retry_states:
+                            remaining.append(package_name)
+                        else:
+                            self._in_state[state].append(package_name)
+                            self._package_state[package_name] = state
+                    if len(remaining) == len(package_names):
+                        # If we didn't do anything this time, we sure aren't going
+                        # to do anything the next time either.
+                        break
+                    package_names = remaining
+            unresolved.extend(package_names)
+        return unresolved
+
     def _compute_package_states(self, use_cached_success=False):
         if self._in_state is not None:
+            if self._dirty_packages:
+                self._update_package_states()
             return
 
         self._stamp = time.time()
+        self._use_cached_success = use_cached_success
 
+        log_names = {}
         for subdir in self._all:
-            self._logdb.bulk_load_dir(subdir)
+            log_names[os.path.basename(subdir)] = self._logdb.bulk_load_dir(subdir)
+        self._observe_phase("logs", self._stamp)
+
+        start = time.time()
+        if self._restore_checkpoint(log_names):
+            self._observe_phase("restore", start)
+            return
+        self._checkpoint_changed = True
 
         todo = self._initialize_package_states(use_cached_success=use_cached_success, check_outdated=False)
 
@@ -672,30 +1242,272 @@ class PackagesDB:
             # redo the initialization to properly resolve "outdated" packages after the dependency databases have been initialized
             todo = self._initialize_package_states(use_cached_success=use_cached_success, check_outdated=True)
 
-        while todo:
-            package_names = todo
-            todo = []
-            done = []
-            for package_name in package_names:
-                if self._package_state[package_name] == "unknown":
-                    state = self._compute_package_state(self._packages[package_name])
-                    assert state in self._states
-                    if state == "unknown":
-                        todo.append(package_name)
-                    else:
-                        self._in_state[state].append(package_name)
-                        self._package_state[package_name] = state
-                        done.append(package_name)
-            if not done:
-                # If we didn't do anything this time, we sure aren't going
-                # to do anything the next time either.
-                break
+        self._in_state["unknown"] = self._resolve_package_states(todo)
+
+        for state in self._states:
+            self._in_state[state].sort()
+        self._observe_phase("states", start)
+
+    def enable_checkpoint(self, filename):
+        """Save the computed package states to filename with
+           save_checkpoint() and restore them from there instead of
+           computing them from scratch"""
+        self._checkpoint_file = filename
 
-        self._in_state["unknown"] = todo
+    def _get_packages_digest(self):
+        """Return a digest of all packages and their test versions"""
+        self._find_all_packages()
+        if self._packages_digest is None:
+            digest = hashlib.sha1()
+            for name in sorted(self._packages):
+                p = self._packages[name]
+                digest.update(p._stanza)
+                digest.update("\0%s\0" % p.test_versions())
+            self._packages_digest = digest.hexdigest()
+        return self._packages_digest
+
+    def _get_checkpoint_key(self):
+        """Return what the checkpointed states depend on, besides the logfiles
+           and the states of the dependency databases"""
+        return (self._get_packages_digest(),
+                [db._get_packages_digest() for db in self._dependency_databases],
+                self._recycle_mode,
+                self._use_cached_success)
+
+    def _get_dependency_names(self):
+        names = set()
+        for p in self._packages.itervalues():
+            for alternatives in p.all_dependencies():
+                names.update(alternatives)
+        return names
+
+    def _get_external_states(self):
+        """Return the states of all dependencies, as far as they may be
+           influenced by the dependency databases"""
+        if not self._dependency_databases:
+            return {}
+        return dict([(name, self.get_best_package_state(name))
+                     for name in self._get_dependency_names()])
+
+    def save_checkpoint(self):
+        """Write the package states to the checkpoint file
+
+        Nothing is written if no checkpoint file is set, the states were not
+        computed or did not change since they were restored or saved."""
+        if self._checkpoint_file is None or self._in_state is None:
+            return False
+        self._compute_package_states()  # process pending state updates
+        if not self._checkpoint_changed:
+            return False
+
+        start = time.time()
+        log_names = {}
+        for subdir in self._all:
+            log_names[os.path.basename(subdir)] = self._logdb.bulk_load_dir(subdir)
+        alternatives = []
+        metrics = {}
+        for name, p in self._packages.iteritems():
+            for header in ["Depends", "Pre-Depends"]:
+                if header in p:
+                    preferred = p._parse_dependencies(header)
+                    for d, alt_deps in enumerate(p.all_dependencies(header)):
+                        if preferred[d] != alt_deps[0]:
+                            alternatives.append((name, header, d, preferred[d]))
+            if None not in (p.rrdep_cnt, p.block_cnt, p.waiting_cnt, p.rdep_chain_len):
+                metrics[name] = (p.rrdep_cnt, p.block_cnt, p.waiting_cnt, p.rdep_chain_len)
+        checkpoint = {
+            "format": self._checkpoint_format,
+            "key": self._get_checkpoint_key(),
+            "logs": log_names,
+            "states": self._package_state,
+            "alternatives": alternatives,
+            "external-states": self._get_external_states(),
+            "metrics": metrics,
+            "all-metrics": self._all_rrdep_counts_done,
+        }
+
+        dirname = os.path.dirname(self._checkpoint_file) or "."
+        (fd, temp_name) = tempfile.mkstemp(dir=dirname)
+        try:
+            with os.fdopen(fd, "wb") as f:
+                marshal.dump(checkpoint, f)
+            os.rename(temp_name, self._checkpoint_file)
+        except:
+            os.remove(temp_name)
+            raise
+        self._checkpoint_changed = False
+        self._observe_phase("checkpoint", start)
+        return True
+
+    def _load_checkpoint(self):
+        try:
+            with open(self._checkpoint_file, "rb") as f:
+                checkpoint = marshal.load(f)
+        except (IOError, EOFError, ValueError, TypeError):
+            return None
+        if not isinstance(checkpoint, dict) or \
+                checkpoint.get("format") != self._checkpoint_format:
+            return None
+        return checkpoint
+
+    def _restore_checkpoint(self, log_names):
+        """Restore the package states from the checkpoint file
+
+        Only the packages whose logfiles were changed since the checkpoint
+        was saved or whose dependencies from the dependency databases changed
+        their states (and their reverse dependencies) are resolved again.
+        Returns False if the checkpoint cannot be used.
+        """
+        if self._checkpoint_file is None:
+            return False
+        checkpoint = self._load_checkpoint()
+        if checkpoint is None:
+            return False
+        for db in self._dependency_databases:
+            db._compute_package_states(use_cached_success=True)
+        if checkpoint["key"] != self._get_checkpoint_key():
+            logging.info("[%s] checkpoint is outdated" % self.prefix)
+            return False
+        self._find_all_packages()
+        if set(checkpoint["states"].keys()) != set(self._packages.keys()):
+            return False
+
+        self._package_state = checkpoint["states"]
+        self._in_state = {}
+        for state in self._states:
+            self._in_state[state] = []
+        for name, state in self._package_state.iteritems():
+            self._in_state[state].append(name)
+        for state in self._states:
+            self._in_state[state].sort()
+        for (name, header, d, dep) in checkpoint["alternatives"]:
+            self._packages[name].prefer_alt_depends(header, d, dep)
+        for name, (rrdep_cnt, block_cnt, waiting_cnt, chain_len) in checkpoint["metrics"].iteritems():
+            p = self._packages[name]
+            p.rrdep_cnt = rrdep_cnt
+            p.block_cnt = block_cnt
+            p.waiting_cnt = waiting_cnt
+            p.rdep_chain_len = chain_len
+        self._all_rrdep_counts_done = checkpoint["all-metrics"]
+        self._checkpoint_changed = False
+
+        # replay the changes since the checkpoint was saved
+        changed = set()
+        for subdir, basenames in log_names.iteritems():
+            old_basenames = checkpoint["logs"].get(subdir, [])
+            for basename in set(basenames).symmetric_difference(old_basenames):
+                changed.add(basename.split("_", 1)[0])
+        old_external_states = checkpoint["external-states"]
+        changed_deps = set([name for name, state in self._get_external_states().iteritems()
+                            if old_external_states.get(name) != state])
+        if changed_deps:
+            for name, p in self._packages.iteritems():
+                for alternatives in p.all_dependencies():
+                    if changed_deps.intersection(alternatives):
+                        changed.add(name)
+                        break
+        for name in changed:
+            self.invalidate_package_state(name)
+        logging.info("[%s] restored package states from checkpoint, %d changed packages"
+                     % (self.prefix, len(self._dirty_packages)))
+        if self._dirty_packages:
+            self._update_package_states()
+        return True
+
+    def invalidate_package_state(self, package_name):
+        """Schedule recomputation of a package state after its logs changed
+
+        The package and all its (transitive) reverse dependencies will be
+        resolved again on the next state query instead of recomputing the
+        states of all packages.
+        """
+        if self._in_state is not None and package_name in self._packages:
+            self._dirty_packages.add(package_name)
+
+    def reload_package_states(self):
+        """Forget all package states, e.g. after logfiles were changed by
+           another process
+
+        The states are recomputed from the logfiles on the next query,
+        without loading the Packages files again.
+        """
+        self._logdb.clear_cache()
+        if self._packages is not None:
+            for p in self._packages.itervalues():
+                p.reset_preferred_alternatives()
+                p.rrdep_cnt = None
+                p.block_cnt = None
+                p.waiting_cnt = None
+                p.rdep_chain_len = None
+        self._packages = None
+        self._in_state = None
+        self._package_state = {}
+        self._dirty_packages = set()
+        self._candidates_for_testing = None
+        self._candidate_keys = {}
+        self._rdeps = None
+
+    def _get_alt_rdep_dict(self):
+        """Return dict of one-level reverse dependencies by package,
+           considering all alternatives and all providers of virtual packages"""
+
+        if self._alt_rdeps is None:
+            self._alt_rdeps = {}
+            for pkg_name, deps in self._get_dependency_graph().iteritems():
+                for dep in deps:
+                    if not dep in self._alt_rdeps:
+                        self._alt_rdeps[dep] = set()
+                    self._alt_rdeps[dep].add(pkg_name)
+
+        return self._alt_rdeps
+
+    def _update_package_states(self):
+        """Recompute the states of the invalidated packages and their rdeps"""
+        start = time.time()
+        rdeps = self._get_alt_rdep_dict()
+        dirty = set()
+        more = list(self._dirty_packages)
+        self._dirty_packages = set()
+        while more:
+            package_name = more.pop()
+            if package_name not in dirty:
+                dirty.add(package_name)
+                more.extend(rdeps.get(package_name, []))
+
+        for state in self._states:
+            self._in_state[state] = [x for x in self._in_state[state] if x not in dirty]
+
+        old_deps = {}
+        todo = []
+        for package_name in dirty:
+            package = self._packages[package_name]
+            old_deps[package_name] = package.dependencies()
+            # the preferred alternatives are chosen again
+            package.reset_preferred_alternatives()
+            state = self._lookup_package_state(package, self._use_cached_success,
+                                               check_outdated=bool(self._dependency_databases))
+            assert state in self._states
+            self._package_state[package_name] = state
+            if state == "unknown":
+                todo.append(package_name)
+            else:
+                self._in_state[state].append(package_name)
+
+        self._in_state["unknown"].extend(self._resolve_package_states(todo))
 
         for state in self._states:
             self._in_state[state].sort()
 
+        for package_name in dirty:
+            if self._packages[package_name].dependencies() != old_deps[package_name]:
+                self._rdeps = None
+                break
+
+        # the candidates with changed rdep metrics need new keys, too
+        self._update_candidates_for_testing(self._reset_rrdep_pkg_counts(dirty, old_deps))
+        self._checkpoint_changed = True
+        self._observe_phase("update", start)
+
     def get_states(self):
         return self._states
 
@@ -712,6 +1524,12 @@ class PackagesDB:
         self._compute_package_states()
         return set(self._in_state[state])
 
+    def get_state_counts(self):
+        """Return the number of packages in each active state"""
+        self._compute_package_states()
+        return dict([(state, len(self._in_state[state]))
+                     for state in self.get_active_states()])
+
     def has_package(self, name):
         self._find_all_packages()
         return name in self._packages
@@ -842,27 +1660,113 @@ class PackagesDB:
                 -mtime / 3600,  # prefer older, at 1 hour granularity to allow randomization
         )
 
+    def _is_candidate_for_testing(self, p):
+        return not self._logdb.log_exists(p, [self._reserved]) or \
+            self._logdb.log_exists(p, [self._recycle])
+
+    def _get_candidate_key(self, p):
+        # heapq pops the smallest key first, so negate the weight
+        return (tuple([-x for x in self._get_package_weight(p)]), random.random())
+
+    def _push_candidate_for_testing(self, p):
+        key = self._get_candidate_key(p)
+        self._candidate_keys[p.name()] = key
+        heapq.heappush(self._candidates_for_testing, (key, p.name()))
+        if len(self._candidates_for_testing) > 2 * len(self._candidate_keys) + 100:
+            # drop the stale entries
+            self._candidates_for_testing = [(key, pn) for pn, key in self._candidate_keys.iteritems()]
+            heapq.heapify(self._candidates_for_testing)
+
     def _find_packages_ready_for_testing(self):
+        """Build the priority queue of the candidates for testing
+
+        The queue is a heap of (key, package name) tuples. Entries are
+        invalidated lazily: only those matching the current key of a
+        package in _candidate_keys are valid.
+        """
+        self._compute_package_states()  # process pending state updates
         if self._candidates_for_testing is None:
-            self._candidates_for_testing = [self.get_package(pn)
-                                            for pn in self.get_pkg_names_in_state("waiting-to-be-tested")]
-            self._candidates_for_testing = [p for p in self._candidates_for_testing
-                                            if not self._logdb.log_exists(p, [self._reserved]) or
-                                            self._logdb.log_exists(p, [self._recycle])]
-            if len(self._candidates_for_testing) > 1:
-                tuples = [(self._get_package_weight(p), random.random(), p)
-                          for p in self._candidates_for_testing]
-                self._candidates_for_testing = [x[-1]
-                                                for x in sorted(tuples, reverse=True)]
-        return self._candidates_for_testing[:]
-
-    def _remove_unavailable_candidate(self, p):
-        self._candidates_for_testing.remove(p)
+            candidates = [self.get_package(pn)
+                          for pn in self.get_pkg_names_in_state("waiting-to-be-tested")]
+            self._candidate_keys = {}
+            for p in candidates:
+                if self._is_candidate_for_testing(p):
+                    self._candidate_keys[p.name()] = self._get_candidate_key(p)
+            self._candidates_for_testing = [(key, pn) for pn, key in self._candidate_keys.iteritems()]
+            heapq.heapify(self._candidates_for_testing)
+
+    def _update_candidates_for_testing(self, package_names):
+        """Requeue the given packages with new states or rdep metrics"""
+        if self._candidates_for_testing is None:
+            return
+        for pn in package_names:
+            self._candidate_keys.pop(pn, None)
+            p = self._packages[pn]
+            if self._package_state[pn] == "waiting-to-be-tested" and self._is_candidate_for_testing(p):
+                self._push_candidate_for_testing(p)
+
+    def _pop_candidate_for_testing(self):
+        """Return the next candidate for testing (or None)"""
+        while self._candidates_for_testing:
+            (key, pn) = heapq.heappop(self._candidates_for_testing)
+            if self._candidate_keys.get(pn) == key:
+                del self._candidate_keys[pn]
+                return self._packages[pn]
+        return None
+
+    def set_reservation_lease_time(self, seconds):
+        """Let reservations expire if they were not renewed for the given
+           number of seconds (0 disables the expiry)"""
+        self._lease_time = seconds
+
+    def get_reservation_lease_time(self):
+        return self._lease_time
+
+    def renew_reservation(self, package, version):
+        """Extend the lease of a reservation, returns False if the package
+           is no longer reserved"""
+        self._check_for_acceptability_as_filename(package)
+        self._check_for_acceptability_as_filename(version)
+        if not self._logdb.log_exists2(package, version, [self._reserved]):
+            return False
+        try:
+            self._logdb.touch(self._reserved, package, version)
+        except OSError:
+            # removed behind our back
+            self._logdb.remove(self._reserved, package, version)
+            return False
+        return True
+
+    def expire_reservations(self):
+        """Unreserve the packages whose leases expired, returns their
+           (package, version)"""
+        expired = []
+        if self._lease_time <= 0:
+            return expired
+        now = time.time()
+        for basename in self._logdb.bulk_load_dir(self._reserved):
+            (package, version) = basename[:-len(".log")].split("_", 1)
+            try:
+                mtime = self._logdb.stat(self._reserved, package, version)[stat.ST_MTIME]
+            except OSError:
+                continue
+            if mtime + self._lease_time < now:
+                logging.info("Reservation expired: %s %s" % (package, version))
+                self.unreserve_package(package, version)
+                expired.append((package, version))
+        self._lease_check_time = now
+        return expired
 
     def reserve_package(self):
-        for p in self._find_packages_ready_for_testing():
+        if self._lease_time > 0 and \
+                time.time() > self._lease_check_time + self._lease_check_interval:
+            self.expire_reservations()
+        self._find_packages_ready_for_testing()
+        while True:
+            p = self._pop_candidate_for_testing()
+            if p is None:
+                return None
             if self._logdb.log_exists(p, [self._reserved]):
-                self._remove_unavailable_candidate(p)
                 continue
             if self._recycle_mode and self._logdb.log_exists(p, [self._recycle]):
                 for vdir in [x for x in self._most if x != self._ok]:
@@ -870,21 +1774,30 @@ class PackagesDB:
                         self._logdb.remove(vdir, p.name(), p.test_versions())
                         logging.info("Recycled %s %s %s" % (vdir, p.name(), p.test_versions()))
             elif self._logdb.log_exists(p, self._most):
-                self._remove_unavailable_candidate(p)
                 continue
             if self._logdb.log_exists(p, [self._recycle]):
                 self._logdb.remove(self._recycle, p.name(), p.test_versions())
             if self._logdb.create(self._reserved, p.name(), p.test_versions(), ""):
+                # the state of a reserved package is no longer resolved from
+                # its dependencies, so its preferred alternatives (and those
+                # of its rdeps) have to be chosen again
+                self.invalidate_package_state(p.name())
                 return p
-        return None
 
     def _check_for_acceptability_as_filename(self, str):
         if "/" in str:
             raise Exception("'/' in (partial) filename: %s" % str)
 
-    def _record_submission(self, category, package, version):
-        with open(self._submissions, "a") as submissions:
-            submissions.write("%d %s %s %s\n" % (time.time(), category, package, version))
+    def _record_submission(self, category, package, version, log, slave):
+        self._submissions.record(category, package, version, slave,
+                                 get_log_duration(log), len(log))
+
+    def flush_submissions(self):
+        """Write the buffered records of the submissions journal"""
+        self._submissions.flush()
+
+    def get_submissions(self):
+        return self._submissions
 
     def _remove_logs_if_reserved(self, package, version):
         if self._logdb.log_exists2(package, version, [self._reserved]):
@@ -893,6 +1806,7 @@ class PackagesDB:
                     self._logdb.remove(vdir, package, version)
                     logging.info("Recycled %s %s %s" % (vdir, package, version))
             self._logdb.remove(self._reserved, package, version)
+            self.invalidate_package_state(package)
 
     def unreserve_package(self, package, version):
         self._check_for_acceptability_as_filename(package)
@@ -903,25 +1817,52 @@ class PackagesDB:
                 if self._logdb.log_exists2(package, version, self._most):
                     self._logdb.create(self._recycle, package, version, "")
         self._logdb.remove(self._reserved, package, version)
+        self.invalidate_package_state(package)
 
-    def _process_log(self, package, version, log, subdir, result):
+    def _process_log(self, package, version, log, subdir, result, slave):
         self._check_for_acceptability_as_filename(package)
         self._check_for_acceptability_as_filename(version)
         self._remove_logs_if_reserved(package, version)
         if self._logdb.create(subdir, package, version, log):
-            self._record_submission(result, package, version)
+            self._record_submission(result, package, version, log, slave)
             self._logdb.remove_kpr(subdir, package, version)
+            self.invalidate_package_state(package)
         else:
             raise LogfileExists(subdir, package, version)
 
-    def pass_package(self, package, version, log):
-        self._process_log(package, version, log, self._ok, "pass")
+    def pass_package(self, package, version, log, slave=None):
+        self._process_log(package, version, log, self._ok, "pass", slave)
 
-    def fail_package(self, package, version, log):
-        self._process_log(package, version, log, self._fail, "fail")
+    def fail_package(self, package, version, log, slave=None):
+        self._process_log(package, version, log, self._fail, "fail", slave)
+
+    def make_package_untestable(self, package, version, log, slave=None):
+        self._process_log(package, version, log, self._evil, "untestable", slave)
+
+    def journal_log(self, result, package, version, log, slave=None):
+        """Store a submitted log (result being "pass", "fail" or "untestable")
+           in the journal, to be processed by replay_log_journal()"""
+        self._check_for_acceptability_as_filename(package)
+        self._check_for_acceptability_as_filename(version)
+        self._log_journal.append(result, package, version, log, slave)
+
+    def _replay_log(self, result, package, version, log, slave):
+        process = {
+            "pass": self.pass_package,
+            "fail": self.fail_package,
+            "untestable": self.make_package_untestable,
+        }
+        try:
+            process[result](package, version, log, slave)
+        except LogfileExists:
+            logging.info("Ignoring duplicate submission: %s %s %s" % (result, package, version))
 
-    def make_package_untestable(self, package, version, log):
-        self._process_log(package, version, log, self._evil, "untestable")
+    def replay_log_journal(self):
+        """Process the logs stored by journal_log(), needs the master.lock"""
+        count = self._log_journal.replay(self._replay_log)
+        if count:
+            logging.info("[%s] processed %d logs from the journal" % (self.prefix, count))
+        return count
 
     def _get_rdep_dict(self):
         """Return dict of one-level reverse dependencies by package"""
@@ -943,8 +1884,125 @@ class PackagesDB:
 
         return self._rdeps
 
+    def _calc_all_rrdep_pkg_counts(self):
+        """Calculate the reverse dependency metrics of all packages at once
+
+        The reverse dependency graph is processed along its strongly
+        connected components, reverse dependencies first. The packages
+        reachable from a component are the union of the packages reachable
+        from its reverse dependencies, kept as bitsets. rdep_chain_len needs
+        the packages reachable within 1, 2, ... steps, which are computed
+        the same way from the corresponding levels of the reverse
+        dependencies. Only a block of _rrdep_block_size target packages is
+        handled at a time to bound the size of the bitsets.
+        """
+        self._compute_package_states()  # populate _package_state
+        rdeps = self._get_rdep_dict()
+        graph = {}
+        for pkg_name in self.get_all_package_names():
+            graph[pkg_name] = list(rdeps.get(pkg_name, []))
+
+        sccs = strongly_connected_components(graph)
+        order = [pkg_name for scc in sccs for pkg_name in scc]
+        position = dict([(pkg_name, i) for i, pkg_name in enumerate(order)])
+        successors = [[position[x] for x in graph[pkg_name]] for pkg_name in order]
+        ranges = []
+        for scc in sccs:
+            lo = ranges[-1][1] if ranges else 0
+            ranges.append((lo, lo + len(scc)))
+
+        error_states = self.get_error_states()
+        waiting_states = self.get_waiting_states()
+        is_error = [self._package_state[x] in error_states for x in order]
+        is_waiting = [self._package_state[x] in waiting_states for x in order]
+
+        count = len(order)
+        rrdep_cnt = [0] * count
+        block_cnt = [0] * count
+        waiting_cnt = [0] * count
+        chain_len = [1] * count
+        no_levels = [0]
+        for start in xrange(0, count, self._rrdep_block_size):
+            end = min(start + self._rrdep_block_size, count)
+            error_mask = 0
+            waiting_mask = 0
+            for i in xrange(start, end):
+                if is_error[i]:
+                    error_mask |= 1 << (i - start)
+                if is_waiting[i]:
+                    waiting_mask |= 1 << (i - start)
+            reach = [0] * count
+            levels = [no_levels] * count
+            for (lo, hi) in ranges:
+                if hi <= start:
+                    # successors precede, nothing of the block is reachable
+                    continue
+                own = [1 << (i - start) if start <= i < end else 0
+                       for i in xrange(lo, hi)]
+                bits = 0
+                for i in xrange(lo, hi):
+                    bits |= own[i - lo]
+                    for j in successors[i]:
+                        if j < lo:
+                            bits |= reach[j]
+                if not bits:
+                    continue
+                if hi - lo == 1 and lo not in successors[lo]:
+                    reach[lo] = bits
+                    levels[lo] = merge_levels(own[0], bits,
+                                              [levels[j] for j in successors[lo]])
+                    growing = []
+                else:
+                    growing = []
+                    for i in xrange(lo, hi):
+                        reach[i] = bits
+                        levels[i] = [own[i - lo]]
+                        if own[i - lo] != bits:
+                            growing.append(i)
+                # dependency cycle: compute the levels of all members in lockstep
+                d = 0
+                while growing:
+                    d += 1
+                    new_levels = []
+                    for i in growing:
+                        level = levels[i][-1]
+                        for j in successors[i]:
+                            level |= levels[j][min(d - 1, len(levels[j]) - 1)]
+                        new_levels.append(level)
+                    still_growing = []
+                    for i, level in zip(growing, new_levels):
+                        levels[i].append(level)
+                        if level != bits:
+                            still_growing.append(i)
+                    growing = still_growing
+                for i in xrange(lo, hi):
+                    rrdep_cnt[i] += popcount(bits)
+                    if is_error[i]:
+                        block_cnt[i] += popcount(bits & error_mask)
+                    if is_waiting[i]:
+                        waiting_cnt[i] += popcount(bits & waiting_mask)
+                    chain_len[i] = max(chain_len[i], len(levels[i]))
+
+        for i, pkg_name in enumerate(order):
+            pkg = self._packages[pkg_name]
+            # the package itself was counted, too
+            pkg.rrdep_cnt = rrdep_cnt[i] - 1
+            pkg.block_cnt = block_cnt[i] - 1 if is_error[i] else 0
+            pkg.waiting_cnt = waiting_cnt[i] - 1 if is_waiting[i] else 0
+            pkg.rdep_chain_len = chain_len[i]
+        self._all_rrdep_counts_done = True
+        self._checkpoint_changed = True
+
     def _calc_rrdep_pkg_counts(self, pkg):
 
+        if not self._all_rrdep_counts_done:
+            start = time.time()
+            self._calc_all_rrdep_pkg_counts()
+            self._observe_phase("rdep-metrics", start)
+            if pkg.rrdep_cnt is not None:
+                return
+
+        # fallback for packages whose metrics were reset afterwards
         pkg_name = pkg['Package']
         self._compute_package_states()  # populate _package_state
 
@@ -984,6 +2042,31 @@ class PackagesDB:
 
         pkg.rdep_chain_len = chain_len
 
+    def _reset_rrdep_pkg_counts(self, package_names, old_deps={}):
+        """Forget the metrics of the given packages and of all packages
+           having them as (transitive) reverse dependencies
+
+           Returns the names of the packages that were reset."""
+        done = set()
+        more = list(package_names)
+        while more:
+            pkg_name = more.pop()
+            if pkg_name in done:
+                continue
+            done.add(pkg_name)
+            pkg = self._packages.get(pkg_name)
+            if pkg is None:
+                continue
+            pkg.rrdep_cnt = None
+            pkg.block_cnt = None
+            pkg.waiting_cnt = None
+            pkg.rdep_chain_len = None
+            for dep in pkg.dependencies() + old_deps.get(pkg_name, []):
+                dep_pkg = self.get_package(dep, resolve_virtual=True)
+                if dep_pkg is not None:
+                    more.append(dep_pkg["Package"])
+        return [x for x in done if x in self._packages]
+
     def block_count(self, name):
         pkg = self.get_package(name)
         if pkg is None:
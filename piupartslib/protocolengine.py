@@ -0,0 +1,406 @@
+# -*- coding: utf-8 -*-
+
+# This file is part of Piuparts
+#
+# Piuparts is free software; you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation; either version 2 of the License, or (at your
+# option) any later version.
+#
+# Piuparts is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General
+# Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, see <http://www.gnu.org/licenses/>.
+
+
+"""Event driven engine for the line based master/slave protocol
+
+A single asyncore loop reads the commands and their data (long parts or a
+given number of bytes) from all connections and writes the responses.
+Slow uploads therefore only occupy a buffer. The commands themselves are
+processed by a session object per connection in a pool of worker threads,
+so that commands which take long (e.g. loading the package database of a
+section) don't block the other connections.
+
+A session is created by factory(output) and provides
+
+  get_data_format(command, args)
+      called in the event loop, checks the command and returns None if no
+      data follows it, "long" for a long part or the number of bytes
+  run_command(command, args, data)
+      called in a worker thread, writes the response to output
+  close()
+      called in a worker thread after the connection was closed by the
+      client, an empty line or an error
+
+At most one command of a session runs at a time.
+"""
+
+
+import Queue
+import asyncore
+import errno
+import logging
+import socket
+import sys
+import threading
+
+
+class ProtocolError(Exception):
+
+    def __init__(self, msg="EOF, missing space in long part, or other protocol error"):
+        self.args = msg,
+
+
+class _Trigger(asyncore.dispatcher):
+
+    """Run callbacks from other threads in the event loop"""
+
+    def __init__(self, map):
+        (reader, self._writer) = socket.socketpair()
+        asyncore.dispatcher.__init__(self, reader, map=map)
+        self._writer.setblocking(0)
+        self._lock = threading.Lock()
+        self._callbacks = []
+
+    def call_soon(self, callback, *args):
+        with self._lock:
+            self._callbacks.append((callback, args))
+        try:
+            self._writer.send("x")
+        except socket.error:
+            pass  # the buffer is full, the loop will wake up anyway
+
+    def writable(self):
+        return False
+
+    def handle_read(self):
+        try:
+            self.recv(4096)
+        except socket.error:
+            pass
+        with self._lock:
+            (callbacks, self._callbacks) = (self._callbacks, [])
+        for (callback, args) in callbacks:
+            try:
+                callback(*args)
+            except:
+                logging.exception("unexpected error in the event loop")
+
+    def close(self):
+        asyncore.dispatcher.close(self)
+        self._writer.close()
+
+
+class _Output:
+
+    """File-like object passed to the sessions, may be used from any thread"""
+
+    def __init__(self, engine, channel):
+        self._engine = engine
+        self._channel = channel
+        self._data = []
+
+    def write(self, data):
+        self._data.append(data)
+
+    def flush(self):
+        if self._data:
+            data = "".join(self._data)
+            self._data = []
+            self._engine.call_soon(self._channel.push, data)
+
+
+class _Channel(asyncore.dispatcher):
+
+    _max_buffer = 1 << 16
+
+    def __init__(self, engine, sock, factory):
+        asyncore.dispatcher.__init__(self, sock, map=engine._map)
+        self._engine = engine
+        # the received data, parsed up to _inpos
+        self._inbuf = ""
+        self._inpos = 0
+        self._outbuf = ""
+        self._session = None
+        self._busy = True
+        self._eof = False
+        self._finished = False
+        self._closing = False
+        self._command = None
+        self._format = None
+        self._data = []
+        self._size = 0
+        engine.run_in_thread(self._session_created, factory, _Output(engine, self))
+
+    def readable(self):
+        return not self._eof and not self._finished and \
+            (not self._busy or len(self._inbuf) - self._inpos < self._max_buffer)
+
+    def writable(self):
+        return len(self._outbuf) > 0
+
+    def push(self, data):
+        if self._fileno is not None:
+            self._outbuf += data
+
+    def handle_read(self):
+        data = self.recv(self._max_buffer)
+        if data:
+            if self._inpos < len(self._inbuf):
+                # usually just an incomplete line
+                self._inbuf = self._inbuf[self._inpos:] + data
+            else:
+                self._inbuf = data
+            self._inpos = 0
+            self._parse()
+
+    def handle_write(self):
+        try:
+            sent = self.socket.send(self._outbuf)
+        except socket.error as e:
+            if e.args[0] in (errno.EWOULDBLOCK, errno.EAGAIN, errno.EINTR):
+                return
+            # the client is gone
+            self._outbuf = ""
+            self._eof = True
+            self._finish()
+            return
+        self._outbuf = self._outbuf[sent:]
+        if self._closing and not self._outbuf:
+            self.close()
+
+    def handle_close(self):
+        self._eof = True
+        self._parse()
+
+    def handle_error(self):
+        logging.exception("ABORT: unexpected error")
+        self._outbuf = ""
+        self._eof = True
+        self._finish()
+
+    def _report(self, exc_info):
+        if isinstance(exc_info[1], self._engine._expected_errors):
+            logging.error("ABORT: %s" % exc_info[1])
+        else:
+            logging.error("ABORT: unexpected error", exc_info=exc_info)
+
+    def _session_created(self, session, exc_info):
+        self._busy = False
+        if exc_info is not None:
+            self._report(exc_info)
+            self._finish()
+            return
+        self._session = session
+        if self._finished:
+            self._finish()
+        else:
+            self._parse()
+
+    def _command_done(self, result, exc_info):
+        self._busy = False
+        if exc_info is not None:
+            self._report(exc_info)
+            self._finish()
+        elif self._finished:
+            self._finish()
+        else:
+            self._parse()
+
+    def _abort(self, error):
+        self._report((type(error), error, None))
+        self._finish()
+
+    def _next_line(self):
+        i = self._inbuf.find("\n", self._inpos)
+        if i < 0:
+            return None
+        line = self._inbuf[self._inpos:i + 1]
+        self._inpos = i + 1
+        return line
+
+    def _parse(self):
+        while not self._busy and not self._finished:
+            if self._format is None:
+                line = self._next_line()
+                if line is None:
+                    break
+                logging.debug(">> " + line.rstrip())
+                parts = line.split()
+                if not parts:
+                    self._finish()
+                    break
+                self._command = (parts[0], parts[1:])
+                try:
+                    self._format = self._session.get_data_format(*self._command)
+                except:
+                    self._report(sys.exc_info())
+                    self._finish()
+                    break
+                if self._format is None:
+                    self._dispatch(None)
+            elif self._format == "long":
+                line = self._next_line()
+                if line is None:
+                    break
+                if line == ".\n":
+                    data = "".join(self._data)
+                    self._data = []
+                    self._dispatch(data)
+                elif line[0] != " ":
+                    self._abort(ProtocolError())
+                else:
+                    self._data.append(line[1:])
+            else:
+                # collect the received chunks, joined once complete
+                chunk = self._inbuf[self._inpos:self._inpos + self._format - self._size]
+                if chunk:
+                    self._data.append(chunk)
+                    self._size += len(chunk)
+                    self._inpos += len(chunk)
+                if self._size < self._format:
+                    break
+                data = "".join(self._data)
+                self._data = []
+                self._size = 0
+                logging.debug(">> (%d bytes of data)" % len(data))
+                self._dispatch(data)
+        if self._eof and not self._busy and not self._finished:
+            if self._format is not None:
+                self._abort(ProtocolError())
+            else:
+                self._finish()
+
+    def _dispatch(self, data):
+        (command, args) = self._command
+        self._format = None
+        self._busy = True
+        self._engine.run_in_thread(self._command_done,
+                                   self._session.run_command, command, args, data)
+
+    def _finish(self):
+        """Stop reading and close the session, the connection is closed
+           once all output has been sent"""
+        self._finished = True
+        self._inbuf = ""
+        self._inpos = 0
+        if self._busy or self._closing:
+            return
+        self._busy = True
+        if self._session is None:
+            self._session_closed(None, None)
+        else:
+            self._engine.run_in_thread(self._session_closed, self._session.close)
+
+    def _session_closed(self, result, exc_info):
+        if exc_info is not None:
+            self._report(exc_info)
+        self._closing = True
+        if not self._outbuf:
+            self.close()
+
+
+class _Listener(asyncore.dispatcher):
+
+    def __init__(self, engine, sock, factory):
+        asyncore.dispatcher.__init__(self, sock, map=engine._map)
+        self.accepting = True
+        self._engine = engine
+        self._factory = factory
+
+    def writable(self):
+        return False
+
+    def handle_accept(self):
+        pair = self.accept()
+        if pair is not None:
+            _Channel(self._engine, pair[0], self._factory)
+
+    def handle_error(self):
+        logging.exception("accepting a connection failed")
+
+
+class ProtocolEngine:
+
+    """Serve many protocol sessions in one event loop
+
+    Exceptions of the sessions that are instances of expected_errors are
+    logged as "ABORT: <error>" and close the connection, others are logged
+    with a traceback.
+    """
+
+    def __init__(self, expected_errors=(), max_threads=32):
+        self._map = {}
+        self._trigger = _Trigger(self._map)
+        self._expected_errors = (ProtocolError,) + tuple(expected_errors)
+        self._running = False
+        # the pool of worker threads, started on demand
+        self._tasks = Queue.Queue()
+        self._pool_lock = threading.Lock()
+        self._max_threads = max_threads
+        self._threads = 0
+        self._idle = 0
+        self._pending = 0
+
+    def call_soon(self, callback, *args):
+        """Run callback(*args) in the event loop, may be used from any thread"""
+        self._trigger.call_soon(callback, *args)
+
+    def run_in_thread(self, callback, func, *args):
+        """Run func(*args) in a worker thread, then callback(result, exc_info)
+           in the event loop
+
+        At most max_threads workers are started, further calls wait until
+        one of them is done.
+        """
+        with self._pool_lock:
+            self._tasks.put((callback, func, args))
+            self._pending += 1
+            if self._pending > self._idle and self._threads < self._max_threads:
+                self._threads += 1
+                thread = threading.Thread(target=self._worker)
+                thread.daemon = True
+                thread.start()
+
+    def _worker(self):
+        while True:
+            with self._pool_lock:
+                self._idle += 1
+            (callback, func, args) = self._tasks.get()
+            with self._pool_lock:
+                self._idle -= 1
+                self._pending -= 1
+            try:
+                result = func(*args)
+            except:
+                self.call_soon(callback, None, sys.exc_info())
+            else:
+                self.call_soon(callback, result, None)
+
+    def add_connection(self, sock, factory):
+        """Serve a connected socket, may be used from any thread"""
+        self.call_soon(_Channel, self, sock, factory)
+
+    def listen(self, sock, factory):
+        """Serve all connections accepted on a listening socket"""
+        self.call_soon(_Listener, self, sock, factory)
+
+    def serve_forever(self, timeout=30.0):
+        self._running = True
+        while self._running:
+            asyncore.loop(timeout=timeout, use_poll=True, map=self._map, count=1)
+
+    def stop(self):
+        """Let serve_forever() return, may be used from any thread"""
+        self.call_soon(setattr, self, "_running", False)
+
+    def close(self):
+        for dispatcher in self._map.values():
+            dispatcher.close()
+
+
+# vi:set et ts=4 sw=4 :
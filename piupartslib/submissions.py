@@ -0,0 +1,251 @@
+# -*- coding: utf-8 -*-
+
+# This file is part of Piuparts
+#
+# Piuparts is free software; you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation; either version 2 of the License, or (at your
+# option) any later version.
+#
+# Piuparts is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General
+# Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, see <http://www.gnu.org/licenses/>.
+
+
+"""Journal of the logs submitted to a section (submissions.txt)
+
+Each line records one submission:
+
+  TIMESTAMP RESULT PACKAGE VERSION SLAVE DURATION SIZE
+
+SLAVE is the host the log was submitted from, DURATION the runtime of the
+test in seconds (taken from the log) and SIZE the size of the log in bytes,
+"-" if unknown. The first four fields are the format used by earlier
+versions, such lines are still accepted.
+
+Records are buffered and appended in batches under a lock of the journal
+file. A sparse index (submissions.txt.idx) maps offsets in the journal to
+the time they were written, so that the submissions since a given time
+can be read without scanning the whole history.
+"""
+
+
+import fcntl
+import os
+import re
+import threading
+import time
+from collections import namedtuple
+
+
+Submission = namedtuple("Submission", ["timestamp", "result", "package", "version",
+                                       "slave", "duration", "size"])
+
+# the elapsed time prefix of the lines of a piuparts log
+_elapsed_re = re.compile(r"^(\d+)m(\d+(?:\.\d+)?)s ")
+
+
+def get_log_duration(log):
+    """Return the runtime (in seconds) of a piuparts log or None"""
+    lines = log.rstrip("\n").rsplit("\n", 1)
+    m = _elapsed_re.match(lines[-1])
+    if m is None:
+        return None
+    return int(m.group(1)) * 60 + int(float(m.group(2)))
+
+
+def _format_field(value):
+    if value is None:
+        return "-"
+    return str(value)
+
+
+def _parse_int(value):
+    if value == "-":
+        return None
+    return int(value)
+
+
+def format_submission(s):
+    return "%d %s %s %s %s %s %s\n" % (s.timestamp, s.result, s.package, s.version,
+                                       _format_field(s.slave), _format_field(s.duration),
+                                       _format_field(s.size))
+
+
+def parse_submission(line):
+    """Parse a line in the current or old format, returns None if invalid"""
+    fields = line.split()
+    if len(fields) == 4:
+        fields.extend(["-", "-", "-"])
+    if len(fields) != 7:
+        return None
+    try:
+        return Submission(int(fields[0]), fields[1], fields[2], fields[3],
+                          None if fields[4] == "-" else fields[4],
+                          _parse_int(fields[5]), _parse_int(fields[6]))
+    except ValueError:
+        return None
+
+
+class SubmissionsJournal:
+
+    def __init__(self, filename, flush_count=100, flush_interval=60, fsync=True,
+                 index_interval=1 << 16):
+        self._filename = filename
+        self._index_filename = filename + ".idx"
+        self._flush_count = flush_count
+        self._flush_interval = flush_interval
+        self._fsync = fsync
+        self._index_interval = index_interval
+        self._lock = threading.Lock()
+        self._pending = []
+        self._pending_since = None
+
+    def record(self, result, package, version, slave=None, duration=None, size=None):
+        """Add a submission, written by the next flush()
+
+        The pending records are flushed if there are flush_count of them or
+        the oldest is older than flush_interval seconds.
+        """
+        now = time.time()
+        with self._lock:
+            if not self._pending:
+                self._pending_since = now
+            self._pending.append(Submission(int(now), result, package, version,
+                                            slave, duration, size))
+            if len(self._pending) < self._flush_count and \
+                    now - self._pending_since < self._flush_interval:
+                return
+        self.flush()
+
+    def flush(self):
+        """Append the pending records to the journal"""
+        with self._lock:
+            if not self._pending:
+                return
+            with self._open_locked() as f:
+                f.seek(0, os.SEEK_END)
+                self._update_index(f.tell())
+                f.write("".join([format_submission(s) for s in self._pending]))
+                f.flush()
+                if self._fsync:
+                    os.fsync(f.fileno())
+            self._pending = []
+
+    def _open_locked(self):
+        """Open the journal for appending and lock it"""
+        while True:
+            f = open(self._filename, "a")
+            fcntl.flock(f, fcntl.LOCK_EX)
+            # retry if convert() replaced the file while we were waiting
+            if os.path.exists(self._filename) and \
+                    os.path.samestat(os.fstat(f.fileno()), os.stat(self._filename)):
+                return f
+            f.close()
+
+    def _read_index(self, size):
+        """Return the (time, offset) entries of the index that are valid
+           for a journal of the given size"""
+        index = []
+        try:
+            with open(self._index_filename) as f:
+                for line in f:
+                    fields = line.split()
+                    if len(fields) != 2 or not fields[1].isdigit():
+                        break
+                    (timestamp, offset) = (int(fields[0]), int(fields[1]))
+                    if offset > size or (index and offset <= index[-1][1]):
+                        # the journal was truncated or replaced
+                        return []
+                    index.append((timestamp, offset))
+        except IOError:
+            pass
+        return index
+
+    def _update_index(self, size):
+        """Add an index entry for the current end of the journal, must be
+           called with the journal locked"""
+        index = self._read_index(size)
+        last = index[-1][1] if index else 0
+        if size - last < self._index_interval:
+            return
+        # all records before this offset were written by now
+        entry = "%d %d\n" % (time.time(), size)
+        if index:
+            with open(self._index_filename, "a") as f:
+                f.write(entry)
+        else:
+            self._write_index([entry])
+
+    def _write_index(self, entries):
+        temp_name = self._index_filename + ".tmp"
+        with open(temp_name, "w") as f:
+            f.write("".join(entries))
+        os.rename(temp_name, self._index_filename)
+
+    def since(self, timestamp):
+        """Yield the flushed submissions recorded at or after timestamp"""
+        if not os.path.exists(self._filename):
+            return
+        with open(self._filename) as f:
+            offset = 0
+            for (written, entry_offset) in self._read_index(os.fstat(f.fileno()).st_size):
+                if written >= timestamp:
+                    break
+                offset = entry_offset
+            f.seek(offset)
+            for line in f:
+                if not line.endswith("\n"):
+                    break  # still being written
+                s = parse_submission(line)
+                if s is not None and s.timestamp >= timestamp:
+                    yield s
+
+    def throughput(self, since, until=None):
+        """Return {hour: number of submissions} for the hours (as
+           timestamps) from since until until (or now)"""
+        hours = {}
+        for s in self.since(since):
+            if until is not None and s.timestamp >= until:
+                continue
+            hour = s.timestamp - s.timestamp % 3600
+            hours[hour] = hours.get(hour, 0) + 1
+        return hours
+
+    def convert(self):
+        """Rewrite the journal (e.g. in the old format) in the current
+           format and rebuild its index, returns the number of records"""
+        count = 0
+        if not os.path.exists(self._filename):
+            return count
+        temp_name = self._filename + ".tmp"
+        with self._open_locked() as lock:
+            index = []
+            with open(self._filename) as old:
+                with open(temp_name, "w") as new:
+                    (last, latest) = (0, 0)
+                    for line in old:
+                        s = parse_submission(line)
+                        if s is None:
+                            continue
+                        if new.tell() - last >= self._index_interval:
+                            last = new.tell()
+                            # the old records are not necessarily ordered
+                            index.append("%d %d\n" % (latest, last))
+                        latest = max(latest, s.timestamp)
+                        new.write(format_submission(s))
+                        count += 1
+                    new.flush()
+                    os.fsync(new.fileno())
+            if os.path.exists(self._index_filename):
+                os.remove(self._index_filename)
+            os.rename(temp_name, self._filename)
+            self._write_index(index)
+        return count
+
+
+# vi:set et ts=4 sw=4 :
@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+
+# This file is part of Piuparts
+#
+# Piuparts is free software; you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation; either version 2 of the License, or (at your
+# option) any later version.
+#
+# Piuparts is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General
+# Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, see <http://www.gnu.org/licenses/>.
+
+
+"""Memoized comparison of Debian version numbers
+
+version_compare() is apt_pkg.version_compare() with a cache for repeated
+pairs of versions. version_key() returns a key for sorting versions
+without a cmp function, e.g. sorted(versions, key=version_key).
+"""
+
+
+import apt_pkg
+
+apt_pkg.init_system()
+
+
+# limit the memory used by the caches
+_max_cache_size = 200000
+
+_compare_cache = {}
+_key_cache = {}
+
+
+def version_compare(a, b):
+    """Return a value < 0, 0 or > 0 if version a is lower than, equal to
+       or greater than version b"""
+    try:
+        return _compare_cache[(a, b)]
+    except KeyError:
+        pass
+    if len(_compare_cache) >= _max_cache_size:
+        _compare_cache.clear()
+    result = apt_pkg.version_compare(a, b)
+    _compare_cache[(a, b)] = result
+    return result
+
+
+def _char_order(c):
+    # dpkg's order for the non-digit parts of a version
+    if c.isalpha():
+        return ord(c)
+    if c == "~":
+        return -1
+    return ord(c) + 256
+
+
+# appended to the parts, sorts before everything but "~"
+_end_of_parts = (((0,),),)
+
+
+def _part_key(s):
+    """Return a sortable key for an upstream version or debian revision
+
+    The string is split into alternating non-digit and digit parts. The
+    non-digit parts compare character-wise in dpkg's order, with the end
+    of the part sorting after "~" but before anything else, the digit
+    parts compare numerically.
+    """
+    parts = []
+    i = 0
+    while i < len(s):
+        j = i
+        while j < len(s) and not s[j].isdigit():
+            j += 1
+        k = j
+        while k < len(s) and s[k].isdigit():
+            k += 1
+        parts.append((tuple([_char_order(c) for c in s[i:j]]) + (0,), int(s[j:k] or 0)))
+        i = k
+    # "", "0", "00" are equal
+    if parts == [((0,), 0)]:
+        parts = []
+    return tuple(parts) + _end_of_parts
+
+
+def version_key(version):
+    """Return a key that sorts versions like version_compare()"""
+    try:
+        return _key_cache[version]
+    except KeyError:
+        pass
+    if len(_key_cache) >= _max_cache_size:
+        _key_cache.clear()
+    epoch = 0
+    rest = version
+    if ":" in rest:
+        e, r = rest.split(":", 1)
+        if e.isdigit():
+            epoch, rest = int(e), r
+    if "-" in rest:
+        upstream, revision = rest.rsplit("-", 1)
+    else:
+        upstream, revision = rest, ""
+    key = (epoch, _part_key(upstream), _part_key(revision))
+    _key_cache[version] = key
+    return key
+
+
+# vi:set et ts=4 sw=4 :
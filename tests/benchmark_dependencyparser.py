@@ -0,0 +1,76 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""Benchmark parsing the dependency fields of a full Packages file
+
+Usage: benchmark_dependencyparser.py PACKAGES_FILE
+
+PACKAGES_FILE may be compressed (.gz, .bz2, .xz), e.g.
+/var/lib/apt/lists/deb.debian.org_debian_dists_sid_main_binary-amd64_Packages.
+Reports the time needed by the cursor based DependencyParser, by its fast
+path and by the memoized parse_dependency_names() used by Package.
+"""
+
+
+import sys
+import time
+
+import piupartslib
+import piupartslib.dependencyparser as dependencyparser
+import piupartslib.packagesdb as packagesdb
+
+
+FIELDS = ["Depends", "Pre-Depends", "Provides"]
+
+
+def read_fields(filename):
+    ext = ""
+    for suffix in (".gz", ".bz2", ".xz"):
+        if filename.endswith(suffix):
+            ext = suffix
+    stream = piupartslib.decompress_packages_stream(ext, open(filename, "rb"))
+    pf = packagesdb.PackagesFile()
+    pf._read_stream(stream)
+    values = []
+    for p in pf.values():
+        for field in FIELDS:
+            if field in p:
+                values.append(p[field])
+    return values
+
+
+def cursor_parser(value):
+    parser = dependencyparser.DependencyParser("")
+    parser._cursor = dependencyparser._Cursor(value)
+    return parser._parse_dependencies()
+
+
+def fast_path(value):
+    return dependencyparser.DependencyParser(value).get_dependencies()
+
+
+def memoized(value):
+    return packagesdb.parse_dependency_names(value)
+
+
+def benchmark(name, function, values):
+    start = time.time()
+    for value in values:
+        function(value)
+    print "%-20s %8.3f s" % (name, time.time() - start)
+
+
+def main():
+    if len(sys.argv) != 2:
+        sys.exit(__doc__)
+    values = read_fields(sys.argv[1])
+    print "%d fields, %d distinct" % (len(values), len(set(values)))
+    benchmark("cursor parser", cursor_parser, values)
+    benchmark("fast path", fast_path, values)
+    benchmark("memoized", memoized, values)
+
+
+if __name__ == "__main__":
+    main()
+
+# vi:set et ts=4 sw=4 :
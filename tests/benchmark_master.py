@@ -0,0 +1,458 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""Benchmark piuparts-master-backend with synthetic slaves
+
+Usage: benchmark_master.py [options]
+
+Creates a temporary master directory with a section "bench" whose Packages
+file (generated, or a recorded one given with --packages-file) is served
+by a local HTTP server. Then starts N fake slaves that speak the real
+protocol with piuparts-master-backend: every slave session submits the
+logs of the previous reservations and reserves new packages, whose
+"tests" just sleep for the simulated test duration.
+
+The master is run once per session, like a slave does via ssh, or with
+--daemon as a long-running daemon listening on a Unix socket. Reports the
+reservations and submissions per second, the connect, reserve and submit
+latencies, the number of sessions refused because the section was busy
+(lock contention) and the time the master spent waiting for the
+master.lock and computing the package states (from its metrics).
+
+Must be run with piupartslib in the PYTHONPATH, e.g. from the top
+directory of the source tree with PYTHONPATH=. (python-apt is needed).
+"""
+
+
+import argparse
+import BaseHTTPServer
+import SimpleHTTPServer
+import gzip
+import hashlib
+import imp
+import os
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import zlib
+
+import piupartslib
+
+
+SECTION = "bench"
+
+MASTER_BACKEND = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                              "..", "piuparts-master-backend.py")
+
+# summaries from the master's metrics included in the report
+MASTER_METRICS = [
+    "piuparts_master_lock_wait_seconds",
+    "piuparts_master_init_db_seconds",
+    "piuparts_packagesdb_phase_seconds",
+]
+
+
+def generate_packages(count, seed):
+    """Return a Packages file with count packages depending on packages
+       with lower numbers"""
+    rnd = random.Random(seed)
+    stanzas = []
+    for i in range(count):
+        depends = []
+        for j in range(rnd.randint(0, min(i, 4))):
+            alternatives = ["pkg%06d" % rnd.randrange(i)]
+            if rnd.random() < 0.1:
+                alternatives.append("pkg%06d" % rnd.randrange(i))
+            depends.append(" | ".join(alternatives))
+        stanza = "Package: pkg%06d\nVersion: 1.%d-1\nArchitecture: amd64\n" % (i, rnd.randrange(10))
+        if depends:
+            stanza += "Depends: %s\n" % ", ".join(depends)
+        stanzas.append(stanza)
+    return "\n".join(stanzas)
+
+
+def read_packages_file(filename):
+    ext = ""
+    for suffix in (".gz", ".bz2", ".xz"):
+        if filename.endswith(suffix):
+            ext = suffix
+    return piupartslib.decompress_packages_stream(ext, open(filename, "rb")).read()
+
+
+class MirrorHandler(SimpleHTTPServer.SimpleHTTPRequestHandler):
+
+    def translate_path(self, path):
+        return os.path.join(self.server.mirror, path.split("?")[0].lstrip("/"))
+
+    def log_message(self, *args):
+        pass
+
+
+def start_mirror(mirror, packages):
+    dirname = os.path.join(mirror, "dists", "sid", "main", "binary-amd64")
+    os.makedirs(dirname)
+    f = gzip.open(os.path.join(dirname, "Packages.gz"), "wb")
+    f.write(packages)
+    f.close()
+    httpd = BaseHTTPServer.HTTPServer(("127.0.0.1", 0), MirrorHandler)
+    httpd.mirror = mirror
+    thread = threading.Thread(target=httpd.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return "http://127.0.0.1:%d" % httpd.server_port
+
+
+def write_config(filename, master_directory, mirror, daemon):
+    with open(filename, "w") as f:
+        f.write("[global]\n")
+        f.write("sections = %s\n" % SECTION)
+        f.write("master-directory = %s\n" % master_directory)
+        f.write("mirror = %s\n" % mirror)
+        if daemon:
+            f.write("master-socket = master.sock\n")
+        f.write("\n[%s]\n" % SECTION)
+        f.write("distro = sid\narea = main\narch = amd64\n")
+
+
+def run_master(config_file, daemon):
+    """Run piuparts-master-backend with our configuration file"""
+    backend = imp.load_source("piuparts_master_backend", MASTER_BACKEND)
+    backend.CONFIG_FILE = config_file
+    backend.DISTRO_CONFIG_FILE = os.devnull
+    sys.argv = [MASTER_BACKEND] + (["--daemon"] if daemon else [])
+    backend.main()
+
+
+class Connection:
+
+    def __init__(self, bench):
+        if bench.args.daemon:
+            self._process = None
+            self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self._sock.connect(bench.socket_path)
+            self._input = self._sock.makefile("r")
+            self._output = self._sock.makefile("w")
+        else:
+            self._sock = None
+            self._process = subprocess.Popen(bench.master_command,
+                                             stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+            self._input = self._process.stdout
+            self._output = self._process.stdin
+
+    def readline(self):
+        line = self._input.readline()
+        if not line:
+            raise EOFError("connection closed by the master")
+        return line.rstrip("\n")
+
+    def read_long_part(self):
+        lines = []
+        while True:
+            line = self.readline()
+            if line == ".":
+                return lines
+            lines.append(line[1:])
+
+    def write(self, data):
+        self._output.write(data)
+        self._output.flush()
+
+    def command(self, line, data=""):
+        self.write(line + "\n" + data)
+        return self.readline()
+
+    def close(self):
+        self._output.close()
+        self._input.close()
+        if self._sock is not None:
+            self._sock.close()
+        if self._process is not None:
+            self._process.wait()
+
+
+class Statistics:
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.latencies = {"connect": [], "reserve": [], "submit": []}
+        self.counts = {"reserved": 0, "submitted": 0, "busy": 0}
+        self.master_metrics = {}
+
+    def add_latency(self, name, seconds):
+        with self._lock:
+            self.latencies[name].append(seconds)
+
+    def add_count(self, name, count=1):
+        with self._lock:
+            self.counts[name] += count
+
+    def add_master_metrics(self, lines):
+        """Sum up the summaries of interest from the _metrics output"""
+        with self._lock:
+            for line in lines:
+                if line.startswith("#"):
+                    continue
+                (key, value) = line.rsplit(" ", 1)
+                for name in MASTER_METRICS:
+                    if key.startswith(name + "_"):
+                        (kind, labels) = key[len(name) + 1:].split("{", 1)
+                        phase = [x for x in labels.rstrip("}").split(",") if x.startswith("phase=")]
+                        summary = self.master_metrics.setdefault(
+                            (name, phase[0][7:-1] if phase else ""), {"count": 0, "sum": 0, "max": 0})
+                        if kind == "max":
+                            summary[kind] = max(summary[kind], float(value))
+                        else:
+                            summary[kind] += float(value)
+
+
+class FakeSlave(threading.Thread):
+
+    def __init__(self, bench, number):
+        threading.Thread.__init__(self, name="slave%d" % number)
+        self.daemon = True
+        self._bench = bench
+        self._args = bench.args
+        self._random = random.Random(number)
+        self._results = []
+
+    def run(self):
+        try:
+            while True:
+                reserved = self._session()
+                if reserved is None:
+                    time.sleep(0.1)  # section busy
+                    continue
+                if time.time() > self._bench.deadline:
+                    break
+                if not reserved:
+                    if self._bench.outstanding() == 0:
+                        break
+                    time.sleep(self._args.idle_wait)
+                for (package, version) in reserved:
+                    time.sleep(self._args.test_duration * self._random.uniform(0.5, 1.5))
+                    result = "fail" if self._random.random() < self._args.fail_rate else "pass"
+                    self._results.append((result, package, version))
+            if self._results:
+                while self._session(reserve=False) is None:
+                    time.sleep(0.1)
+        except:
+            self._bench.error = sys.exc_info()
+            raise
+
+    def _session(self, reserve=True):
+        """Submit the results and reserve new packages, returns the
+           reserved packages or None if the section was busy"""
+        start = time.time()
+        conn = Connection(self._bench)
+        try:
+            conn.readline()  # hello
+            version = 1
+            response = conn.command("hello 4")
+            if response.startswith("ok "):
+                version = int(response.split()[1])
+            response = conn.command("section %s" % SECTION)
+            if response == "busy":
+                self._bench.stats.add_count("busy")
+                return None
+            if response != "ok":
+                raise EOFError("section %s: %s" % (SECTION, response))
+            self._bench.stats.add_latency("connect", time.time() - start)
+
+            for (result, package, version_) in self._results:
+                self._submit(conn, version, result, package, version_)
+            self._bench.add_outstanding(-len(self._results))
+            self._results = []
+
+            reserved = []
+            if reserve and time.time() < self._bench.deadline:
+                start = time.time()
+                if version >= 2 and self._args.reserve_count > 1:
+                    if conn.command("reserve %d" % self._args.reserve_count) == "ok":
+                        reserved = [tuple(line.split()) for line in conn.read_long_part()]
+                else:
+                    response = conn.command("reserve")
+                    if response.startswith("ok "):
+                        reserved = [tuple(response.split()[1:])]
+                self._bench.stats.add_latency("reserve", time.time() - start)
+                self._bench.stats.add_count("reserved", len(reserved))
+                self._bench.add_outstanding(len(reserved))
+
+            if not self._args.daemon:
+                conn.write("_metrics\n")
+                if conn.readline() == "ok":
+                    self._bench.stats.add_master_metrics(conn.read_long_part())
+            return reserved
+        finally:
+            conn.close()
+
+    def _submit(self, conn, version, result, package, package_version):
+        log = "".join(["%s %s: line %d of a simulated log\n" % (package, package_version, i)
+                       for i in range(self._args.log_size // 40 + 1)])
+        start = time.time()
+        if version >= 3 and self._args.compress:
+            data = zlib.compress(log)
+            response = conn.command("%s %s %s zlib %d %s" % (result, package, package_version, len(data),
+                                                             hashlib.sha256(log).hexdigest()), data)
+        else:
+            data = "".join([" " + line + "\n" for line in log.splitlines()]) + ".\n"
+            response = conn.command("%s %s %s" % (result, package, package_version), data)
+        if response != "ok":
+            raise EOFError("%s %s %s: %s" % (result, package, package_version, response))
+        self._bench.stats.add_latency("submit", time.time() - start)
+        self._bench.stats.add_count("submitted")
+
+
+class Benchmark:
+
+    def __init__(self, args):
+        self.args = args
+        self.stats = Statistics()
+        self.error = None
+        self._lock = threading.Lock()
+        self._outstanding = 0
+        self.deadline = None
+
+    def outstanding(self):
+        with self._lock:
+            return self._outstanding
+
+    def add_outstanding(self, count):
+        with self._lock:
+            self._outstanding += count
+
+    def setup(self, tmpdir):
+        if self.args.packages_file:
+            packages = read_packages_file(self.args.packages_file)
+        else:
+            packages = generate_packages(self.args.packages, self.args.seed)
+        mirror = start_mirror(os.path.join(tmpdir, "mirror"), packages)
+        master_directory = os.path.join(tmpdir, "master")
+        os.makedirs(master_directory)
+        config_file = os.path.join(tmpdir, "piuparts.conf")
+        write_config(config_file, master_directory, mirror, self.args.daemon)
+        self.master_command = [sys.executable, os.path.abspath(__file__),
+                               "--run-master", config_file]
+        self.socket_path = os.path.join(master_directory, "master.sock")
+
+    def start_daemon(self):
+        self._daemon = subprocess.Popen(self.master_command + ["--daemon"])
+        for i in range(300):
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                sock.connect(self.socket_path)
+            except socket.error:
+                time.sleep(0.1)
+            else:
+                return
+            finally:
+                sock.close()
+        raise EOFError("the master daemon did not start")
+
+    def stop_daemon(self):
+        conn = Connection(self)
+        try:
+            conn.readline()
+            conn.command("section %s" % SECTION)
+            conn.write("_metrics\n")
+            if conn.readline() == "ok":
+                self.stats.add_master_metrics(conn.read_long_part())
+        finally:
+            conn.close()
+            self._daemon.terminate()
+            self._daemon.wait()
+
+    def run(self):
+        if self.args.daemon:
+            self.start_daemon()
+        start = time.time()
+        self.deadline = start + self.args.time
+        slaves = [FakeSlave(self, i) for i in range(self.args.slaves)]
+        for slave in slaves:
+            slave.start()
+        for slave in slaves:
+            while slave.is_alive():
+                slave.join(1)
+        self.elapsed = time.time() - start
+        if self.args.daemon:
+            self.stop_daemon()
+        if self.error is not None:
+            raise self.error[0], self.error[1], self.error[2]
+
+    def report(self):
+        print "%s master, %d slaves, %.1f s" % (
+            "daemon" if self.args.daemon else "per-session", self.args.slaves, self.elapsed)
+        for name in ["reserved", "submitted"]:
+            count = self.stats.counts[name]
+            print "%-12s %8d %10.1f/s" % (name, count, count / self.elapsed)
+        print "%-12s %8d" % ("busy", self.stats.counts["busy"])
+        for name in ["connect", "reserve", "submit"]:
+            values = sorted(self.stats.latencies[name])
+            if not values:
+                continue
+            print "%-12s n=%-6d avg %7.3f s  50%% %7.3f s  95%% %7.3f s  max %7.3f s" % (
+                name + " latency", len(values), sum(values) / len(values),
+                values[len(values) // 2], values[int(len(values) * 0.95)], values[-1])
+        for (name, phase) in sorted(self.stats.master_metrics):
+            summary = self.stats.master_metrics[(name, phase)]
+            print "%-45s n=%-6d sum %7.3f s  max %7.3f s" % (
+                name + (" " + phase if phase else ""), summary["count"],
+                summary["sum"], summary["max"])
+
+
+def main():
+    if sys.argv[1:2] == ["--run-master"]:
+        run_master(sys.argv[2], "--daemon" in sys.argv[3:])
+        return
+
+    parser = argparse.ArgumentParser(
+        description="Benchmark piuparts-master-backend with synthetic slaves")
+    parser.add_argument("--slaves", type=int, default=10,
+                        help="number of fake slaves (default: %(default)s)")
+    parser.add_argument("--daemon", action="store_true",
+                        help="run the master as a daemon instead of once per session")
+    parser.add_argument("--packages", type=int, default=5000,
+                        help="number of generated packages (default: %(default)s)")
+    parser.add_argument("--packages-file", metavar="FILE",
+                        help="use a recorded (maybe compressed) Packages file")
+    parser.add_argument("--seed", type=int, default=0,
+                        help="seed for generating the packages (default: %(default)s)")
+    parser.add_argument("--time", type=float, default=60,
+                        help="stop reserving packages after SECONDS (default: %(default)s)")
+    parser.add_argument("--test-duration", type=float, default=0.5, metavar="SECONDS",
+                        help="average simulated test duration (default: %(default)s)")
+    parser.add_argument("--fail-rate", type=float, default=0.1,
+                        help="fraction of failing tests (default: %(default)s)")
+    parser.add_argument("--log-size", type=int, default=20000, metavar="BYTES",
+                        help="size of the submitted logs (default: %(default)s)")
+    parser.add_argument("--compress", action="store_true",
+                        help="submit zlib compressed logs (protocol version 3)")
+    parser.add_argument("--reserve-count", type=int, default=1,
+                        help="packages reserved per session (default: %(default)s)")
+    parser.add_argument("--idle-wait", type=float, default=1, metavar="SECONDS",
+                        help="wait before asking again if nothing is left (default: %(default)s)")
+    parser.add_argument("--keep", action="store_true",
+                        help="keep the temporary master directory")
+    args = parser.parse_args()
+
+    tmpdir = tempfile.mkdtemp(prefix="piuparts-benchmark.")
+    bench = Benchmark(args)
+    try:
+        bench.setup(tmpdir)
+        bench.run()
+        bench.report()
+    finally:
+        if args.keep:
+            print "kept %s" % tmpdir
+        else:
+            shutil.rmtree(tmpdir)
+
+
+if __name__ == "__main__":
+    main()
+
+# vi:set et ts=4 sw=4 :
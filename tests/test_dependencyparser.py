@@ -31,3 +31,16 @@ class DependencyParserTests(unittest.TestCase):
     def testAlternatives(self):
         deps, names = self.parse("foo, bar | foobar")
         self.failUnlessEqual(names, [["foo"], ["bar", "foobar"]])
+
+    def testFastPathIsEquivalent(self):
+        for str in ["libc6 (>= 2.14), libfoo1 (= 1:2.0-1+b1) | bar:any (<< 3~)",
+                    " foo ( < 1 ) ,bar(>>2)|baz ",
+                    "foo,", "foo | bar [amd64 i386], baz", "foo:amd64"]:
+            parser = piupartslib.dependencyparser.DependencyParser(str)
+            parser._cursor = piupartslib.dependencyparser._Cursor(str)
+            self.failUnlessEqual(repr(parser.get_dependencies()),
+                                 repr(parser._parse_dependencies()))
+
+    def testSyntaxError(self):
+        self.failUnlessRaises(piupartslib.dependencyparser.DependencySyntaxError,
+                              self.parse, "foo, (>= 1)")
@@ -0,0 +1,103 @@
+import unittest
+import os
+import shutil
+import tempfile
+import StringIO
+
+import piupartslib.logindex as logindex
+import piupartslib.packagesdb as packagesdb
+
+from test_packagesdb import PACKAGES
+
+
+class LogIndexTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.sectiondir = os.path.join(self.tmpdir, "sid")
+        for subdir in ("pass", "fail"):
+            os.makedirs(os.path.join(self.sectiondir, subdir))
+        self.write("pass", "pkg-a_1.log", mtime=1000)
+        self.write("pass", "pkg-b_1.log", mtime=2000)
+        self.write("fail", "pkg-c_1.log", mtime=1500)
+        self.write("fail", "pkg-c_1.kpr")
+        self.index = logindex.LogIndex(os.path.join(self.tmpdir, "logs.sqlite"))
+
+    def tearDown(self):
+        self.index.close()
+        shutil.rmtree(self.tmpdir)
+
+    def path(self, subdir, name):
+        return os.path.join(self.sectiondir, subdir, name)
+
+    def write(self, subdir, name, mtime=None):
+        with open(self.path(subdir, name), "w") as f:
+            f.write(name)
+        if mtime is not None:
+            os.utime(self.path(subdir, name), (mtime, mtime))
+
+    def testInitialBuild(self):
+        self.assertTrue(self.index.exists(self.path("pass", "pkg-a_1.log")))
+        self.assertFalse(self.index.exists(self.path("fail", "pkg-a_1.log")))
+        self.assertEqual([x[0] for x in self.index.list_dir(os.path.join(self.sectiondir, "pass"))],
+                         ["pkg-a_1.log", "pkg-b_1.log"])
+        self.assertEqual(self.index.query(self.sectiondir, older_than=1800),
+                         [self.path("pass", "pkg-a_1.log"), self.path("fail", "pkg-c_1.log")])
+        self.assertEqual(self.index.verify(self.sectiondir), [])
+
+    def testVerify(self):
+        self.index.verify(self.sectiondir)
+        os.remove(self.path("pass", "pkg-a_1.log"))
+        self.write("pass", "pkg-d_1.log")
+        self.write("pass", "pkg-b_1.log", mtime=3000)
+        self.assertEqual(self.index.verify(self.sectiondir),
+                         [("changed", self.path("pass", "pkg-b_1.log")),
+                          ("missing", self.path("pass", "pkg-d_1.log")),
+                          ("stale", self.path("pass", "pkg-a_1.log"))])
+        self.index.rebuild(self.sectiondir)
+        self.assertEqual(self.index.verify(self.sectiondir), [])
+
+    def testMove(self):
+        os.makedirs(os.path.join(self.sectiondir, "bugged"))
+        old_path = self.path("fail", "pkg-c_1.log")
+        new_path = self.path("bugged", "pkg-c_1.log")
+        self.index.exists(old_path)
+        os.rename(old_path, new_path)
+        self.index.move(old_path, new_path)
+        self.assertFalse(self.index.exists(old_path))
+        self.assertTrue(self.index.exists(new_path))
+        self.assertEqual(self.index.verify(self.sectiondir), [])
+
+    def testUpdate(self):
+        os.makedirs(os.path.join(self.sectiondir, "recycle"))
+        self.index.verify(self.sectiondir)
+        # like reschedule_oldest_logs and reclassify_bugged
+        os.link(self.path("pass", "pkg-a_1.log"), self.path("recycle", "pkg-a_1.log"))
+        os.remove(self.path("pass", "pkg-b_1.log"))
+        self.index.update(os.path.join(self.sectiondir, "recycle"))
+        self.index.update(self.path("pass", "pkg-b_1.log"))
+        self.assertTrue(self.index.exists(self.path("recycle", "pkg-a_1.log")))
+        self.assertFalse(self.index.exists(self.path("pass", "pkg-b_1.log")))
+        self.assertEqual(self.index.verify(self.sectiondir), [])
+
+    def testIndexedLogDB(self):
+        db = packagesdb.PackagesDB(logdb=packagesdb.IndexedLogDB(self.index),
+                                   prefix=self.sectiondir)
+        pf = packagesdb.PackagesFile()
+        pf._read_file(StringIO.StringIO(PACKAGES))
+        db._packages_files.append(pf)
+        self.assertEqual(db.get_package_state("pkg-a"), "successfully-tested")
+        self.assertEqual(db.get_package_state("pkg-c"), "failed-testing")
+        name = db.reserve_package()["Package"]
+        self.assertTrue(name in ("pkg-d", "pkg-e", "pkg-f"))
+        self.assertTrue(self.index.exists(self.path("reserved", name + "_1.log")))
+        db.pass_package(name, "1", "log")
+        self.assertFalse(self.index.exists(self.path("reserved", name + "_1.log")))
+        self.assertTrue(self.index.exists(self.path("pass", name + "_1.log")))
+        self.assertEqual(self.index.verify(self.sectiondir), [])
+
+
+if __name__ == "__main__":
+    unittest.main()
+
+# vi:set et ts=4 sw=4 :
@@ -0,0 +1,77 @@
+import os
+import shutil
+import tempfile
+import unittest
+import StringIO
+
+import piupartslib.metrics as metrics
+import piupartslib.packagesdb as packagesdb
+
+from test_packagesdb import PACKAGES
+
+
+class MetricsTests(unittest.TestCase):
+
+    def testFormat(self):
+        m = metrics.Metrics()
+        m.inc("requests_total", {"section": "sid", "command": "reserve"})
+        m.inc("requests_total", {"command": "reserve", "section": "sid"}, 2)
+        m.set("packages", 5, {"state": "waiting-to-be-tested"})
+        m.observe("command_seconds", 0.5)
+        m.observe("command_seconds", 1.5)
+        self.assertEqual(m.get("requests_total", {"section": "sid", "command": "reserve"}), 3)
+        self.assertEqual(m.get("command_seconds"), (2, 2.0, 1.5))
+        self.assertEqual(m.get("unknown"), None)
+        self.assertEqual(m.format(), """\
+# TYPE command_seconds summary
+command_seconds_count 2
+command_seconds_sum 2.0
+command_seconds_max 1.5
+# TYPE packages gauge
+packages{state="waiting-to-be-tested"} 5
+# TYPE requests_total counter
+requests_total{command="reserve",section="sid"} 3
+""")
+
+    def testLabelEscaping(self):
+        m = metrics.Metrics()
+        m.inc("x", {"slave": 'a"b\\c'})
+        self.assertEqual(m.format(), '# TYPE x counter\nx{slave="a\\"b\\\\c"} 1\n')
+
+    def testWrite(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            filename = os.path.join(tmpdir, "master.prom")
+            m = metrics.Metrics()
+            with m.timer("t"):
+                pass
+            m.write(filename)
+            self.assertEqual(open(filename).read(), m.format())
+            self.assertEqual(os.listdir(tmpdir), ["master.prom"])
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def testPackagesDBPhases(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            metrics.registry.reset()
+            db = packagesdb.PackagesDB(prefix=tmpdir)
+            pf = packagesdb.PackagesFile()
+            pf._read_file(StringIO.StringIO(PACKAGES))
+            db._packages_files.append(pf)
+            self.assertEqual(db.get_state_counts()["waiting-to-be-tested"], 3)
+            db.pass_package("pkg-c", "1", "log")
+            db.get_package_state("pkg-b")
+            self.assertEqual(db.rrdep_count("pkg-c"), 4)
+            for phase in ["logs", "states", "update", "rdep-metrics"]:
+                (count, seconds, max) = metrics.registry.get(
+                    "piuparts_packagesdb_phase_seconds", {"section": tmpdir, "phase": phase})
+                self.assertEqual(count, 1)
+        finally:
+            shutil.rmtree(tmpdir)
+
+
+if __name__ == "__main__":
+    unittest.main()
+
+# vi:set et ts=4 sw=4 :
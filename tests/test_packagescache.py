@@ -0,0 +1,112 @@
+import unittest
+import os
+import shutil
+import tempfile
+import threading
+import gzip
+import hashlib
+import BaseHTTPServer
+import SimpleHTTPServer
+
+import piupartslib.packagesdb as packagesdb
+import piupartslib.packagescache as packagescache
+
+from test_packagesdb import PACKAGES
+
+
+class MirrorHandler(SimpleHTTPServer.SimpleHTTPRequestHandler):
+
+    mirror = None
+
+    def translate_path(self, path):
+        return os.path.join(self.mirror, os.path.basename(path))
+
+    def log_message(self, format, *args):
+        pass
+
+
+class NoValidatorsHandler(MirrorHandler):
+
+    def send_header(self, keyword, value):
+        if keyword != "Last-Modified":
+            MirrorHandler.send_header(self, keyword, value)
+
+
+class PackagesCacheTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.mirror = os.path.join(self.tmpdir, "mirror")
+        os.makedirs(self.mirror)
+        self.write_packages(PACKAGES)
+        MirrorHandler.mirror = self.mirror
+        self.start_server(MirrorHandler)
+        self.url = "http://127.0.0.1:%d/Packages" % self.server.server_port
+        self.cache = packagescache.PackagesCache(os.path.join(self.tmpdir, "cache"))
+
+    def start_server(self, handler):
+        self.server = BaseHTTPServer.HTTPServer(("127.0.0.1", 0), handler)
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.start()
+
+    def stop_server(self):
+        self.server.shutdown()
+        self.thread.join()
+        self.server.server_close()
+
+    def tearDown(self):
+        self.stop_server()
+        shutil.rmtree(self.tmpdir)
+
+    def write_packages(self, contents, mtime=1000000000):
+        filename = os.path.join(self.mirror, "Packages.gz")
+        f = gzip.open(filename, "wb")
+        f.write(contents)
+        f.close()
+        os.utime(filename, (mtime, mtime))
+        with open(filename, "rb") as f:
+            sha256 = hashlib.sha256(f.read()).hexdigest()
+        with open(os.path.join(self.mirror, "Release"), "w") as f:
+            f.write("Suite: sid\nSHA256:\n %s 1234 main/binary-amd64/Packages.gz\n" % sha256)
+
+    def load(self):
+        pf = packagesdb.PackagesFile(cache=self.cache)
+        pf.load_packages_urls([self.url])
+        return pf
+
+    def testReuseSnapshot(self):
+        pf = self.load()
+        self.assertEqual((self.cache.hits, self.cache.misses), (0, 1))
+        pf2 = self.load()
+        self.assertEqual((self.cache.hits, self.cache.misses), (1, 1))
+        self.assertEqual(pf2.get_urls(), [self.url + ".gz"])
+        self.assertEqual(sorted(pf2.keys()), sorted(pf.keys()))
+        for name in pf.keys():
+            self.assertEqual(pf2[name].all_dependencies(), pf[name].all_dependencies())
+            self.assertEqual(pf2[name].version(), pf[name].version())
+
+    def testModifiedFile(self):
+        self.load()
+        self.write_packages(PACKAGES + "\nPackage: pkg-g\nVersion: 1\n", mtime=1100000000)
+        pf = self.load()
+        self.assertEqual((self.cache.hits, self.cache.misses), (0, 2))
+        self.assertTrue("pkg-g" in pf)
+
+    def testReleaseHash(self):
+        self.stop_server()
+        self.start_server(NoValidatorsHandler)
+        self.url = "http://127.0.0.1:%d/debian/dists/sid/main/binary-amd64/Packages" % \
+            self.server.server_port
+        self.assertEqual(packagescache.get_release_hash(self.url + ".xz"), None)
+        self.load()
+        self.load()
+        self.assertEqual((self.cache.hits, self.cache.misses), (1, 1))
+        self.write_packages(PACKAGES + "\nPackage: pkg-g\nVersion: 1\n")
+        self.assertTrue("pkg-g" in self.load())
+        self.assertEqual((self.cache.hits, self.cache.misses), (1, 2))
+
+
+if __name__ == "__main__":
+    unittest.main()
+
+# vi:set et ts=4 sw=4 :
@@ -0,0 +1,330 @@
+import os
+import time
+import unittest
+import shutil
+import tempfile
+import StringIO
+
+import piupartslib.packagesdb as packagesdb
+
+
+PACKAGES = """\
+Package: pkg-a
+Version: 1
+Depends: pkg-b
+
+Package: pkg-b
+Version: 1
+Depends: pkg-c | pkg-d
+
+Package: pkg-c
+Version: 1
+
+Package: pkg-d
+Version: 1
+
+Package: pkg-e
+Version: 1
+Depends: pkg-a, pkg-f
+
+Package: pkg-f
+Version: 1
+Depends: pkg-e
+"""
+
+
+class PackageTests(unittest.TestCase):
+
+    stanza = """\
+Package: foo
+Source: foo-src (1.0-1)
+Version: 1.0-1+b1
+Depends: libc6 (>= 2.14),
+ bar | baz
+Description: the foo
+ long description
+"""
+
+    def testFields(self):
+        p = packagesdb.Package(self.stanza)
+        self.assertEqual(p.name(), "foo")
+        self.assertEqual(p.source(), "foo-src")
+        self.assertEqual(p.source_version(), "1.0-1")
+        self.assertEqual(p.dependencies(), ["libc6", "bar"])
+        self.assertEqual(p.all_dependencies(), [["libc6"], ["bar", "baz"]])
+        self.assertEqual(p["Description"], "the foo\n long description")
+        self.assertFalse("Provides" in p)
+        self.assertEqual(p.get("Uploaders", ""), "")
+
+    def testDump(self):
+        p = packagesdb.Package(self.stanza)
+        output = StringIO.StringIO()
+        p.dump(output)
+        self.assertEqual(output.getvalue(), self.stanza)
+
+    def testSharedDependencies(self):
+        p = packagesdb.Package(self.stanza)
+        q = packagesdb.Package(self.stanza.replace("foo", "qux"))
+        self.assertTrue(packagesdb.parse_dependency_names(p["Depends"]) is
+                        packagesdb.parse_dependency_names(q["Depends"]))
+        p.prefer_alt_depends("Depends", 1, "baz")
+        self.assertEqual(p.dependencies(), ["libc6", "baz"])
+        self.assertEqual(q.dependencies(), ["libc6", "bar"])
+
+    def testTestVersions(self):
+        p = packagesdb.Package(self.stanza)
+        self.assertEqual(p.test_versions(), "1.0-1+b1")
+        p.set_test_versions("None")
+        self.assertEqual(p.test_versions(), "None")
+
+
+class PackagesFileTests(unittest.TestCase):
+
+    def read(self, parser, restrict_packages=None):
+        pf = packagesdb.PackagesFile(parser=parser)
+        if parser == "apt":
+            pf._read_tagfile(StringIO.StringIO(PACKAGES + "\n" + PackageTests.stanza),
+                             restrict_packages=restrict_packages)
+        else:
+            pf._read_file(StringIO.StringIO(PACKAGES + "\n" + PackageTests.stanza),
+                          restrict_packages=restrict_packages)
+        return pf
+
+    def dump(self, pf):
+        output = StringIO.StringIO()
+        for name in sorted(pf.keys()):
+            pf[name].dump(output)
+        return output.getvalue()
+
+    def testParsersAreEquivalent(self):
+        pf_python = self.read("python")
+        pf_apt = self.read("apt")
+        self.assertEqual(sorted(pf_apt.keys()), sorted(pf_python.keys()))
+        for name in pf_python.keys():
+            self.assertEqual(pf_apt[name].all_dependencies(), pf_python[name].all_dependencies())
+            self.assertEqual(pf_apt[name].source_version(), pf_python[name].source_version())
+        self.assertEqual(self.dump(pf_apt), self.dump(pf_python))
+
+    def testRestrictPackages(self):
+        pf = self.read("apt", restrict_packages=set(["foo", "pkg-a"]))
+        self.assertEqual(sorted(pf.keys()), ["foo", "pkg-a"])
+
+
+class PackagesDbTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def new_db(self, packages_file_contents=PACKAGES):
+        db = packagesdb.PackagesDB(prefix=self.tmpdir)
+        pf = packagesdb.PackagesFile()
+        pf._read_file(StringIO.StringIO(packages_file_contents))
+        db._packages_files.append(pf)
+        return db
+
+    def states(self, db):
+        return dict([(name, db.get_package_state(name))
+                     for name in db.get_all_package_names()])
+
+    def testInitialStates(self):
+        db = self.new_db()
+        states = self.states(db)
+        self.assertEqual(states["pkg-c"], "waiting-to-be-tested")
+        self.assertEqual(states["pkg-d"], "waiting-to-be-tested")
+        self.assertEqual(states["pkg-b"], "waiting-for-dependency-to-be-tested")
+        self.assertEqual(states["pkg-a"], "waiting-for-dependency-to-be-tested")
+        self.assertEqual(states["pkg-e"], "waiting-for-dependency-to-be-tested")
+
+    def testDependencyCycle(self):
+        db = self.new_db()
+        self.assertEqual(db._get_dependency_cycle("pkg-e"), ["pkg-e", "pkg-f"])
+        self.assertEqual(db._get_dependency_cycle("pkg-a"), [])
+        self.assertEqual(db._get_recursive_dependencies(db.get_package("pkg-a")),
+                         ["pkg-b", "pkg-c", "pkg-d"])
+
+    def testUnchosenAlternativeIsNoCycle(self):
+        db = self.new_db("""\
+Package: aa
+Version: 1
+Depends: xx
+
+Package: xx
+Version: 1
+Depends: yy | aa
+
+Package: yy
+Version: 1
+Depends: zz
+
+Package: zz
+Version: 1
+""")
+        self.assertEqual(db.get_package_state("aa"), "waiting-for-dependency-to-be-tested")
+        self.assertEqual(db.get_package_state("xx"), "waiting-for-dependency-to-be-tested")
+        self.assertEqual(db._get_dependency_cycle("aa"), [])
+
+    def testCircularErrorPropagation(self):
+        db = self.new_db()
+        db.pass_package("pkg-c", "1", "log")
+        db.pass_package("pkg-b", "1", "log")
+        db.fail_package("pkg-a", "1", "log")
+        db = self.new_db()
+        self.assertEqual(db.get_package_state("pkg-e"), "dependency-failed-testing")
+        self.assertEqual(db.get_package_state("pkg-f"), "dependency-failed-testing")
+
+    def testIncrementalPass(self):
+        db = self.new_db()
+        db.get_package_state("pkg-a")
+        db.pass_package("pkg-c", "1", "log")
+        self.assertEqual(db.get_package_state("pkg-c"), "successfully-tested")
+        self.assertEqual(db.get_package_state("pkg-b"), "waiting-to-be-tested")
+        self.assertEqual(self.states(db), self.states(self.new_db()))
+        self.assertTrue("pkg-b" in db.get_pkg_names_in_state("waiting-to-be-tested"))
+        self.assertFalse("pkg-c" in db.get_pkg_names_in_state("waiting-to-be-tested"))
+
+    def testIncrementalFail(self):
+        db = self.new_db()
+        db.get_package_state("pkg-a")
+        db.pass_package("pkg-c", "1", "log")
+        db.pass_package("pkg-b", "1", "log")
+        db.fail_package("pkg-a", "1", "log")
+        self.assertEqual(db.get_package_state("pkg-e"), "dependency-failed-testing")
+        self.assertEqual(self.states(db), self.states(self.new_db()))
+        self.assertEqual(db.block_count("pkg-a"), 2)
+
+    def testReloadPackageStates(self):
+        db = self.new_db()
+        self.assertEqual(db.get_package_state("pkg-c"), "waiting-to-be-tested")
+        # another process submits a log
+        packagesdb.LogDB().create(db._ok, "pkg-c", "1", "log")
+        self.assertEqual(db.get_package_state("pkg-c"), "waiting-to-be-tested")
+        db.reload_package_states()
+        self.assertEqual(db.get_package_state("pkg-c"), "successfully-tested")
+        self.assertEqual(db.reserve_package()["Package"], "pkg-b")
+        self.assertEqual(self.states(db), self.states(self.new_db()))
+
+    def testReservationLease(self):
+        db = self.new_db()
+        db.set_reservation_lease_time(3600)
+        self.assertEqual(db.reserve_package()["Package"], "pkg-c")
+        self.assertTrue(db.renew_reservation("pkg-c", "1"))
+        self.assertFalse(db.renew_reservation("pkg-b", "1"))
+        self.assertEqual(db.expire_reservations(), [])
+        old = time.time() - 7200
+        os.utime(os.path.join(db._reserved, "pkg-c_1.log"), (old, old))
+        self.assertEqual(db.expire_reservations(), [("pkg-c", "1")])
+        self.assertFalse(db.renew_reservation("pkg-c", "1"))
+        self.assertEqual(db.reserve_package()["Package"], "pkg-c")
+
+    def testCheckpoint(self):
+        checkpoint = os.path.join(self.tmpdir, "checkpoint")
+        db = self.new_db()
+        db.enable_checkpoint(checkpoint)
+        self.assertFalse(db.save_checkpoint())
+        db.pass_package("pkg-c", "1", "log")
+        db.fail_package("pkg-b", "1", "log")
+        self.assertEqual(db.block_count("pkg-b"), 3)
+        self.assertTrue(db.save_checkpoint())
+        self.assertFalse(db.save_checkpoint())
+        # another process changes the logs
+        packagesdb.LogDB().remove(db._fail, "pkg-b", "1")
+        packagesdb.LogDB().create(db._ok, "pkg-d", "1", "log")
+        db = self.new_db()
+        db.enable_checkpoint(checkpoint)
+        db._initialize_package_states = None  # must not be used
+        self.assertEqual(self.states(db), self.states(self.new_db()))
+        self.assertEqual(self.rrdep_counts(db), self.rrdep_counts(self.new_db()))
+        self.assertTrue(db.save_checkpoint())
+
+    def testOutdatedCheckpoint(self):
+        checkpoint = os.path.join(self.tmpdir, "checkpoint")
+        db = self.new_db()
+        db.enable_checkpoint(checkpoint)
+        self.assertEqual(db.get_package_state("pkg-b"), "waiting-for-dependency-to-be-tested")
+        db.pass_package("pkg-c", "1", "log")
+        self.assertTrue(db.save_checkpoint())
+        db = self.new_db(PACKAGES.replace("Depends: pkg-c | pkg-d", "Depends: pkg-d"))
+        db.enable_checkpoint(checkpoint)
+        self.assertEqual(db.get_package_state("pkg-b"), "waiting-for-dependency-to-be-tested")
+
+    def testLogJournal(self):
+        db = self.new_db()
+        db.journal_log("pass", "pkg-c", "1", "log\n", "slave1")
+        db.journal_log("fail", "pkg-b", "1", "")
+        db.journal_log("pass", "pkg-c", "1", "duplicate")
+        with open(os.path.join(self.tmpdir, "log-journal"), "ab") as f:
+            f.write("pass pkg-d 1 100\nincomplete")
+        self.assertEqual(db.get_package_state("pkg-c"), "waiting-to-be-tested")
+        self.assertEqual(db.replay_log_journal(), 3)
+        self.assertEqual(db.get_package_state("pkg-c"), "successfully-tested")
+        self.assertEqual(db.get_package_state("pkg-b"), "failed-testing")
+        self.assertEqual(db.get_package_state("pkg-d"), "waiting-to-be-tested")
+        self.assertEqual(open(os.path.join(db._ok, "pkg-c_1.log")).read(), "log\n")
+        self.assertEqual(db.replay_log_journal(), 0)
+        db.flush_submissions()
+        self.assertEqual([(s.result, s.package, s.slave, s.size) for s in db.get_submissions().since(0)],
+                         [("pass", "pkg-c", "slave1", 4), ("fail", "pkg-b", None, 0)])
+
+    def rrdep_counts(self, db):
+        return dict([(name, (db.rrdep_count(name), db.block_count(name),
+                             db.waiting_count(name), db.rdep_chain_len(name)))
+                     for name in db.get_all_package_names()])
+
+    def testRrdepCounts(self):
+        db = self.new_db()
+        db.fail_package("pkg-b", "1", "log")
+        db = self.new_db()
+        db._rrdep_block_size = 2
+        counts = self.rrdep_counts(db)
+        self.assertEqual(counts["pkg-b"], (3, 3, 0, 4))
+        self.assertEqual(counts["pkg-c"], (4, 0, 0, 5))
+        self.assertEqual(counts["pkg-d"], (0, 0, 0, 1))
+        self.assertEqual(counts["pkg-e"], (1, 1, 0, 2))
+        # compare with the per-package fallback
+        db2 = self.new_db()
+        db2._all_rrdep_counts_done = True
+        self.assertEqual(counts, self.rrdep_counts(db2))
+
+    def testIncrementalRrdepCounts(self):
+        db = self.new_db()
+        db.pass_package("pkg-d", "1", "log")
+        self.assertEqual(db.rrdep_count("pkg-d"), 4)
+        reserved = []
+        p = db.reserve_package()
+        while p is not None:
+            reserved.append(p["Package"])
+            p = db.reserve_package()
+        self.assertTrue("pkg-b" in reserved)
+        self.assertEqual(self.states(db), self.states(self.new_db()))
+        self.assertEqual(self.rrdep_counts(db), self.rrdep_counts(self.new_db()))
+
+    def testIncrementalCandidates(self):
+        db = self.new_db()
+        self.assertEqual(db.reserve_package()["Package"], "pkg-c")
+        reserved = set()
+        p = db.reserve_package()
+        while p is not None:
+            reserved.add(p["Package"])
+            p = db.reserve_package()
+        self.assertEqual(reserved, set(["pkg-d", "pkg-f"]))
+        db.pass_package("pkg-c", "1", "log")
+        self.assertEqual(db.reserve_package()["Package"], "pkg-b")
+
+    def testUnreserveRequeues(self):
+        db = self.new_db()
+        self.assertEqual(db.reserve_package()["Package"], "pkg-c")
+        db.unreserve_package("pkg-c", "1")
+        self.assertEqual(db.reserve_package()["Package"], "pkg-c")
+        # no stale entries are returned
+        reserved = [db.reserve_package()["Package"], db.reserve_package()["Package"]]
+        self.assertEqual(sorted(reserved), ["pkg-d", "pkg-f"])
+        self.assertEqual(db.reserve_package(), None)
+
+
+if __name__ == "__main__":
+    unittest.main()
+
+# vi:set et ts=4 sw=4 :
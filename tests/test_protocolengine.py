@@ -0,0 +1,156 @@
+import socket
+import threading
+import unittest
+
+import piupartslib.protocolengine as protocolengine
+
+
+class FakeSession:
+
+    """Echoes the commands, "wait" blocks until the test releases it"""
+
+    def __init__(self, output, test):
+        self._output = output
+        self._test = test
+        self._output.write("hello\n")
+        self._output.flush()
+
+    def get_data_format(self, command, args):
+        if command == "long":
+            return "long"
+        if command == "bytes":
+            return int(args[0])
+        if command == "bad":
+            raise protocolengine.ProtocolError("bad command")
+        return None
+
+    def run_command(self, command, args, data):
+        if command == "wait":
+            self._test.waiting.set()
+            self._test.release.wait(10)
+        self._output.write("ok %s %s %r\n" % (command, " ".join(args), data))
+        self._output.flush()
+
+    def close(self):
+        self._test.closed.append(self)
+
+
+class Client:
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.sock.settimeout(10)
+        self.buf = ""
+
+    def send(self, data):
+        self.sock.sendall(data)
+
+    def readline(self):
+        while "\n" not in self.buf:
+            data = self.sock.recv(4096)
+            if not data:
+                (line, self.buf) = (self.buf, "")
+                return line
+            self.buf += data
+        (line, self.buf) = self.buf.split("\n", 1)
+        return line + "\n"
+
+
+class ProtocolEngineTests(unittest.TestCase):
+
+    def setUp(self):
+        self.waiting = threading.Event()
+        self.release = threading.Event()
+        self.closed = []
+        self.start_engine()
+
+    def tearDown(self):
+        self.release.set()
+        self.stop_engine()
+
+    def start_engine(self, **kwargs):
+        self.engine = protocolengine.ProtocolEngine(**kwargs)
+        self.thread = threading.Thread(target=self.engine.serve_forever,
+                                       kwargs={"timeout": 1})
+        self.thread.start()
+
+    def stop_engine(self):
+        self.engine.stop()
+        self.thread.join(10)
+        self.engine.close()
+
+    def connect(self):
+        (server, client) = socket.socketpair()
+        self.engine.add_connection(server, lambda output: FakeSession(output, self))
+        client = Client(client)
+        self.assertEqual(client.readline(), "hello\n")
+        return client
+
+    def testCommands(self):
+        client = self.connect()
+        client.send("status\nlong\n line 1\n line 2\n.\nbytes 5 x\nab\ncd")
+        self.assertEqual(client.readline(), "ok status  None\n")
+        self.assertEqual(client.readline(), "ok long  'line 1\\nline 2\\n'\n")
+        self.assertEqual(client.readline(), "ok bytes 5 x 'ab\\ncd'\n")
+        client.send("\n")
+        self.assertEqual(client.readline(), "")
+        self.assertEqual(len(self.closed), 1)
+
+    def testBusySessionDoesNotBlockOthers(self):
+        client1 = self.connect()
+        client1.send("wait\n")
+        self.assertTrue(self.waiting.wait(10))
+        client2 = self.connect()
+        # a slow upload and a command while the other session is busy
+        client2.send("bytes 6\nabc")
+        client2.send("def")
+        self.assertEqual(client2.readline(), "ok bytes 6 'abcdef'\n")
+        client2.send("status\n")
+        self.assertEqual(client2.readline(), "ok status  None\n")
+        self.release.set()
+        self.assertEqual(client1.readline(), "ok wait  None\n")
+
+    def testLongUpload(self):
+        client = self.connect()
+        lines = ["line %d\n" % i for i in range(20000)]
+        client.send("long\n" + "".join([" " + line for line in lines]) + ".\nbytes 100000\n")
+        self.assertEqual(client.readline(), "ok long  %r\n" % "".join(lines))
+        client.send("x" * 100000)
+        self.assertEqual(client.readline(), "ok bytes 100000 %r\n" % ("x" * 100000))
+
+    def testBoundedWorkers(self):
+        self.stop_engine()
+        self.start_engine(max_threads=2)
+        clients = [self.connect() for i in range(5)]
+        clients[0].send("wait\n")
+        self.assertTrue(self.waiting.wait(10))
+        # the other sessions share the remaining worker
+        for client in clients[1:]:
+            client.send("status\n")
+        for client in clients[1:]:
+            self.assertEqual(client.readline(), "ok status  None\n")
+        self.assertEqual(self.engine._threads, 2)
+        self.release.set()
+        self.assertEqual(clients[0].readline(), "ok wait  None\n")
+
+    def testProtocolError(self):
+        client = self.connect()
+        client.send("long\nno space\n.\nstatus\n")
+        self.assertEqual(client.readline(), "")
+        client = self.connect()
+        client.send("bad\nstatus\n")
+        self.assertEqual(client.readline(), "")
+        self.assertEqual(len(self.closed), 2)
+
+    def testEofClosesSession(self):
+        client = self.connect()
+        client.send("bytes 10\nabc")
+        client.sock.shutdown(socket.SHUT_WR)
+        self.assertEqual(client.readline(), "")
+        self.assertEqual(len(self.closed), 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
+
+# vi:set et ts=4 sw=4 :
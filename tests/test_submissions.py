@@ -0,0 +1,76 @@
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+import piupartslib.submissions as submissions
+
+
+class SubmissionsJournalTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.tmpdir, "submissions.txt")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def testParse(self):
+        s = submissions.parse_submission("1000 pass foo 1.0\n")
+        self.assertEqual(s, (1000, "pass", "foo", "1.0", None, None, None))
+        s = submissions.parse_submission("1000 fail foo 1.0 slave1 65 1234\n")
+        self.assertEqual(s, (1000, "fail", "foo", "1.0", "slave1", 65, 1234))
+        self.assertEqual(submissions.format_submission(s), "1000 fail foo 1.0 slave1 65 1234\n")
+        self.assertEqual(submissions.parse_submission("1000 pass foo\n"), None)
+        self.assertEqual(submissions.parse_submission("x pass foo 1.0\n"), None)
+
+    def testLogDuration(self):
+        log = "0m0.0s INFO: start\n1m5.9s INFO: PASS: All tests.\n"
+        self.assertEqual(submissions.get_log_duration(log), 65)
+        self.assertEqual(submissions.get_log_duration("no timestamps\n"), None)
+        self.assertEqual(submissions.get_log_duration(""), None)
+
+    def testBufferedRecords(self):
+        journal = submissions.SubmissionsJournal(self.filename, flush_count=3)
+        journal.record("pass", "foo", "1", "slave1", 10, 100)
+        journal.record("fail", "bar", "2")
+        self.assertFalse(os.path.exists(self.filename))
+        journal.record("pass", "baz", "3")
+        self.assertEqual(len(open(self.filename).readlines()), 3)
+        journal.record("pass", "foo", "2")
+        journal.flush()
+        result = [(s.package, s.slave) for s in journal.since(0)]
+        self.assertEqual(result, [("foo", "slave1"), ("bar", None), ("baz", None), ("foo", None)])
+
+    def testSinceUsesIndex(self):
+        with open(self.filename, "w") as f:
+            for t in range(1000, 3000):
+                f.write("%d pass pkg%d 1\n" % (t, t))
+        journal = submissions.SubmissionsJournal(self.filename, index_interval=1000)
+        self.assertEqual(journal.convert(), 2000)
+        index = journal._read_index(os.path.getsize(self.filename))
+        self.assertTrue(len(index) > 10)
+        self.assertEqual([s.timestamp for s in journal.since(2990)], range(2990, 3000))
+        self.assertEqual(len(list(journal.since(0))), 2000)
+        # the index of a replaced journal is ignored
+        with open(self.filename, "w") as f:
+            f.write("1000 pass foo 1\n")
+        self.assertEqual(journal._read_index(os.path.getsize(self.filename)), [])
+        self.assertEqual(len(list(journal.since(0))), 1)
+
+    def testThroughput(self):
+        journal = submissions.SubmissionsJournal(self.filename, flush_count=1)
+        now = int(time.time())
+        journal.record("pass", "foo", "1")
+        journal.record("pass", "bar", "1")
+        hour = now - now % 3600
+        self.assertEqual(sum(journal.throughput(now - 3600).values()), 2)
+        self.assertTrue(journal.throughput(now - 3600).keys()[0] in [hour, hour + 3600])
+        self.assertEqual(journal.throughput(now - 3600, now - 1800), {})
+
+
+if __name__ == "__main__":
+    unittest.main()
+
+# vi:set et ts=4 sw=4 :
@@ -0,0 +1,41 @@
+import unittest
+
+import apt_pkg
+
+import piupartslib.versions as versions
+
+
+VERSIONS = ["1.0", "1.0~rc1", "1.0~~", "1.0-0", "1", "1.0.", "1.00", "1.0+b1",
+            "1:0.9", "2:0", "1.0-1", "1.0-1~bpo8+1", "1.0-1+b1", "1.0a",
+            "1.0-1.1", "0", "0.0", "10", "9.99", "1.0+dfsg-2", "1.0-a",
+            "20180101", "1.0~beta-1", "1.0.0~rc2-1"]
+
+
+def sign(x):
+    return (x > 0) - (x < 0)
+
+
+class VersionsTests(unittest.TestCase):
+
+    def testCompare(self):
+        self.assertTrue(versions.version_compare("1.0", "1.0~rc1") > 0)
+        self.assertEqual(versions.version_compare("1.0", "1.0-0"), 0)
+        self.assertTrue(versions.version_compare("1:0.9", "2.0") > 0)
+        self.assertTrue(("1.0", "1.0~rc1") in versions._compare_cache)
+
+    def testKeyMatchesCompare(self):
+        for a in VERSIONS:
+            for b in VERSIONS:
+                self.assertEqual(sign(cmp(versions.version_key(a), versions.version_key(b))),
+                                 sign(apt_pkg.version_compare(a, b)),
+                                 "%s %s" % (a, b))
+
+    def testSort(self):
+        self.assertEqual(sorted(["1.0", "1.0-1", "1.0~rc1", "0.9+b1"], key=versions.version_key),
+                         ["0.9+b1", "1.0~rc1", "1.0", "1.0-1"])
+
+
+if __name__ == "__main__":
+    unittest.main()
+
+# vi:set et ts=4 sw=4 :